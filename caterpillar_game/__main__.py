@@ -5,22 +5,44 @@ from .window import Window
 from .grid import Grid
 from .butterfly import Demo
 from .state import GameState
+from .state_store import ButterflyStore
 from .ui import LevelSelect
+from . import wing
 
-state = GameState.load()
+def main():
+    if 'WING_PROCESSES' in os.environ:
+        # Composite butterfly wings in this many worker processes
+        wing.use_process_pool(int(os.environ['WING_PROCESSES']))
 
-try:
-    level = int(sys.argv[1])
-except (IndexError, ValueError):
-    level = 5
+    if 'SAVE_DB' in os.environ:
+        # Keep the saved game in this sqlite database rather than in JSON
+        state = GameState.from_store(ButterflyStore(os.environ['SAVE_DB']))
+    else:
+        state = GameState.load()
 
-#window = Window(Grid(state, level=level))
-#window = Window(Demo())
-window = Window(state=state)
+    try:
+        level = int(sys.argv[1])
+    except (IndexError, ValueError):
+        level = 5
 
-if 'ENTR_ON' in os.environ:
-    # for rapid prototyping (entr), put window somewhat out of the way
-    window.set_location(3306, 1300)
-    #print('—' * os.get_terminal_size()[0])
+    #window = Window(GridView(Grid(state, level=level)))
+    #window = Window(Demo())
+    window = Window(state=state)
 
-window.run()
+    if 'LEVEL_RELOAD' in os.environ:
+        # for level design: pick up changes to maps.json while playing
+        window.watch_levels()
+
+    if 'ENTR_ON' in os.environ:
+        # for rapid prototyping (entr), put window somewhat out of the way
+        window.set_location(3306, 1300)
+        #print('—' * os.get_terminal_size()[0])
+
+    window.run()
+
+    wing.shutdown(wait=False)
+
+# Worker processes (see wing.use_process_pool) import the main module,
+# so the game only starts when this is run as a script
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,19 @@
 import random
 import math
 import time
+import weakref
+import functools
+import collections
 
 import pyglet
+import numpy
 
 from .resources import get_butterfly_image, get_image
 from .resources import BUTTERFLY_ANCHORS, BUTTERFLY_HEIGHT
-from .wing import start_wing_generation, get_wing_image, WING_PATCH_COUNT
+from .wing import start_wing_generation, start_wing_generations
+from .wing import get_wing_image, get_lod_size, WING_PATCH_COUNT
+from .wing import get_priority, set_wing_priority, cancel_wing_generation
+from .wing import get_changed_patches, recolor_wing_image
 from .util import random_hue
 
 BODY_COLOR = (61, 43, 6)
@@ -40,42 +47,50 @@ class Demo:
             )
             self.butterflies.append(butterfly)
         '''
+        self.renderer = ButterflyRenderer()
         _b = {}
+        placed = []
         for y in range(10):
             x = 0
             if y == 0:
                 butterfly = Butterfly(' ' * WING_PATCH_COUNT)
             else:
                 butterfly = Butterfly(random_hue() * WING_PATCH_COUNT)
-            sprite = ButterflySprite(
-                butterfly,
-                scale=0.1,
-                x=x*102+51, y=y*57+35,
-            )
-            self.butterflies.append(sprite)
+            placed.append((butterfly, x, y))
             _b[x, y] = butterfly
 
+        from .egg import Egg, make_butterflies
         for x in range(1, 10):
             plus_hues = ''.join(
                 random_hue() for i in range(WING_PATCH_COUNT)
             )
             ys = list(range(10))
             random.shuffle(ys)
-            for y in ys:
-                from .egg import Egg
-                if x % 2:
-                    d = -1
-                else:
-                    d = 1
-                butterfly = Egg([_b[x-1, y], _b[x-1, (y+d)%10]]).make_butterfly(plus_hues)
-                sprite = ButterflySprite(
-                    butterfly,
-                    scale=0.1,
-                    x=x*102+51, y=y*57+35,
-                )
-                self.butterflies.append(sprite)
+            if x % 2:
+                d = -1
+            else:
+                d = 1
+            # Each column is bred from the previous one in one go
+            eggs = [Egg([_b[x-1, y], _b[x-1, (y+d)%10]]) for y in ys]
+            butterflies = make_butterflies(eggs, [plus_hues] * len(eggs))
+            for y, butterfly in zip(ys, butterflies):
+                placed.append((butterfly, x, y))
                 _b[x, y] = butterfly
 
+        wing_gens = start_wing_generations(
+            [b.hues for b, x, y in placed],
+            size=get_lod_size(BUTTERFLY_HEIGHT * 0.1),
+        )
+        for (butterfly, x, y), wing_gen in zip(placed, wing_gens):
+            sprite = ButterflySprite(
+                butterfly,
+                scale=0.1,
+                x=x*102+51, y=y*57+35,
+                wing_gen=wing_gen,
+                renderer=self.renderer,
+            )
+            self.butterflies.append(sprite)
+
     def tick(self, dt):
         if dt > 0.5:
             return
@@ -83,49 +98,320 @@ class Demo:
 
     def draw(self):
         self.bg.draw()
-        for i, butterfly in enumerate(reversed(self.butterflies)):
-            butterfly.draw(self.t + i * 1/9 * (1 + i*0.01), partial=i%7==0)
+        self.renderer.draw(
+            (butterfly, self.t + i * 1/9 * (1 + i*0.01), i%7==0)
+            for i, butterfly in enumerate(reversed(self.butterflies))
+        )
 
 class Butterfly:
-    def __init__(self, hues=' ' * WING_PATCH_COUNT):
+    def __init__(self, hues=' ' * WING_PATCH_COUNT, parents=()):
         self.hues = hues
+        # Parents of the egg this butterfly hatched from
+        self.parents = tuple(parents)
 
     def to_dict(self):
+        """Return the butterfly as a dict; parents are not included
+
+        Whole lineages are saved with pedigree.Pedigree.
+        """
         return {
             'wing': str(self.hues),
         }
 
     @classmethod
-    def from_dict(cls, data):
-        return cls(hues=data.get('wing', ' '*WING_PATCH_COUNT))
+    def from_dict(cls, data, parents=()):
+        return cls(hues=data.get('wing', ' '*WING_PATCH_COUNT), parents=parents)
 
+    def ancestors(self):
+        """Iterate over all ancestors once each, nearest generations first"""
+        seen = set()
+        queue = collections.deque(self.parents)
+        while queue:
+            butterfly = queue.popleft()
+            if butterfly not in seen:
+                seen.add(butterfly)
+                yield butterfly
+                queue.extend(butterfly.parents)
 
-class ButterflySprite:
-    def __init__(self, butterfly, x=0, y=0, scale=1, wing_t=0):
-        self.wing_batch = pyglet.graphics.Batch()
-        self.body_batch = pyglet.graphics.Batch()
-        self.sprites = []
-        self.wing_sprite = None
-        for name in 'abdomen', 'thorax', 'head', 'antenna', 'eye':
-            sprite = pyglet.sprite.Sprite(
-                get_butterfly_image(name),
-                batch=self.body_batch,
+
+def get_wing_scale(t):
+    """Return how wide the wings are at time t; they flap every 2 units"""
+    t = t % 2
+    if t > 1:
+        t = 2 - t
+    return 1 - abs(math.sin(t*math.tau/4))**3 * 0.99
+
+
+BODY_PARTS = 'abdomen', 'thorax', 'head', 'antenna', 'eye'
+
+@functools.lru_cache()
+def get_body_atlas():
+    """Return the body part images packed into one texture
+
+    Return (texture, corners, tex_coords): corners of each part's quad
+    in butterfly coordinates, shape (part, corner, xy), and the texture
+    coordinates of the parts, shape (part, 12).
+    """
+    atlas = pyglet.image.atlas.TextureAtlas(2048, 2048)
+    corners = []
+    tex_coords = []
+    for name in BODY_PARTS:
+        image = get_butterfly_image(name)
+        # The parts are big and have transparent edges, so no border
+        region = atlas.add(image.get_region(0, 0, image.width, image.height))
+        y = (BUTTERFLY_ANCHORS['wing'] - BUTTERFLY_ANCHORS[name]) * BUTTERFLY_HEIGHT
+        x1 = -image.anchor_x
+        y1 = y - image.anchor_y
+        x2 = x1 + image.width
+        y2 = y1 + image.height
+        corners.append(((x1, y1), (x2, y1), (x2, y2), (x1, y2)))
+        tex_coords.append(region.tex_coords)
+    return (
+        atlas.texture,
+        numpy.array(corners, dtype='float32'),
+        numpy.array(tex_coords, dtype='float32'),
+    )
+
+
+@functools.lru_cache()
+def get_renderer():
+    """Return the ButterflyRenderer shared by sprites not given their own"""
+    return ButterflyRenderer()
+
+
+class WingSlab:
+    """A texture divided into equal slots, each holding one wing image
+
+    Slots are freed when their wing is no longer used, and reused by
+    later wings of the same size.
+    """
+    def __init__(self, atlas_size, slot_size):
+        per_row = max(1, atlas_size // slot_size)
+        side = per_row * slot_size
+        self.texture = pyglet.image.Texture.create(
+            side, side, pyglet.gl.GL_RGBA, rectangle=True,
+        )
+        self.slot_count = per_row * per_row
+        self.free = [
+            (x * slot_size, y * slot_size)
+            for y in reversed(range(per_row)) for x in reversed(range(per_row))
+        ]
+
+
+class ButterflyRenderer:
+    """Draws many butterflies with a few draw calls
+
+    Body parts come from one shared atlas, and wings are packed into the
+    renderer's own textures, with wings of each size sharing slabs of
+    equal slots. Each draw, the quads of all the butterflies are
+    computed together and written into one vertex list per texture.
+    """
+    def __init__(self, atlas_size=1024):
+        self.batch = pyglet.graphics.Batch()
+        self.atlas_size = atlas_size
+        # wing size -> WingSlabs with wings of that size
+        self.wing_slabs = {}
+        # Regions given back by release_wing, freed on the next add_wing
+        # (sprites may be collected on any thread)
+        self.released = []
+        self.body_group = pyglet.graphics.OrderedGroup(0)
+        self.wing_group = pyglet.graphics.OrderedGroup(1)
+        # texture ID -> [vertex list, number of quads it has room for]
+        self.vertex_lists = {}
+
+    def add_wing(self, image):
+        """Put a wing image into a slab; return its region there"""
+        self.free_released_wings()
+        slabs = self.wing_slabs.setdefault(image.width, [])
+        for slab in slabs:
+            if slab.free:
+                break
+        else:
+            # Slots have a 1-pixel border, so neighbours don't bleed in
+            slab = WingSlab(self.atlas_size, image.width + 2)
+            slabs.append(slab)
+        x, y = slab.free.pop()
+        slab.texture.blit_into(
+            image.get_region(0, 0, image.width, image.height), x + 1, y + 1, 0,
+        )
+        region = slab.texture.get_region(x + 1, y + 1, image.width, image.height)
+        region.anchor_x = image.anchor_x
+        region.anchor_y = image.anchor_y
+        return region
+
+    def release_wing(self, region):
+        """Give back a region from add_wing that won't be drawn any more"""
+        self.released.append(region)
+
+    def free_released_wings(self):
+        while self.released:
+            region = self.released.pop()
+            slabs = self.wing_slabs[region.width]
+            for slab in slabs:
+                if slab.texture.id == region.id:
+                    break
+            else:
+                continue
+            slab.free.append((region.x - 1, region.y - 1))
+            if len(slab.free) == slab.slot_count:
+                # The texture is deleted once nothing refers to it
+                slabs.remove(slab)
+                vertex_list, capacity = self.vertex_lists.pop(
+                    slab.texture.id, (None, 0),
+                )
+                if vertex_list:
+                    vertex_list.delete()
+
+    def draw(self, items):
+        """Draw butterflies given as (ButterflySprite, t, partial) triples
+
+        Butterflies are drawn as ButterflySprite.draw() would, in order;
+        but all bodies are drawn before all wings.
+        """
+        matrix = (pyglet.gl.GLfloat * 16)()
+        pyglet.gl.glGetFloatv(pyglet.gl.GL_MODELVIEW_MATRIX, matrix)
+        pixel_scale = abs(matrix[0])
+        bodies = []
+        wings = []
+        for sprite, t, partial in items:
+            if t is None:
+                t = sprite.wing_t
+            region = sprite.prepare_wing(
+                self, BUTTERFLY_HEIGHT * pixel_scale * sprite.scale,
             )
-            sprite.y = (
-                BUTTERFLY_ANCHORS['wing']-BUTTERFLY_ANCHORS[name]
-            ) * BUTTERFLY_HEIGHT
-            sprite.color = BODY_COLOR
-            self.sprites.append(sprite)
+            if region is None and not partial:
+                continue
+            bodies.append((sprite.x, sprite.y, sprite.scale))
+            if region is not None:
+                wings.append((
+                    sprite.x, sprite.y, sprite.scale, get_wing_scale(t), region,
+                ))
+
+        quads = {}
+        texture, corners, tex_coords = get_body_atlas()
+        if bodies:
+            x, y, scale = numpy.array(bodies, dtype='float32').T[..., None, None]
+            vertices = corners * scale[..., None]
+            vertices[..., 0] += x
+            vertices[..., 1] += y
+            quads[texture] = self.body_group, [(
+                vertices.reshape(-1, 4, 2),
+                numpy.tile(tex_coords, (len(bodies), 1)),
+                BODY_COLOR,
+            )]
+        if wings:
+            x, y, scale, wing_scale = numpy.array(
+                [wing[:4] for wing in wings], dtype='float32',
+            ).T[..., None]
+            regions = [wing[4] for wing in wings]
+            size = numpy.array([r.width for r in regions], dtype='float32')
+            anchors = numpy.array(
+                [(r.anchor_x, r.anchor_y) for r in regions], dtype='float32',
+            )
+            # Wing images are scaled to the full butterfly size
+            factor = (BUTTERFLY_HEIGHT / size)[:, None]
+            x1, y1 = (-anchors * factor).T[..., None]
+            x2, y2 = ((size[:, None] - anchors) * factor).T[..., None]
+            wing_xs = numpy.hstack([x1, x2, x2, x1]) * wing_scale
+            wing_ys = numpy.hstack([y1, y1, y2, y2]) * scale + y
+            x_wing = BUTTERFLY_ANCHORS['x-wing'] * BUTTERFLY_HEIGHT
+            # The left wing is the right one, mirrored around the body
+            vertices = numpy.stack([
+                numpy.stack([(x_wing + wing_xs) * side * scale + x, wing_ys], -1)
+                for side in (+1, -1)
+            ], axis=1)
+            tex_coords = numpy.array(
+                [r.tex_coords for r in regions], dtype='float32',
+            ).repeat(2, axis=0)
+            indices = {}
+            for i, region in enumerate(regions):
+                indices.setdefault(region.owner, []).append(i)
+            for texture, texture_indices in indices.items():
+                quad_indices = numpy.array(texture_indices)[:, None] * 2
+                quad_indices = (quad_indices + (0, 1)).ravel()
+                quads[texture] = self.wing_group, [(
+                    vertices[texture_indices].reshape(-1, 4, 2),
+                    tex_coords[quad_indices],
+                    (255, 255, 255),
+                )]
+
+        for texture_id in list(self.vertex_lists):
+            if not any(texture.id == texture_id for texture in quads):
+                vertex_list, capacity = self.vertex_lists.pop(texture_id)
+                vertex_list.delete()
+        for texture, (group, parts) in quads.items():
+            self.write_quads(texture, group, parts)
+        self.batch.draw()
+
+    def write_quads(self, texture, group, parts):
+        vertices = numpy.concatenate([p[0] for p in parts]).reshape(-1, 4, 2)
+        count = len(vertices)
+        vertex_list, capacity = self.vertex_lists.get(texture.id, (None, 0))
+        if count > capacity:
+            if vertex_list:
+                vertex_list.delete()
+            capacity = max(count, capacity * 2)
+            vertex_list = self.batch.add(
+                capacity * 4, pyglet.gl.GL_QUADS,
+                pyglet.sprite.SpriteGroup(
+                    texture,
+                    pyglet.gl.GL_SRC_ALPHA, pyglet.gl.GL_ONE_MINUS_SRC_ALPHA,
+                    parent=group,
+                ),
+                'v2f/stream', 'c4B/stream', 't3f/stream',
+            )
+            self.vertex_lists[texture.id] = vertex_list, capacity
+        # Quads not used this time are left with zero area
+        all_vertices = numpy.zeros((capacity, 4, 2), dtype='float32')
+        all_vertices[:count] = vertices
+        numpy.ctypeslib.as_array(vertex_list.vertices)[:] = all_vertices.ravel()
+        tex_coords = numpy.zeros((capacity, 12), dtype='float32')
+        tex_coords[:count] = numpy.concatenate([p[1] for p in parts])
+        numpy.ctypeslib.as_array(vertex_list.tex_coords)[:] = tex_coords.ravel()
+        colors = numpy.zeros((capacity, 4, 4), dtype='uint8')
+        start = 0
+        for part_vertices, part_tex_coords, color in parts:
+            end = start + len(part_tex_coords)
+            colors[start:end, :, :3] = color
+            colors[start:end, :, 3] = 255
+            start = end
+        numpy.ctypeslib.as_array(vertex_list.colors)[:] = colors.ravel()
+
+
+class ButterflySprite:
+    def __init__(
+        self, butterfly, x=0, y=0, scale=1, wing_t=0, wing_gen=None,
+        renderer=None,
+    ):
+        if renderer is None:
+            renderer = get_renderer()
+        self.renderer = renderer
+        # renderer -> region of the current wing in that renderer's slabs
+        self.wing_regions = {}
+        weakref.finalize(self, _release_wing_regions, self.wing_regions)
+        self.butterfly = butterfly
+        self.hues = butterfly.hues
         self.scale = scale
         self.x = x
         self.y = y
         self.wing_t = wing_t
-        self.wing_gen = start_wing_generation(butterfly.hues)
+        if wing_gen is None:
+            drawn_size = BUTTERFLY_HEIGHT * scale
+            wing_gen = start_wing_generation(
+                butterfly.hues, get_lod_size(drawn_size),
+                get_priority(False, drawn_size),
+            )
+        self.wing_gen = wing_gen
+        # Generation of a sharper wing, when drawn larger than wing_gen
+        self.sharper_wing_gen = None
+        # Wings still generated for this sprite; cancelled if it goes away
+        self.pending_wing_gens = [wing_gen]
+        weakref.finalize(self, _cancel_wing_generations, self.pending_wing_gens)
         self.alive_since = None
 
     @property
     def is_done(self):
-        return self.wing_sprite or get_wing_image(self.wing_gen)
+        return self.wing_regions or get_wing_image(self.wing_gen)
 
     @property
     def age(self):
@@ -134,37 +420,69 @@ class ButterflySprite:
         return time.time() - self.alive_since
 
     def draw(self, t=None, partial=False):
-        if t is None:
-            t = self.wing_t
-        t = t % 2
-        if t > 1:
-            t = 2 - t
-        if not self.wing_sprite:
+        self.renderer.draw([(self, t, partial)])
+
+    def prepare_wing(self, renderer, drawn_size):
+        """Get the wing ready for drawing at the given size on screen
+
+        Return its region in the renderer's atlas, or None if the wing
+        isn't generated yet.
+        """
+        if renderer not in self.wing_regions:
             image = get_wing_image(self.wing_gen)
             if image is None:
-                if not partial:
-                    return
-            else:
-                self.wing_sprite = pyglet.sprite.Sprite(
-                    image, batch=self.wing_batch,
-                )
-                self.sprites.append(self.wing_sprite)
+                set_wing_priority(self.wing_gen, get_priority(True, drawn_size))
+                return None
+            self.wing_regions[renderer] = renderer.add_wing(image)
+            if self.alive_since is None:
                 self.alive_since = time.time()
-        #age = self.age
-        #if self.age < 1:
-        #    t = min(1-self.age, t)
-        wing_scale = 1 - abs(math.sin(t*math.tau/4))**3 * 0.99
-        x_wing = BUTTERFLY_ANCHORS['x-wing'] * BUTTERFLY_HEIGHT
-        pyglet.gl.glPushMatrix()
-        try:
-            pyglet.gl.glTranslatef(self.x, self.y, 0)
-            pyglet.gl.glScalef(self.scale, self.scale, 1)
-            self.body_batch.draw()
-            pyglet.gl.glTranslatef(x_wing, 0, 0)
-            pyglet.gl.glScalef(wing_scale, 1, 1)
-            self.wing_batch.draw()
-            pyglet.gl.glTranslatef(-2 * x_wing / wing_scale, 0, 0)
-            pyglet.gl.glScalef(-1, 1, 1)
-            self.wing_batch.draw()
-        finally:
-            pyglet.gl.glPopMatrix()
+        self.update_wing_detail(renderer, drawn_size)
+        return self.wing_regions[renderer]
+
+    def update_wing_detail(self, renderer, drawn_size):
+        """Switch to a sharper wing texture if drawn larger than its size"""
+        if self.sharper_wing_gen:
+            image = get_wing_image(self.sharper_wing_gen)
+            if image:
+                self.wing_gen = self.sharper_wing_gen
+                self.sharper_wing_gen = None
+                self.pending_wing_gens[:] = [self.wing_gen]
+                # Other renderers pick up the new wing when they draw next
+                _release_wing_regions(self.wing_regions)
+                self.wing_regions[renderer] = renderer.add_wing(image)
+            return
+        size = get_lod_size(drawn_size)
+        if size > self.wing_gen[2]:
+            self.sharper_wing_gen = start_wing_generation(
+                self.hues, size, get_priority(True, drawn_size),
+            )
+            self.pending_wing_gens.append(self.sharper_wing_gen)
+
+    def recolor(self, hues):
+        """Show the butterfly with different hues
+
+        A wing that is already generated is updated in place, redoing
+        only the patches whose hue changed.
+        """
+        patches = get_changed_patches(self.hues, hues)
+        self.hues = hues
+        _cancel_wing_generations(self.pending_wing_gens)
+        self.sharper_wing_gen = None
+        image = get_wing_image(self.wing_gen)
+        if image is None:
+            self.wing_gen = start_wing_generation(hues, self.wing_gen[2])
+        else:
+            recolor_wing_image(
+                image, hues, patches, list(self.wing_regions.values()),
+            )
+        self.pending_wing_gens[:] = [self.wing_gen]
+
+
+def _cancel_wing_generations(wing_gens):
+    for wing_gen in wing_gens:
+        cancel_wing_generation(wing_gen)
+
+def _release_wing_regions(wing_regions):
+    for renderer, region in wing_regions.items():
+        renderer.release_wing(region)
+    wing_regions.clear()
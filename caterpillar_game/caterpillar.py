@@ -4,10 +4,7 @@ import math
 import random
 import sys
 
-import pyglet
-
-from .resources import get_image, TILE_WIDTH
-from .util import lerp
+import numpy
 
 DEBUG = 'megahit' in sys.argv
 
@@ -40,6 +37,7 @@ class Segment:
         self.is_fresh_end = False
         self.from_angle = get_dir_angle(self.from_direction)
         self.visible = True
+        self.on_water = False
         self.launched = False
         self.adjust_from_angle()
 
@@ -75,75 +73,79 @@ class Segment:
         while self.from_angle - 180 > to_angle:
             self.from_angle -= 360
 
-    def update_sprite(self, sprite, t, is_head, i, fate, ct):
-        if not self.visible:
-            return
-        if fate == 'crash' and is_head:
-            if self.launched:
-                t *= 1.5
-            else:
-                t *= 0.5
-            if ct:
-                cct = ct
-                if ct > 0.5:
-                    sprite.image = get_image('crushed')
-                    cct = 0.5
-                if self.launched:
-                    cct /= 4
-                sprite.scale_x = 1 + cct / 4
-                sprite.scale_y = 1 - cct / 2
-        if fate == 'drown' and is_head and ct > 1:
-            lt = t - (t/1.5)**3
-            sprite.x = lerp(self.from_x, self.x, lt) * TILE_WIDTH
-            sprite.y = lerp(self.from_y, self.y, lt) * TILE_WIDTH
-            sprite.scale = (1-t) * TILE_WIDTH / sprite.image.width
-        elif fate == 'unsail' and ct > 1:
-            ct -= 1
-            ct /= 4
-            lt = 1 - (1 - ct) ** 2
-            sprite.x = lerp(self.from_x, self.x, 1+lt/3) * TILE_WIDTH
-            sprite.y = lerp(self.from_y, self.y, 1+lt/3) * TILE_WIDTH
-            if self.direction[1]:
-                sprite.x += + math.sin(t*6) * ct * TILE_WIDTH / (i % 2 * 16 - 8)
-            else:
-                sprite.y += + math.sin(t*6) * ct * TILE_WIDTH / (i % 2 * 16 - 8)
-            if ct > 1:
-                sprite.scale = 0
-            else:
-                sprite.scale = (1-lt) * TILE_WIDTH / sprite.image.width
-        elif fate == 'fall' and is_head and ct > 1:
-            sprite.x = lerp(self.from_x, self.x, t/6) * TILE_WIDTH
-            sprite.y = lerp(self.from_y, self.y, t/6) * TILE_WIDTH
-            sprite.scale = (1-t) * TILE_WIDTH / sprite.image.width
-        elif self.is_fresh_end:
-            sprite.x = self.x * TILE_WIDTH
-            sprite.y = self.y * TILE_WIDTH
-            sprite.scale = (t/2+1/2) * TILE_WIDTH / sprite.image.width
-        else:
-            sprite.x = lerp(self.from_x, self.x, t) * TILE_WIDTH
-            sprite.y = lerp(self.from_y, self.y, t) * TILE_WIDTH
-            sprite.scale = TILE_WIDTH / sprite.image.width
-        if is_head:
-            wiggle = 2
-        else:
-            wiggle = i % 2 * 20 - 10
-        if fate == 'fall' and is_head:
-            wiggle *= 4 * (t+1)
-        sprite.rotation = lerp(
-            self.from_angle, get_dir_angle(self.direction), t
-        ) + math.sin(t * math.tau * 2) * wiggle
-        if ct:
-            if fate == 'cocooning':
-                if ct > 1:
-                    ct = 1
-                if not is_head:
-                    sprite.rotation += ct * 90
-                sprite.color = 0, lerp(255, 100, ct), 0
-        if self.launched:
-            if fate == 'crash':
-                t *= 1.2
-            amount = (1 - (1-2*t)**2)
-            sprite.y += amount * TILE_WIDTH * 2 / 3
+
+class Body:
+    """Segment data in NumPy arrays, tail first, for drawing all at once
+
+    Segments are added at the end and removed from the start. When the
+    end reaches the capacity, the data is moved back to the start of the
+    arrays, which are grown if they are more than half full.
+    """
+    COLUMNS = (
+        ('x', numpy.float32),
+        ('y', numpy.float32),
+        ('from_x', numpy.float32),
+        ('from_y', numpy.float32),
+        ('from_angle', numpy.float32),
+        ('to_angle', numpy.float32),
+        ('vertical', bool),
+        ('visible', bool),
+        ('launched', bool),
+        ('fresh_end', bool),
+    )
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.start = 0
+        self.end = 0
+        # Index of the segment at array position 0
+        self.offset = 0
+        self.columns = {
+            name: numpy.zeros(capacity, dtype)
+            for name, dtype in self.COLUMNS
+        }
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, name):
+        return self.columns[name][self.start:self.end]
+
+    def append(self, segment):
+        if self.end >= self.capacity:
+            self._make_room()
+        segment.body_index = self.offset + self.end
+        self.end += 1
+        self.update(segment)
+
+    def popleft(self):
+        self.start += 1
+
+    def update(self, segment):
+        i = segment.body_index - self.offset
+        columns = self.columns
+        columns['x'][i] = segment.x
+        columns['y'][i] = segment.y
+        columns['from_x'][i] = segment.from_x
+        columns['from_y'][i] = segment.from_y
+        columns['from_angle'][i] = segment.from_angle
+        columns['to_angle'][i] = get_dir_angle(segment.direction)
+        columns['vertical'][i] = bool(segment.direction[1])
+        columns['visible'][i] = segment.visible
+        columns['launched'][i] = segment.launched
+        columns['fresh_end'][i] = segment.is_fresh_end
+
+    def _make_room(self):
+        length = len(self)
+        if length * 2 > self.capacity:
+            self.capacity *= 2
+        for name, column in self.columns.items():
+            new_column = numpy.zeros(self.capacity, column.dtype)
+            new_column[:length] = column[self.start:self.end]
+            self.columns[name] = new_column
+        self.offset += self.start
+        self.start = 0
+        self.end = length
 
 
 class Caterpillar:
@@ -158,79 +160,25 @@ class Caterpillar:
         self.swimming = False
         self.egg = egg
         self.zt = 0
+        self.face = 'head'
         dx, dy = direction
         self.segments = collections.deque()
-        self.segments.append(Segment.make_initial(
+        self.body = Body()
+        # Visible segments by position, oldest first
+        self.occupied = {}
+        # Number of segments on water tiles
+        self.water_count = 0
+        self.append_segment(Segment.make_initial(
             (grid.width // 2 if x is None else x) + dx,
             (grid.height // 2 if y is None else y) + dy,
             self.direction,
         ))
-        self.body_image = get_image('body')
-        self.head_image = get_image('head')
         self.t = 0
         self.ct = 0
-        self.batch = pyglet.graphics.Batch()
-        sprite = pyglet.sprite.Sprite(
-            self.head_image,
-            batch=self.batch,
-        )
-        sprite.color = 0, 255, 0
-        sprite.scale = TILE_WIDTH / sprite.width
-        self.sprites = [sprite]
         self.collected_hues = []
         self.collected_items = set()
-        
-        self.collect('boulder')
 
-    def draw(self):
-        while len(self.sprites) < len(self.segments):
-            sprite = pyglet.sprite.Sprite(
-                self.body_image,
-                batch=self.batch,
-            )
-            sprite.scale = TILE_WIDTH / sprite.width
-            sprite.color = 0, 255, 0
-            self.sprites.append(sprite)
-        while len(self.sprites) > len(self.segments):
-            self.sprites.pop().delete()
-        t = self.t
-        for i, segment in enumerate(self.segments):
-            sprite = self.sprites[-1-i]
-            is_head = (i == len(self.segments) - 1)
-            segment.update_sprite(
-                sprite,
-                t=t, ct=self.ct,
-                is_head=is_head,
-                fate=self.fate,
-                i=i,
-            )
-            if segment.visible:
-                sprite.opacity = self.grid.caterpillar_opacity
-            else:
-                sprite.opacity = False
-            if is_head:
-                can_swim = 'mushroom-w' in self.collected_items
-                can_bash = 'mushroom-s' in self.collected_items
-                if can_swim and can_bash:
-                    sprite.color = 150, 200, 200
-                elif can_swim:
-                    sprite.color = 0, 255, 200
-                elif can_bash:
-                    sprite.color = 150, 200, 150
-                else:
-                    sprite.color = 100, 255, 0
-            else:
-                sprite.color = 100, 255, 0
-        self.batch.draw()
-        if DEBUG:
-            sprite = pyglet.sprite.Sprite(
-                get_image('solid'),
-                x=self.segments[-1].x * TILE_WIDTH,
-                y=self.segments[-1].y * TILE_WIDTH,
-            )
-            sprite.scale = len(self.segments)
-            sprite.opacity = 100
-            sprite.draw()
+        self.collect('boulder')
 
     def turn(self, direction):
         if self.fate:
@@ -245,7 +193,7 @@ class Caterpillar:
             self.paused = False
             self.moving = True
             self.pause_label = None
-            self.sprites[0].image = self.head_image
+            self.face = 'head'
         if not self.moving:
             return
         if not self.grid[head.xy].attempt_turn(self, direction):
@@ -253,6 +201,7 @@ class Caterpillar:
         if not turning_back or len(self.segments) == 1:
             self.direction = direction
             head.look(direction)
+            self.body.update(head)
 
     def tick(self, dt):
         if DEBUG:
@@ -295,8 +244,8 @@ class Caterpillar:
             x *= 2
             y *= 2
             phantom_segment = head.grow_head(direction)
-            self.segments.append(phantom_segment)
             phantom_segment.visible = False
+            self.append_segment(phantom_segment)
             direction = x, y
             launched = True
         new_head = head.grow_head(direction)
@@ -313,41 +262,37 @@ class Caterpillar:
         if self.swimming and not head_tile.is_water(self):
             self.swimming = False
         if not self.fate:
-            for segment in self.segments:
-                if segment.xy == new_head.xy and segment.visible:
-                    new_head.look(segment.direction)
-                    self.fate = 'cocooning'
-                    self.moving = False
+            segments_there = self.occupied.get(new_head.xy)
+            if segments_there:
+                new_head.look(segments_there[0].direction)
+                self.fate = 'cocooning'
+                self.moving = False
         if self.fate in ('drown', 'fall'):
             if self.ct < 1.5:
-                self.segments.append(new_head)
+                self.append_segment(new_head)
             else:
-                self.sprites[0].image = self.head_image = self.body_image
+                self.face = 'body'
             if len(self.segments) > 1:
-                self.segments.popleft()
+                self.popleft_segment()
             else:
-                self.segments[0].visible = False
+                self.hide_segment(self.segments[0])
         elif self.fate and self.fate != 'cocooning':
             pass
         else:
-            self.segments.append(new_head)
+            self.append_segment(new_head)
             if self.fate == 'cocooning':
                 should_grow = True
             else:
                 should_grow = head_tile.enter(self)
             if should_grow:
                 self.segments[0].is_fresh_end = True
+                self.body.update(self.segments[0])
             else:
-                self.segments.popleft()
+                self.popleft_segment()
                 if len(self.segments) > 1 and not self.segments[0].visible:
-                    self.segments.popleft()
+                    self.popleft_segment()
                 if self.swimming:
-                    on_dry_land = False
-                    for segment in self.segments:
-                        if not self.grid[segment.xy].is_water(self):
-                            on_dry_land = True
-                            break
-                    if not on_dry_land:
+                    if self.water_count == len(self.segments):
                         self.die('unsail', """
                             Sailing is over.
                             That bridge is too short.
@@ -361,6 +306,37 @@ class Caterpillar:
         if DEBUG and not self.swimming and not self.fate:
             self.pause('.')
 
+    def append_segment(self, segment):
+        self.segments.append(segment)
+        self.body.append(segment)
+        segment.on_water = self.grid[segment.xy].is_water(self)
+        if segment.on_water:
+            self.water_count += 1
+        if segment.visible:
+            self.occupied.setdefault(segment.xy, []).append(segment)
+
+    def popleft_segment(self):
+        segment = self.segments.popleft()
+        self.body.popleft()
+        if segment.on_water:
+            self.water_count -= 1
+        if segment.visible:
+            self._unoccupy(segment)
+        return segment
+
+    def hide_segment(self, segment):
+        if segment.visible:
+            self._unoccupy(segment)
+        segment.visible = False
+        self.body.update(segment)
+
+    def _unoccupy(self, segment):
+        # Only the tail segment leaves, and it's the oldest one on its tile
+        segments_there = self.occupied[segment.xy]
+        del segments_there[0]
+        if not segments_there:
+            del self.occupied[segment.xy]
+
     def make_butterfly(self):
         return self.egg.make_butterfly(self.collected_hues)
 
@@ -371,10 +347,10 @@ class Caterpillar:
         self.grid.signal_game_over(
             random.choice(messages.strip().splitlines()).strip()
         )
-        self.sprites[0].image = get_image('scared')
+        self.face = 'scared'
 
     def pause(self, label=None):
-        self.sprites[0].image = get_image('asleep')
+        self.face = 'asleep'
         self.paused = True
         self.pause_label = label
 
@@ -0,0 +1,224 @@
+import math
+
+import numpy
+import pyglet
+
+from .resources import get_image, TILE_WIDTH
+from .util import lerp, add_quads, sprite_quads
+from .caterpillar import get_dir_angle, DEBUG
+
+
+def update_segment_sprite(segment, sprite, t, is_head, i, fate, ct):
+    if not segment.visible:
+        return
+    if fate == 'crash' and is_head:
+        if segment.launched:
+            t *= 1.5
+        else:
+            t *= 0.5
+        if ct:
+            cct = ct
+            if ct > 0.5:
+                sprite.image = get_image('crushed')
+                cct = 0.5
+            if segment.launched:
+                cct /= 4
+            sprite.scale_x = 1 + cct / 4
+            sprite.scale_y = 1 - cct / 2
+    if fate == 'drown' and is_head and ct > 1:
+        lt = t - (t/1.5)**3
+        sprite.x = lerp(segment.from_x, segment.x, lt) * TILE_WIDTH
+        sprite.y = lerp(segment.from_y, segment.y, lt) * TILE_WIDTH
+        sprite.scale = (1-t) * TILE_WIDTH / sprite.image.width
+    elif fate == 'unsail' and ct > 1:
+        ct -= 1
+        ct /= 4
+        lt = 1 - (1 - ct) ** 2
+        sprite.x = lerp(segment.from_x, segment.x, 1+lt/3) * TILE_WIDTH
+        sprite.y = lerp(segment.from_y, segment.y, 1+lt/3) * TILE_WIDTH
+        if segment.direction[1]:
+            sprite.x += + math.sin(t*6) * ct * TILE_WIDTH / (i % 2 * 16 - 8)
+        else:
+            sprite.y += + math.sin(t*6) * ct * TILE_WIDTH / (i % 2 * 16 - 8)
+        if ct > 1:
+            sprite.scale = 0
+        else:
+            sprite.scale = (1-lt) * TILE_WIDTH / sprite.image.width
+    elif fate == 'fall' and is_head and ct > 1:
+        sprite.x = lerp(segment.from_x, segment.x, t/6) * TILE_WIDTH
+        sprite.y = lerp(segment.from_y, segment.y, t/6) * TILE_WIDTH
+        sprite.scale = (1-t) * TILE_WIDTH / sprite.image.width
+    elif segment.is_fresh_end:
+        sprite.x = segment.x * TILE_WIDTH
+        sprite.y = segment.y * TILE_WIDTH
+        sprite.scale = (t/2+1/2) * TILE_WIDTH / sprite.image.width
+    else:
+        sprite.x = lerp(segment.from_x, segment.x, t) * TILE_WIDTH
+        sprite.y = lerp(segment.from_y, segment.y, t) * TILE_WIDTH
+        sprite.scale = TILE_WIDTH / sprite.image.width
+    if is_head:
+        wiggle = 2
+    else:
+        wiggle = i % 2 * 20 - 10
+    if fate == 'fall' and is_head:
+        wiggle *= 4 * (t+1)
+    sprite.rotation = lerp(
+        segment.from_angle, get_dir_angle(segment.direction), t
+    ) + math.sin(t * math.tau * 2) * wiggle
+    if ct:
+        if fate == 'cocooning':
+            if ct > 1:
+                ct = 1
+            if not is_head:
+                sprite.rotation += ct * 90
+            sprite.color = 0, lerp(255, 100, ct), 0
+    if segment.launched:
+        if fate == 'crash':
+            t *= 1.2
+        amount = (1 - (1-2*t)**2)
+        sprite.y += amount * TILE_WIDTH * 2 / 3
+
+
+class CaterpillarView:
+    def __init__(self, grid_view, caterpillar):
+        self.grid_view = grid_view
+        self.caterpillar = caterpillar
+        self.face = caterpillar.face
+        self.batch = pyglet.graphics.Batch()
+        self.head_sprite = sprite = pyglet.sprite.Sprite(
+            get_image(self.face),
+            batch=self.batch,
+            # The head is drawn first, under the neck
+            group=pyglet.graphics.OrderedGroup(0),
+        )
+        sprite.color = 0, 255, 0
+        sprite.scale = TILE_WIDTH / sprite.width
+
+        # All of the body is drawn as one vertex list of quads
+        self.body_image = get_image('body')
+        self.body_vertex_list = None
+        self.body_capacity = 0
+
+    def draw(self):
+        caterpillar = self.caterpillar
+        segments = caterpillar.segments
+        if self.face != caterpillar.face:
+            self.face = caterpillar.face
+            self.head_sprite.image = get_image(self.face)
+        sprite = self.head_sprite
+        head = segments[-1]
+        update_segment_sprite(
+            head, sprite,
+            t=caterpillar.t, ct=caterpillar.ct,
+            is_head=True,
+            fate=caterpillar.fate,
+            i=len(segments) - 1,
+        )
+        if head.visible:
+            sprite.opacity = self.grid_view.caterpillar_opacity
+        else:
+            sprite.opacity = False
+        can_swim = 'mushroom-w' in caterpillar.collected_items
+        can_bash = 'mushroom-s' in caterpillar.collected_items
+        if can_swim and can_bash:
+            sprite.color = 150, 200, 200
+        elif can_swim:
+            sprite.color = 0, 255, 200
+        elif can_bash:
+            sprite.color = 150, 200, 150
+        else:
+            sprite.color = 100, 255, 0
+        self.update_body()
+        self.batch.draw()
+        if DEBUG:
+            sprite = pyglet.sprite.Sprite(
+                get_image('solid'),
+                x=segments[-1].x * TILE_WIDTH,
+                y=segments[-1].y * TILE_WIDTH,
+            )
+            sprite.scale = len(segments)
+            sprite.opacity = 100
+            sprite.draw()
+
+    def update_body(self):
+        """Compute all body segment quads at once
+
+        This does for the body what update_segment_sprite does for a
+        single segment (the head-only cases don't apply here).
+        """
+        caterpillar = self.caterpillar
+        body = caterpillar.body
+        n = len(body) - 1
+        if n > self.body_capacity:
+            self.body_capacity = max(n, self.body_capacity * 2, 16)
+            if self.body_vertex_list:
+                self.body_vertex_list.delete()
+            self.body_vertex_list = add_quads(
+                self.batch, self.body_image, self.body_capacity,
+                group=pyglet.graphics.OrderedGroup(1),
+            )
+        if not self.body_capacity:
+            return
+
+        # Segment data, tail first, without the head
+        x = body['x'][:n]
+        y = body['y'][:n]
+        from_x = body['from_x'][:n]
+        from_y = body['from_y'][:n]
+        visible = body['visible'][:n]
+        launched = body['launched'][:n]
+        fresh_end = body['fresh_end'][:n]
+        i = numpy.arange(n)
+
+        t = caterpillar.t
+        ct = caterpillar.ct
+        fate = caterpillar.fate
+        scale = numpy.full(n, TILE_WIDTH / self.body_image.width)
+        if fate == 'unsail' and ct > 1:
+            ct -= 1
+            ct /= 4
+            lt = 1 - (1 - ct) ** 2
+            pos_x = lerp(from_x, x, 1+lt/3) * TILE_WIDTH
+            pos_y = lerp(from_y, y, 1+lt/3) * TILE_WIDTH
+            offset = math.sin(t*6) * ct * TILE_WIDTH / (i % 2 * 16 - 8)
+            vertical = body['vertical'][:n]
+            pos_x += numpy.where(vertical, offset, 0)
+            pos_y += numpy.where(vertical, 0, offset)
+            if ct > 1:
+                scale[:] = 0
+            else:
+                scale *= 1 - lt
+        else:
+            pos_x = numpy.where(fresh_end, x, lerp(from_x, x, t)) * TILE_WIDTH
+            pos_y = numpy.where(fresh_end, y, lerp(from_y, y, t)) * TILE_WIDTH
+            scale[fresh_end] *= t/2+1/2
+
+        wiggle = i % 2 * 20 - 10
+        rotation = (
+            lerp(body['from_angle'][:n], body['to_angle'][:n], t)
+            + math.sin(t * math.tau * 2) * wiggle
+        )
+        if ct and fate == 'cocooning':
+            rotation += min(ct, 1) * 90
+        if fate == 'crash':
+            lt = t * 1.2
+        else:
+            lt = t
+        pos_y = pos_y + launched * ((1 - (1-2*lt)**2) * TILE_WIDTH * 2 / 3)
+
+        # Neck first, so segments nearer the tail are drawn on top;
+        # unused quads at the end have zero scale
+        capacity = self.body_capacity
+        def padded(values):
+            result = numpy.zeros(capacity)
+            result[:n] = values[::-1]
+            return result
+        colors = numpy.zeros((capacity, 4))
+        colors[:n] = 100, 255, 0, int(self.grid_view.caterpillar_opacity)
+        colors[:n, 3] *= visible[::-1]
+        scale = padded(scale)
+        sprite_quads(
+            self.body_vertex_list, self.body_image,
+            padded(pos_x), padded(pos_y), padded(rotation), scale, scale,
+            colors,
+        )
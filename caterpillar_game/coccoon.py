@@ -2,48 +2,43 @@ import random
 import math
 from heapq import heappush, heappop
 
-import pyglet
-from bresenham import bresenham
+import numpy
 
-from .resources import get_image, TILE_WIDTH
-from .util import lerp, flip, UP, DOWN, LEFT, RIGHT
-from .butterfly import ButterflySprite
+from .util import flip, UP, DOWN, LEFT, RIGHT
 
 WEAVE_SPEED = 50
 
+# Up to this many cells, lines of sight between all pairs of edge tiles
+# are checked up front
+SIGHT_MATRIX_CELLS = 200_000
+
+# Sets of directions are stored as bit masks in the cocoon arrays
+DIRECTION_BITS = {UP: 1, DOWN: 2, LEFT: 4, RIGHT: 8}
+UP_BIT, DOWN_BIT, LEFT_BIT, RIGHT_BIT = DIRECTION_BITS.values()
+
+def direction_bits(directions):
+    result = 0
+    for direction in directions:
+        result |= DIRECTION_BITS[direction]
+    return result
+
+# Time after white_t when the butterfly has flown to its corner
+HATCH_T = 8
 
-COCCOON_TILES = {
-    frozenset({RIGHT, DOWN}): ('coccoon_2', 0),
-    frozenset({DOWN, LEFT}): ('coccoon_2', 90),
-    frozenset({LEFT, UP}): ('coccoon_2', 180),
-    frozenset({UP, RIGHT}): ('coccoon_2', 270),
-    frozenset({RIGHT, DOWN, LEFT}): ('coccoon_3', 0),
-    frozenset({DOWN, LEFT, UP}): ('coccoon_3', 90),
-    frozenset({LEFT, UP, RIGHT}): ('coccoon_3', 180),
-    frozenset({UP, RIGHT, DOWN}): ('coccoon_3', 270),
-    frozenset({LEFT, UP, RIGHT, DOWN}): ('solid', 0),
-}
 
 class Cocoon:
     def __init__(self, grid, caterpillar):
         self.grid = grid
         self.caterpillar = caterpillar
         self.butterfly = caterpillar.make_butterfly()
-        self.butterfly_sprite = ButterflySprite(self.butterfly, scale=0)
         self.edge_tiles = set()
         self.lines = []
         self.t = 0
         self.last_score_t = 0
 
-        self.batch = pyglet.graphics.Batch()
-        self.line_batch = pyglet.graphics.Batch()
-        self.sprites = []
         self.pending_scores = []
 
-        self.sprite_color = 0, 100, 0
-        self.web_opacity = 255
-
-        self.cocoon_tiles = cocoon_tiles = {}
+        loop_tiles = {}
         head = caterpillar.segments[-1]
         xs = set()
         ys = set()
@@ -55,9 +50,9 @@ class Cocoon:
                     self.edge_tiles.add(xy)
                     xs.add(x)
                     ys.add(y)
-                    cocoon_tiles[x, y] = {
+                    loop_tiles[x, y] = direction_bits({
                         segment.direction, flip(segment.from_direction)
-                    }
+                    })
                 if xy == head.xy:
                     cocooning = True
             if ys:
@@ -70,57 +65,43 @@ class Cocoon:
             self.xmean = self.ymean = 0
             self.update_t()
 
-        for y in range(min(ys), max(ys)+1):
-            filling = set()
-            for x in range(min(xs), max(xs)+1):
-                d = cocoon_tiles.get((x, y))
-                prev_filling = filling
-                if d:
-                    filling = filling ^ (d & {UP, DOWN})
-                    d |= filling
-                elif filling:
-                    d = cocoon_tiles[x, y] = {UP, DOWN}
-                if d:
-                    if prev_filling:
-                        d.add(LEFT)
-                    if filling:
-                        d.add(RIGHT)
+        # Directions of the cocoon tiles, in a box around the loop
+        # starting at `origin`; 0 for tiles outside the cocoon.
+        self.origin = x0, y0 = min(xs), min(ys)
+        self.directions = directions = numpy.zeros(
+            (max(xs) - x0 + 1, max(ys) - y0 + 1), dtype=numpy.uint8,
+        )
+        for (x, y), bits in loop_tiles.items():
+            directions[x - x0, y - y0] = bits
+        self.edge = directions != 0
+
+        # Going right along each row, we're inside the loop after crossing
+        # its vertical parts an odd number of times. Upward and downward
+        # parts are tracked separately, so tiles where the loop just turns
+        # are marked as half-filled
+        filling = numpy.bitwise_xor.accumulate(
+            directions & (UP_BIT | DOWN_BIT), axis=0,
+        )
+        prev_filling = numpy.zeros_like(filling)
+        prev_filling[1:] = filling[:-1]
+        directions[self.edge] |= filling[self.edge]
+        directions[~self.edge & (filling != 0)] = UP_BIT | DOWN_BIT
+        self.inside = directions != 0
+        directions[self.inside & (prev_filling != 0)] |= LEFT_BIT
+        directions[self.inside & (filling != 0)] |= RIGHT_BIT
 
         self.xmean = sum(xs) / len(xs)
         self.ymean = sum(ys) / len(ys)
-        for (x, y), dirs in cocoon_tiles.items():
-            tile_name, tile_rotation = COCCOON_TILES.get(
-                frozenset(dirs), ('solid', 0)
-            )
-            sprite = pyglet.sprite.Sprite(
-                get_image(tile_name),
-                x=x * TILE_WIDTH,
-                y=y * TILE_WIDTH,
-                batch=self.batch,
-            )
-            sprite.scale = TILE_WIDTH / sprite.width
-            sprite.color = self.sprite_color
-            sprite.rotation = tile_rotation
-            sprite.opacity = 100
-            sprite._caterpillar_rotation = random.gauss(0, 2) * 180
-            sprite._caterpillar_orig_x = sprite.x
-            sprite._caterpillar_orig_y = sprite.y
-            for i in range(20):
-                sx = random.gauss(x-self.xmean, 1) * 300
-                sy = random.gauss(y-self.ymean, 1) * 300
-                sprite._caterpillar_speed_x = sx
-                sprite._caterpillar_speed_y = sy
-                if sx + sy > 300:
-                    break
-            self.sprites.append(sprite)
-
-            score = 4
-            if (x, y) in self.edge_tiles:
-                score += 10
-            self.pending_scores.append((score, x, y))
+        inside_xs, inside_ys = numpy.nonzero(self.inside)
+        scores = 4 + 10 * self.edge[inside_xs, inside_ys]
+        self.pending_scores.extend(zip(
+            scores.tolist(),
+            (inside_xs + x0).tolist(),
+            (inside_ys + y0).tolist(),
+        ))
 
         for segment in caterpillar.segments:
-            if segment.xy not in cocoon_tiles:
+            if not self.contains(*segment.xy):
                 self.pending_scores.append((-10, segment.x, segment.y))
 
         self.green_t, self.white_t, self.end_t = self.add_lines()
@@ -133,6 +114,16 @@ class Cocoon:
 
     def add_lines(self):
         edges = list(self.edge_tiles)
+        edge_array = numpy.array(edges)
+        extent = max(self.inside.shape)
+        if len(edges) ** 2 * extent <= SIGHT_MATRIX_CELLS:
+            edge_indices = {xy: i for i, xy in enumerate(edges)}
+            sight_matrix = self.line_of_sight(
+                numpy.repeat(edge_array, len(edges), axis=0),
+                numpy.tile(edge_array, (len(edges), 1)),
+            ).reshape(len(edges), len(edges))
+        else:
+            sight_matrix = None
         heads = [(0.5 * WEAVE_SPEED, self.caterpillar.segments[-1].xy, (0, 0))]
         new_head_counter = 5
         covered = set()
@@ -141,16 +132,28 @@ class Cocoon:
                 break
             best_coords = None
             pos, start, fuzz = heappop(heads)
-            for i in range(20):
-                sx, sy = start
-                candidate_coords = cx, cy = random.choice(edges)
+            sx, sy = start
+            candidates = [random.choice(edges) for i in range(20)]
+            if sight_matrix is not None:
+                in_sight = sight_matrix[
+                    edge_indices[start],
+                    [edge_indices[c] for c in candidates],
+                ]
+            else:
+                candidate_array = numpy.array(candidates)
+                in_sight = self.line_of_sight(
+                    numpy.broadcast_to(start, candidate_array.shape),
+                    candidate_array,
+                )
+            for candidate_coords, visible in zip(candidates, in_sight):
+                cx, cy = candidate_coords
                 sq_distance = abs(sx - cx) ** 2 + abs(sy - cy) ** 2
                 if (
                     (best_coords is None or sq_distance > best_sq_distance)
                     and sq_distance
                     and start != candidate_coords
                     and (start, candidate_coords) not in covered
-                    and self.bresenham_check(start, candidate_coords)
+                    and visible
                 ):
                     best_sq_distance = sq_distance
                     best_coords = candidate_coords
@@ -164,12 +167,10 @@ class Cocoon:
                 new_fuzz = random.uniform(-.5, .5), random.uniform(-.5, .5)
                 nfx, nfy = new_fuzz
                 self.lines.append(CocoonLine(
-                    self,
                     (sx + fx, sy + fy),
                     (bx + nfx, by + nfy),
                     start_t=pos,
                     duration=duration,
-                    batch=self.line_batch,
                     length=distance,
                 ))
                 new_head_counter -= 1
@@ -185,65 +186,50 @@ class Cocoon:
         end = pos / WEAVE_SPEED
         return end + 1, end + 1.5, end + 5
 
-    def bresenham_check(self, start, end):
-        for x, y in bresenham(*start, *end):
-            if (x, y) not in self.cocoon_tiles:
-                return False
-        return True
+    def contains(self, x, y):
+        x0, y0 = self.origin
+        width, height = self.inside.shape
+        if 0 <= x - x0 < width and 0 <= y - y0 < height:
+            return bool(self.inside[x - x0, y - y0])
+        return False
+
+    def iter_tiles(self):
+        """Iterate over ((x, y), directions) of tiles inside the cocoon
 
-    def draw(self):
-        self.update_sprites()
-        self.batch.draw()
-        for line in self.lines:
-            line.update_sprite(self.t)
-        self.line_batch.draw()
-        if self.butterfly_sprite.scale:
-            self.butterfly_sprite.draw()
+        Directions are bit masks; see DIRECTION_BITS.
+        """
+        x0, y0 = self.origin
+        xs, ys = numpy.nonzero(self.inside)
+        for x, y, bits in zip(
+            (xs + x0).tolist(), (ys + y0).tolist(),
+            self.directions[xs, ys].tolist(),
+        ):
+            yield (x, y), bits
 
-    def update_sprites(self):
-        t = self.t
-        if t < self.green_t:
-            t /= self.green_t
-            op = int(255 * t)
-            for sprite in self.sprites:
-                sprite.opacity = op
-            return
-        for sprite in self.sprites:
-            sprite.opacity = 255
-        if t < self.white_t:
-            if self.pending_scores:
-                self.white_t += 1/2
-                self.end_t += 1/2
-                self.green_t += 1/2
-                self.update_t()
-                return
-            t -= self.green_t
-            t /= (self.white_t - self.green_t)
-            a = int(lerp(0, 255, t))
-            b = int(lerp(100, 255, t))
-            self.sprite_color = sprite_color = a, b, a
-            for sprite in self.sprites:
-                sprite.color = sprite_color
-            self.web_opacity = lerp(255, 0, t)
-            self.grid.caterpillar_opacity = lerp(255, 0, t)
-            return
-        self.sprite_color = sprite_color = 255, 255, 255
-        self.web_opacity = 0
-        self.grid.caterpillar_opacity = 0
-        for sprite in self.sprites:
-            sprite.color = sprite_color
-        self.anim_butterfly(t)
-        if t < self.end_t:
-            t -= self.white_t
-            t /= (self.end_t - self.white_t)
-            for sprite in self.sprites:
-                sprite.x = sprite._caterpillar_orig_x + t * sprite._caterpillar_speed_x
-                sprite.y = sprite._caterpillar_orig_y + t * sprite._caterpillar_speed_y
-                sprite.rotation = t * sprite._caterpillar_rotation
-                sprite.opacity = lerp(255, 0, t**5)
-            return
-        for sprite in self.sprites:
-            sprite.opacity = 0
+    def line_of_sight(self, starts, ends):
+        """Check lines between pairs of tiles, given as two (n, 2) arrays
+
+        Both ends of each line must be in the cocoon's bounding box.
+        Return a boolean array telling which lines stay in the cocoon.
+        Lines are rasterized with Bresenham's algorithm (as in the
+        `bresenham` package), all at once.
+        """
+        starts = starts - self.origin
+        delta = ends - self.origin - starts
+        sign = numpy.where(delta > 0, 1, -1)
+        delta = numpy.abs(delta)
+        x_major = delta[:, 0:1] > delta[:, 1:2]
+        major = delta.max(axis=1)[:, None]
+        minor = delta.min(axis=1)[:, None]
+
+        # Step k along the major axis moves this far along the minor one.
+        # Shorter lines repeat their last tile.
+        k = numpy.minimum(numpy.arange(major.max(initial=0) + 1), major)
+        denominator = 2 * numpy.maximum(major, 1)
+        offset = (2 * k * minor + denominator // 2) // denominator
+        xs = starts[:, 0:1] + numpy.where(x_major, k, offset) * sign[:, 0:1]
+        ys = starts[:, 1:2] + numpy.where(x_major, offset, k) * sign[:, 1:2]
+        return self.inside[xs, ys].all(axis=1)
 
     def tick(self, dt):
         self.t += dt
@@ -252,84 +238,27 @@ class Cocoon:
             while self.last_score_t > 0.05 and self.pending_scores:
                 self.last_score_t -= 0.05
                 amount, x, y = self.pending_scores.pop()
-                item, bonus = self.grid[x, y].coccoon_info()
+                tile = self.grid[x, y]
+                item, bonus = tile.coccoon_info()
+                if item:
+                    self.grid.observer.tile_cocooned(tile, x, y)
                 self.grid.score(amount+bonus, x, y)
                 if item:
                     self.caterpillar.collect(item)
+        if self.green_t <= self.t < self.white_t and self.pending_scores:
+            # Don't turn white until everything inside is scored
+            self.white_t += 1/2
+            self.end_t += 1/2
+            self.green_t += 1/2
+            self.update_t()
+        if self.t >= self.white_t + HATCH_T:
+            self.grid.signal_done()
 
-    def anim_butterfly(self, t):
-        t -= self.white_t
-        self.butterfly_sprite.wing_t = t
-        if t < 2:
-            t /= 2
-            self.butterfly_sprite.scale = t
-            self.butterfly_sprite.x = lerp(self.xmean, self.grid.width/2-1/2, t) * TILE_WIDTH
-            self.butterfly_sprite.y = lerp(self.ymean, self.grid.height/2+1, t) * TILE_WIDTH
-            return
-        self.butterfly_sprite.x = (self.grid.width/2-1/2) * TILE_WIDTH
-        self.butterfly_sprite.y = (self.grid.height/2+1) * TILE_WIDTH
-        self.butterfly_sprite.scale = 1
-        t -= 4
-        if t < 0:
-            return
-        if t < 2:
-            t /= 2
-            self.butterfly_sprite.scale = lerp(1, 0.0625, t)
-            self.butterfly_sprite.x = lerp(self.grid.width/2-1/2, 2.55, t) * TILE_WIDTH
-            self.butterfly_sprite.y = lerp(self.grid.height/2+1, 16, t) * TILE_WIDTH
-            return
-        t -= 4
-        self.butterfly_sprite.scale = 0.0625
-        self.butterfly_sprite.x = 2.55 * TILE_WIDTH
-        self.butterfly_sprite.y = 16 * TILE_WIDTH
-        if t < 0:
-            return
-        self.butterfly_sprite.wing_t = 0
-        self.grid.signal_done()
 
 class CocoonLine:
-    def __init__(self, cocoon, start, end, start_t, duration, batch, length):
-        self.cocoon = cocoon
+    def __init__(self, start, end, start_t, duration, length):
         self.sx, self.sy = start
         self.ex, self.ey = end
         self.start_t = start_t
         self.duration = duration + 0.1
         self.length = length
-        self.sprite = sprite = pyglet.sprite.Sprite(
-            get_image('line', 0.5, 0),
-            x=self.sx * TILE_WIDTH,
-            y=self.sy * TILE_WIDTH,
-            batch=batch,
-        )
-        sprite.rotation = 90 - math.degrees(math.atan2(
-            self.ey - self.sy, self.ex - self.sx
-        ))
-        sprite.scale_x = TILE_WIDTH / 5 / sprite.image.width
-        sprite.scale_y = 0
-        sprite.color = 255, 255, 255
-        self.max_sprite_scale = length * TILE_WIDTH / sprite.image.width
-
-    def update_sprite(self, t):
-        t *= WEAVE_SPEED
-        t -= self.start_t
-        if t < 0:
-            return
-        t /= self.duration
-        if t > 1:
-            self.sprite.scale_y = self.max_sprite_scale
-        else:
-            self.sprite.scale_y = t * self.max_sprite_scale
-
-        t -= 1
-        if t < 0:
-            self.sprite.color = 255, 255, 255
-        elif t > 1:
-            self.sprite.color = self.cocoon.sprite_color
-        else:
-            cr, cg, cb = self.cocoon.sprite_color
-            lr = lerp(255, cr, t)
-            lg = lerp(255, cg, t)
-            lb = lerp(255, cb, t)
-            self.sprite.color = lr, lg, lb
-
-        self.sprite.opacity = self.cocoon.web_opacity
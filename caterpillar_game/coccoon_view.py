@@ -0,0 +1,208 @@
+import random
+
+import numpy
+import pyglet
+
+from .resources import get_image, TILE_WIDTH
+from .util import lerp, add_quads, sprite_quads, quad_colors
+from .util import UP, DOWN, LEFT, RIGHT
+from .butterfly import ButterflySprite
+from .coccoon import WEAVE_SPEED, direction_bits
+
+
+COCCOON_TILES = {
+    frozenset({RIGHT, DOWN}): ('coccoon_2', 0),
+    frozenset({DOWN, LEFT}): ('coccoon_2', 90),
+    frozenset({LEFT, UP}): ('coccoon_2', 180),
+    frozenset({UP, RIGHT}): ('coccoon_2', 270),
+    frozenset({RIGHT, DOWN, LEFT}): ('coccoon_3', 0),
+    frozenset({DOWN, LEFT, UP}): ('coccoon_3', 90),
+    frozenset({LEFT, UP, RIGHT}): ('coccoon_3', 180),
+    frozenset({UP, RIGHT, DOWN}): ('coccoon_3', 270),
+    frozenset({LEFT, UP, RIGHT, DOWN}): ('solid', 0),
+}
+COCCOON_TILES_BY_BITS = {
+    direction_bits(directions): tile
+    for directions, tile in COCCOON_TILES.items()
+}
+
+class CocoonView:
+    """Draws a cocoon: its tiles and web lines are each drawn from vertex
+    lists (one per texture), computed in bulk while animating
+
+    Tile positions are only written when the animation phase changes,
+    and each frame while the tiles fly apart; line positions only while
+    the web is being woven. Otherwise just the fading colors change.
+    """
+    def __init__(self, grid_view, cocoon):
+        self.grid_view = grid_view
+        self.grid = grid_view.grid
+        self.cocoon = cocoon
+        self.butterfly_sprite = ButterflySprite(cocoon.butterfly, scale=0)
+
+        self.batch = pyglet.graphics.Batch()
+        self.line_batch = pyglet.graphics.Batch()
+
+        self.sprite_color = 0, 100, 0
+        self.web_opacity = 255
+        self.settled = False
+        # Animation phase the tile positions were last written for
+        self.tile_phase = None
+        self.lines_woven = False
+
+        xmean = cocoon.xmean
+        ymean = cocoon.ymean
+        tile_names = []
+        tiles = []
+        for (x, y), bits in cocoon.iter_tiles():
+            tile_name, tile_rotation = COCCOON_TILES_BY_BITS.get(
+                bits, ('solid', 0)
+            )
+            spin = random.gauss(0, 2) * 180
+            for i in range(20):
+                sx = random.gauss(x-xmean, 1) * 300
+                sy = random.gauss(y-ymean, 1) * 300
+                if sx + sy > 300:
+                    break
+            tile_names.append(tile_name)
+            tiles.append((
+                x * TILE_WIDTH, y * TILE_WIDTH, tile_rotation, spin, sx, sy,
+            ))
+        (
+            self.tile_x, self.tile_y, self.tile_rotation, self.tile_spin,
+            self.tile_speed_x, self.tile_speed_y,
+        ) = numpy.array(tiles, dtype=float).reshape(-1, 6).T
+        tile_names = numpy.array(tile_names)
+        self.tile_lists = []
+        for name in sorted(set(tile_names)):
+            indices = numpy.flatnonzero(tile_names == name)
+            image = get_image(name)
+            vertex_list = add_quads(self.batch, image, len(indices))
+            self.tile_lists.append((indices, image, vertex_list))
+
+        lines = cocoon.lines
+        self.line_image = get_image('line', 0.5, 0)
+        self.line_x = numpy.array([line.sx for line in lines]) * TILE_WIDTH
+        self.line_y = numpy.array([line.sy for line in lines]) * TILE_WIDTH
+        self.line_rotation = 90 - numpy.degrees(numpy.arctan2(
+            [line.ey - line.sy for line in lines],
+            [line.ex - line.sx for line in lines],
+        ))
+        self.line_start_t = numpy.array([line.start_t for line in lines])
+        self.line_duration = numpy.array([line.duration for line in lines])
+        self.line_max_scale = (
+            numpy.array([line.length for line in lines])
+            * TILE_WIDTH / self.line_image.width
+        )
+        self.line_list = add_quads(
+            self.line_batch, self.line_image, len(lines),
+        )
+
+    def draw(self):
+        if not self.settled:
+            self.update_tiles()
+            self.update_lines()
+        if self.cocoon.t >= self.cocoon.white_t:
+            self.anim_butterfly(self.cocoon.t)
+        self.batch.draw()
+        self.line_batch.draw()
+        if self.butterfly_sprite.scale:
+            self.butterfly_sprite.draw()
+
+    def update_tiles(self):
+        cocoon = self.cocoon
+        t = cocoon.t
+        x = self.tile_x
+        y = self.tile_y
+        rotation = self.tile_rotation
+        if t < cocoon.green_t:
+            phase = 'weaving'
+            t /= cocoon.green_t
+            opacity = int(255 * t)
+        elif t < cocoon.white_t:
+            phase = 'whitening'
+            opacity = 255
+            t -= cocoon.green_t
+            t /= (cocoon.white_t - cocoon.green_t)
+            a = int(lerp(0, 255, t))
+            b = int(lerp(100, 255, t))
+            self.sprite_color = a, b, a
+            self.web_opacity = lerp(255, 0, t)
+            self.grid_view.caterpillar_opacity = lerp(255, 0, t)
+        else:
+            self.sprite_color = 255, 255, 255
+            self.web_opacity = 0
+            self.grid_view.caterpillar_opacity = 0
+            if t < cocoon.end_t:
+                phase = 'bursting'
+                t -= cocoon.white_t
+                t /= (cocoon.end_t - cocoon.white_t)
+                x = x + t * self.tile_speed_x
+                y = y + t * self.tile_speed_y
+                rotation = t * self.tile_spin
+                opacity = int(lerp(255, 0, t**5))
+            else:
+                # Everything has faded out; nothing changes from now on
+                phase = 'settled'
+                opacity = 0
+                self.settled = True
+        move = phase != self.tile_phase or phase == 'bursting'
+        self.tile_phase = phase
+        for indices, image, vertex_list in self.tile_lists:
+            if move:
+                scale = TILE_WIDTH / image.width
+                sprite_quads(
+                    vertex_list, image,
+                    x[indices], y[indices],
+                    numpy.broadcast_to(rotation, x.shape)[indices],
+                    scale, scale,
+                )
+            quad_colors(vertex_list, (*self.sprite_color, opacity))
+
+    def update_lines(self):
+        t = self.cocoon.t * WEAVE_SPEED - self.line_start_t
+        t /= self.line_duration
+        if not self.lines_woven:
+            scale_y = numpy.where(t < 0, 0, numpy.minimum(t, 1))
+            scale_y *= self.line_max_scale
+            sprite_quads(
+                self.line_list, self.line_image,
+                self.line_x, self.line_y, self.line_rotation,
+                TILE_WIDTH / 5 / self.line_image.width, scale_y,
+            )
+            self.lines_woven = bool(numpy.all(t >= 1))
+        # Lines turn from white to the cocoon color after they're woven
+        fade = numpy.clip(t - 1, 0, 1)[:, None]
+        colors = numpy.empty((len(t), 4))
+        colors[:, :3] = lerp(255, numpy.array(self.sprite_color), fade)
+        colors[:, 3] = int(self.web_opacity)
+        quad_colors(self.line_list, colors)
+
+    def anim_butterfly(self, t):
+        t -= self.cocoon.white_t
+        self.butterfly_sprite.wing_t = t
+        if t < 2:
+            t /= 2
+            self.butterfly_sprite.scale = t
+            self.butterfly_sprite.x = lerp(self.cocoon.xmean, self.grid.width/2-1/2, t) * TILE_WIDTH
+            self.butterfly_sprite.y = lerp(self.cocoon.ymean, self.grid.height/2+1, t) * TILE_WIDTH
+            return
+        self.butterfly_sprite.x = (self.grid.width/2-1/2) * TILE_WIDTH
+        self.butterfly_sprite.y = (self.grid.height/2+1) * TILE_WIDTH
+        self.butterfly_sprite.scale = 1
+        t -= 4
+        if t < 0:
+            return
+        if t < 2:
+            t /= 2
+            self.butterfly_sprite.scale = lerp(1, 0.0625, t)
+            self.butterfly_sprite.x = lerp(self.grid.width/2-1/2, 2.55, t) * TILE_WIDTH
+            self.butterfly_sprite.y = lerp(self.grid.height/2+1, 16, t) * TILE_WIDTH
+            return
+        t -= 4
+        self.butterfly_sprite.scale = 0.0625
+        self.butterfly_sprite.x = 2.55 * TILE_WIDTH
+        self.butterfly_sprite.y = 16 * TILE_WIDTH
+        if t < 0:
+            return
+        self.butterfly_sprite.wing_t = 0
@@ -3,6 +3,8 @@ import statistics
 import random
 from itertools import zip_longest
 
+import numpy
+
 from .butterfly import Butterfly
 from .util import encode_hue, decode_hue
 from .wing import WING_PATCH_COUNT
@@ -12,13 +14,24 @@ class Egg:
     def __init__(self, parents=()):
         self.parents = parents
 
-    def to_dict(self):
+    def to_dict(self, pedigree=None):
+        """Return the parents as a list of dicts
+
+        If a pedigree.Pedigree is given, the parents are added to it and
+        the list holds their entry numbers instead.
+        """
+        if pedigree is not None:
+            return [pedigree.add(p) for p in self.parents]
         return [p.to_dict() for p in self.parents]
 
     @classmethod
-    def from_dict(cls, data):
+    def from_dict(cls, data, butterflies=None):
+        """Load an egg; `butterflies` are the loaded pedigree, if any"""
         self = cls()
-        self.parents = [Butterfly.from_dict(d) for d in data]
+        if butterflies is not None:
+            self.parents = [butterflies[number] for number in data]
+        else:
+            self.parents = [Butterfly.from_dict(d) for d in data]
         return self
 
     def make_butterfly(self, hues):
@@ -64,4 +77,115 @@ class Egg:
             offspring_hues = ''.join(offspring_hues)
 
         assert len(offspring_hues) == WING_PATCH_COUNT
-        return Butterfly(offspring_hues)
+        return Butterfly(offspring_hues, parents=self.parents)
+
+
+BLANK_CODE = ord(' ')
+
+def get_hue_codes(hue_strings, length):
+    """Convert hue strings to a uint8 array of codes, padded with blanks"""
+    codes = numpy.full((len(hue_strings), length), BLANK_CODE, dtype='uint8')
+    for row, hues in zip(codes, hue_strings):
+        encoded = numpy.frombuffer(hues.encode('ascii'), dtype='uint8')
+        row[:len(encoded)] = encoded[:length]
+    return codes
+
+def get_hue_strings(codes):
+    """Convert an array of hue codes back to a list of strings"""
+    return [bytes(row).decode('ascii') for row in codes]
+
+def get_mean_hue_codes(collected_codes):
+    """Vectorized mean hue of collected hues, as in Egg.make_butterfly
+
+    `collected_codes` has a row of hue codes per egg, padded with blanks.
+    Rounding differs slightly from statistics.mean() and math.atan2(), so
+    a mean that falls right on the boundary between two hue codes may come
+    out one code off.
+    """
+    codes = numpy.asarray(collected_codes)
+    valid = codes != BLANK_CODE
+    # Out-of-range codes decode to -1 or 1, like decode_hue()
+    hues = numpy.where(
+        codes < 33, -1,
+        numpy.where(codes > 126, 1, (codes.astype('float64') - 33) / (126 - 33)),
+    )
+    angles = hues * math.tau
+    # The mean includes an extra zero, like the Python version
+    count = valid.sum(axis=-1) + 1
+    y = numpy.where(valid, numpy.sin(angles), 0).sum(axis=-1) / count
+    x = numpy.where(valid, numpy.cos(angles), 0).sum(axis=-1) / count
+    mean = numpy.arctan2(y, x) / math.tau
+    # encode_hue() turns negative hues into blanks
+    result = numpy.where(
+        mean < 0, BLANK_CODE,
+        numpy.minimum(mean * (126 - 33), 126 - 33).astype('int64') + 33,
+    )
+    result[(x == 0) & (y == 0)] = BLANK_CODE
+    return result.astype('uint8')
+
+def breed(parent_codes, collected_codes, parent_counts=None, rng=None):
+    """Make offspring hues for many eggs at once
+
+    `parent_codes` are hue codes with axes (egg, parent, patch), and
+    `collected_codes` are hue codes of the flowers collected for each
+    egg, padded with blanks; see get_hue_codes. If eggs have different
+    numbers of parents, give `parent_counts`; only that many leading
+    parents are used. `rng` is a numpy.random.Generator or a seed.
+    Return offspring hue codes with axes (egg, patch).
+
+    Inheritance works like Egg.make_butterfly, though the random numbers
+    are drawn differently.
+    """
+    rng = numpy.random.default_rng(rng)
+    parent_codes = numpy.asarray(parent_codes, dtype='uint8')
+    egg_count, parent_count, patch_count = parent_codes.shape
+    if parent_counts is None:
+        parent_counts = numpy.full(egg_count, parent_count)
+    parent_counts = numpy.asarray(parent_counts)
+    mean_hues = get_mean_hue_codes(collected_codes)[:, None]
+    shape = egg_count, patch_count
+
+    eggs = numpy.arange(egg_count)[:, None]
+    patches = numpy.arange(patch_count)
+    result = numpy.full(shape, BLANK_CODE, dtype='uint8')
+    undecided = numpy.ones(shape, dtype=bool)
+    # Up to three tries to inherit a non-blank hue from a random parent;
+    # a blank one is replaced by the mean hue half of the time
+    for i in range(3):
+        chosen_parents = rng.integers(
+            numpy.maximum(parent_counts, 1)[:, None], size=shape,
+        )
+        chosen = parent_codes[eggs, chosen_parents, patches]
+        blank = chosen == BLANK_CODE
+        to_mean = blank & (rng.integers(2, size=shape) == 1)
+        result = numpy.where(undecided & ~blank, chosen, result)
+        result = numpy.where(undecided & to_mean, mean_hues, result)
+        undecided &= blank & ~to_mean
+    mutated = rng.integers(patch_count * 2, size=shape) < 3
+    result = numpy.where(mutated, mean_hues, result)
+    result[parent_counts == 0] = mean_hues[parent_counts == 0]
+    return result.astype('uint8')
+
+def make_butterflies(eggs, collected_hues, rng=None):
+    """Hatch many eggs at once with breed()
+
+    `collected_hues` has a hue string for each egg. Return a list of
+    Butterflies, as Egg.make_butterfly would make for each egg.
+    """
+    parent_counts = [len(egg.parents) for egg in eggs]
+    parent_codes = numpy.full(
+        (len(eggs), max([1, *parent_counts]), WING_PATCH_COUNT), BLANK_CODE,
+        dtype='uint8',
+    )
+    for row, egg in zip(parent_codes, eggs):
+        row[:len(egg.parents)] = get_hue_codes(
+            [p.hues for p in egg.parents], WING_PATCH_COUNT,
+        )
+    collected_codes = get_hue_codes(
+        collected_hues, max([0, *map(len, collected_hues)]),
+    )
+    offspring = breed(parent_codes, collected_codes, parent_counts, rng)
+    return [
+        Butterfly(hues, parents=egg.parents)
+        for egg, hues in zip(eggs, get_hue_strings(offspring))
+    ]
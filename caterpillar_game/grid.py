@@ -1,76 +1,86 @@
-import array
 import random
-import math
 
-import pyglet
+import numpy
 
-from .resources import get_image, TILE_WIDTH, HALF_FONT_INFO
-from .util import pushed_matrix, UP, DOWN, LEFT, RIGHT
+from .util import UP, DOWN, LEFT, RIGHT, IndexedSet
 from .caterpillar import Caterpillar
 from .coccoon import Cocoon
-from .level import load_level_to_grid
+from .level import load_level_to_grid, LEVEL_WIDTH, LEVEL_HEIGHT, INDEX_NAMES
 from . import tiles
 
 SPEED = 2
 
 
+class GridObserver:
+    """Follows what happens on a Grid, e.g. to draw it
+
+    All hooks do nothing here, so a Grid without an observer runs headless.
+    """
+    def tile_added(self, tile, x, y):
+        pass
+
+    def tile_removed(self, tile, x, y):
+        pass
+
+    def flower_grown(self, tile, x, y):
+        pass
+
+    def tile_cocooned(self, tile, x, y):
+        pass
+
+    def caterpillar_added(self, caterpillar):
+        pass
+
+    def collected_changed(self, caterpillar):
+        pass
+
+    def cocoon_added(self, cocoon):
+        pass
+
+    def scored(self, amount, x, y):
+        pass
+
+    def label_added(self, label, x, y):
+        pass
+
+    def game_over(self, message):
+        pass
+
+    def level_done(self):
+        pass
+
+
 class Grid:
-    def __init__(self, state, egg=None, level=0, ui=None):
+    def __init__(self, state, egg=None, level=0):
         self.state = state
-        self.ui = ui
         self.egg = egg
-        self.width = 31
-        self.height = 17
-        self.tiles = {}
+        self.observer = GridObserver()
+        self.width = LEVEL_WIDTH
+        self.height = LEVEL_HEIGHT
+        # Tile codes (see tiles.kinds), and per-cell state kept beside them:
+        # the hue of a flower as a character code (0 = no flower)
+        self.codes = numpy.zeros((self.width, self.height), dtype=numpy.uint16)
+        self.flower_hues = numpy.zeros((self.width, self.height), dtype=numpy.uint8)
+        # Positions of some kinds of tiles (see Tile.index_name)
+        self.cells = {name: IndexedSet() for name in INDEX_NAMES}
+        for x in range(self.width):
+            for y in range(self.height):
+                self.cells['empty'].add((x, y))
         self.caterpillar = None
-        self.caterpillar_opacity = 255
-        self.sprites = {}
-        self.eol_tiles = []
-        self.batch = pyglet.graphics.Batch()
-        self.score_batch = pyglet.graphics.Batch()
-        self.displayed_score = 0
         self.t = 0
         self.gameover_t = None
+        self.gameover_message = None
         self.total_score = 0
-        self.score_labels = []
         self.cocoon = None
         self.done = False
-        self.background = pyglet.image.TileableTexture. create_for_image(
-            get_image('tile', 0, 0, 2, 2)
-        )
         self.level = int(level)
         self.autogrow_flowers = True
-        self.collected_sprites = {}
         if level == 0:
             self.add_caterpillar()
             self.init_level0()
         else:
             load_level_to_grid(level, self)
 
-        self.main_score_label = pyglet.text.Label(
-            f'',
-            **HALF_FONT_INFO.label_args(),
-            anchor_x='right',
-            anchor_y='baseline',
-            align='center',
-            batch=self.score_batch,
-            x=(self.width - .5) * TILE_WIDTH,
-            y=(self.height - .5) * TILE_WIDTH + HALF_FONT_INFO.baseline,
-        )
-        self.gameover_label = pyglet.text.Label(
-            f'',
-            **HALF_FONT_INFO.label_args(),
-            anchor_x='left',
-            anchor_y='baseline',
-            align='center',
-            batch=self.score_batch,
-            color=(255, 255, 255, 255),
-            x=-.5 * TILE_WIDTH,
-            y=(self.height - .5) * TILE_WIDTH + HALF_FONT_INFO.baseline,
-        )
-        if not self.level:
-            self.gameover_label.text = 'Crash to form a cocoon.'.upper()
-
         self.t = 1
         if self.caterpillar is None:
             self.add_caterpillar()
@@ -81,6 +91,7 @@ class Grid:
             self, self.egg or self.state.choose_egg(),
             x=x, y=y, direction=direction,
         )
+        self.observer.caterpillar_added(self.caterpillar)
 
     def init_level0(self):
         for x in range(self.width):
@@ -117,90 +128,40 @@ class Grid:
     def add_a_flower(self, grass_only=False):
         if not self.autogrow_flowers:
             return False
-        if grass_only == False:
-            if self.add_a_flower(grass_only=True):
-                return True
-        xs = list(range(self.width))
-        ys = list(range(self.width))
-        random.shuffle(xs)
-        random.shuffle(ys)
-        caterpillar_xys = set(s.xy for s in self.caterpillar.segments)
-        for x in xs:
-            for y in ys:
-                if (x, y) in caterpillar_xys:
-                    continue
-                tile = self.tiles.get((x, y))
-                if tile is None:
-                    if not grass_only:
-                        self[x, y] = 'flower'
-                        return True
-                elif tile.grow_flower():
-                    return True
-
-    def draw(self):
-        with pushed_matrix():
-            pyglet.gl.glTranslatef(TILE_WIDTH/2, TILE_WIDTH/2, 1)
-            pyglet.gl.glScalef(1/2, 1/2, 1)
-            self.background.blit_tiled(
-                0, 0, 0,
-                self.width * TILE_WIDTH * 2, self.height * TILE_WIDTH * 2,
-            )
-            pyglet.gl.glScalef(2, 2, 1)
-            pyglet.gl.glTranslatef(TILE_WIDTH/2, TILE_WIDTH/2, 0)
-            self.batch.draw()
-            self.caterpillar.draw()
-            if self.cocoon:
-                self.cocoon.draw()
-            self.score_batch.draw()
+        xy = self.random_cell('grass')
+        if xy:
+            return self[xy].grow_flower()
+        if grass_only:
+            return False
+        xy = self.random_cell('empty')
+        if xy:
+            self[xy] = 'flower'
+            return True
+        return False
+
+    def random_cell(self, index_name):
+        """Pick a random position from a cells index, avoiding the caterpillar
+
+        Return None if there's no such position.
+        """
+        cells = self.cells[index_name]
+        occupied = self.caterpillar.occupied
+        for i in range(10):
+            if not cells:
+                return None
+            xy = cells.choice()
+            if xy not in occupied:
+                return xy
+        candidates = [xy for xy in cells if xy not in occupied]
+        if candidates:
+            return random.choice(candidates)
+        return None
 
     def tick(self, dt):
         self.t += dt
         self.caterpillar.tick(dt * SPEED)
         if self.cocoon:
             self.cocoon.tick(dt)
-        self.eol_tiles = [tile for tile in self.eol_tiles if tile.tick(dt)]
-        for tile in self.tiles.values():
-            tile.tick(dt)
-        if self.score_labels:
-            new_score_labels = []
-            for label in self.score_labels:
-                t = self.t - label._caterpillar_start_t
-                label.x = (label._caterpillar_x) * TILE_WIDTH
-                label.y = (label._caterpillar_y + t + t**2*2) * TILE_WIDTH
-                label.color = (*label._caterpillar_color, int(abs(1 - t)**.5 * 255))
-                if t < 1:
-                    new_score_labels.append(label)
-                else:
-                    label.delete()
-            self.score_labels = new_score_labels
-        if self.displayed_score != self.total_score:
-            diff = (self.total_score - self.displayed_score)
-            if diff < 1:
-                self.displayed_score = self.total_score
-            else:
-                self.displayed_score += (self.total_score - self.displayed_score) * 0.1
-                if diff > 1000:
-                    self.displayed_score += 111
-                if diff > 100:
-                    self.displayed_score += 11
-                elif diff > 10:
-                    self.displayed_score += 1
-                elif diff > 0:
-                    self.displayed_score += 0.5
-                else:
-                    self.displayed_score -= 0.5
-            if self.displayed_score:
-                self.main_score_label.text = str(int(self.displayed_score))
-            else:
-                self.main_score_label.text = ''
-        if self.gameover_t is not None:
-            gt = (self.t - self.gameover_t)
-            n = 30
-            b = int(min(255-n, (255-n) * gt))
-            o = int(math.sin(gt * math.tau / 2) * n)
-            self.gameover_label.color = (
-                b-o, b-o, b-o, 255
-            )
 
     def handle_command(self, command):
         if command == 'up':
@@ -211,95 +172,78 @@ class Grid:
             self.caterpillar.turn(LEFT)
         elif command == 'right':
             self.caterpillar.turn(RIGHT)
-        elif command == 'end' and self.ui:
-            self.ui.activate()
-            return True
 
     def __getitem__(self, x_y):
+        """Get the tile at the given position
+
+        Tiles are made on demand from the code arrays, so changes to
+        a returned tile aren't stored unless it is put back on the grid.
+        """
         x, y = x_y
         if x < 0 or y < 0 or x >= self.width or y >= self.height:
             return tiles.edge
-        return self.tiles.get(x_y, tiles.empty)
+        code = self.codes[x, y]
+        if not code:
+            return tiles.empty
+        return tiles.from_code(code, self, x, y)
 
     def __setitem__(self, x_y, item):
-        eol_tile = self.tiles.pop(x_y, None)
-        if eol_tile:
-            self.eol_tiles.append(eol_tile)
-            eol_tile.delete()
         x, y = x_y
         if x < 0 or y < 0 or x >= self.width or y >= self.height:
             return
+        if self.codes[x, y]:
+            old_tile = self[x_y]
+            self.codes[x, y] = 0
+            self.flower_hues[x, y] = 0
+            index_name = old_tile.index_name()
+            if index_name:
+                self.cells[index_name].discard(x_y)
+            self.cells['empty'].add(x_y)
+            self.observer.tile_removed(old_tile, x, y)
         if item is not None:
             if isinstance(item, str):
                 item = tiles.new(item, self, x, y)
-            self.tiles[x_y] = item
+            self.codes[x, y] = tiles.get_code(type(item), item.props)
+            item.save()
+            self.cells['empty'].discard(x_y)
+            index_name = item.index_name()
+            if index_name:
+                self.cells[index_name].add(x_y)
+            self.observer.tile_added(item, x, y)
+
+    def iter_tiles(self):
+        """Iterate over ((x, y), tile) for all non-empty cells"""
+        for x, y in zip(*numpy.nonzero(self.codes)):
+            x, y = int(x), int(y)
+            yield (x, y), self[x, y]
 
     def add_cocoon(self, caterpillar):
         self.cocoon = Cocoon(self, caterpillar)
+        self.observer.cocoon_added(self.cocoon)
 
     def score(self, amount, x, y):
         self.total_score += amount
         if self.total_score <= 0:
             self.total_score = 0
-        self.main_score_label.text = str(self.total_score)
-        if not (0 < amount < 5):
-            label = self.add_label(f'{amount:+1}', x, y)
-            if amount > 0:
-                label._caterpillar_color = 250, 255, 200
-            else:
-                label._caterpillar_color = 255, 230, 200
+        self.observer.scored(amount, x, y)
 
     def add_label(self, label, x, y):
-        label = pyglet.text.Label(
-            label,
-            **HALF_FONT_INFO.label_args(),
-            anchor_x='center',
-            anchor_y='baseline',
-            align='center',
-            batch=self.score_batch,
-            x=x * TILE_WIDTH,
-            y=y * TILE_WIDTH,
-        )
-        self.score_labels.append(label)
-        label._caterpillar_start_t = self.t
-        label._caterpillar_x = x
-        label._caterpillar_y = y
-        label._caterpillar_color = 255, 255, 255
-        return label
+        self.observer.label_added(label, x, y)
 
     def signal_done(self):
         if self.done:
             return True
-        self.shot = pyglet.image.get_buffer_manager().get_color_buffer().get_texture()
+        self.done = True
         self.state.level_completed(
             self.level, self.total_score, self.caterpillar.collected_items,
             self.cocoon.butterfly,
         )
-        if self.ui:
-            self.ui.activate(self.shot)
+        self.observer.level_done()
 
     def signal_game_over(self, message):
-        self.gameover_label.text = f'{message}    Press esc to exit.'.upper()
+        self.gameover_message = message
         self.gameover_t = self.t
+        self.observer.game_over(message)
 
     def update_collected(self, caterpillar):
-        for item in caterpillar.collected_items.difference(self.collected_sprites):
-            for i in range(100):
-                for sprite in self.collected_sprites.values():
-                    if sprite._caterpillar_i == i:
-                        break
-                else:
-                    break
-            sprite = pyglet.sprite.Sprite(
-                get_image(item),
-                x=(self.width-1/4) * TILE_WIDTH,
-                y=(self.height - 3/4 - i/2) * TILE_WIDTH,
-                batch=self.score_batch,
-            )
-            sprite._caterpillar_i = i
-            sprite.scale = 1/4
-            self.collected_sprites[item] = sprite
-        for name, sprite in list(self.collected_sprites.items()):
-            if name not in caterpillar.collected_items:
-                sprite.delete()
-                del self.collected_sprites[name]
+        self.observer.collected_changed(caterpillar)
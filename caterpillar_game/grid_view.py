@@ -0,0 +1,221 @@
+import math
+
+import pyglet
+
+from .resources import get_image, TILE_WIDTH, HALF_FONT_INFO
+from .util import pushed_matrix
+from .grid import GridObserver
+from .caterpillar_view import CaterpillarView
+from .coccoon_view import CocoonView
+from . import tiles_view
+
+
+class GridView(GridObserver):
+    def __init__(self, grid, ui=None):
+        self.grid = grid
+        self.ui = ui
+        self.caterpillar_opacity = 255
+        self.tile_views = {}
+        # Views that are animating, in an insertion-ordered dict
+        self.active_tile_views = {}
+        self.batch = pyglet.graphics.Batch()
+        self.score_batch = pyglet.graphics.Batch()
+        self.displayed_score = 0
+        self.score_labels = []
+        self.collected_sprites = {}
+        self.caterpillar_view = None
+        self.cocoon_view = None
+        self.shot = None
+        self.background = pyglet.image.TileableTexture. create_for_image(
+            get_image('tile', 0, 0, 2, 2)
+        )
+
+        self.main_score_label = pyglet.text.Label(
+            '',
+            **HALF_FONT_INFO.label_args(),
+            anchor_x='right',
+            anchor_y='baseline',
+            align='center',
+            batch=self.score_batch,
+            x=(grid.width - .5) * TILE_WIDTH,
+            y=(grid.height - .5) * TILE_WIDTH + HALF_FONT_INFO.baseline,
+        )
+        self.gameover_label = pyglet.text.Label(
+            '',
+            **HALF_FONT_INFO.label_args(),
+            anchor_x='left',
+            anchor_y='baseline',
+            align='center',
+            batch=self.score_batch,
+            color=(255, 255, 255, 255),
+            x=-.5 * TILE_WIDTH,
+            y=(grid.height - .5) * TILE_WIDTH + HALF_FONT_INFO.baseline,
+        )
+        if not grid.level:
+            self.gameover_label.text = 'Crash to form a cocoon.'.upper()
+
+        # Catch up with whatever happened to the grid before we were attached
+        grid.observer = self
+        for (x, y), tile in grid.iter_tiles():
+            self.tile_views[x, y] = tiles_view.new(
+                self, tile, x, y, initial=True,
+            )
+        self.caterpillar_added(grid.caterpillar)
+        self.collected_changed(grid.caterpillar)
+        if grid.cocoon:
+            self.cocoon_added(grid.cocoon)
+        if grid.gameover_message:
+            self.game_over(grid.gameover_message)
+
+    def draw(self):
+        grid = self.grid
+        with pushed_matrix():
+            pyglet.gl.glTranslatef(TILE_WIDTH/2, TILE_WIDTH/2, 1)
+            pyglet.gl.glScalef(1/2, 1/2, 1)
+            self.background.blit_tiled(
+                0, 0, 0,
+                grid.width * TILE_WIDTH * 2, grid.height * TILE_WIDTH * 2,
+            )
+            pyglet.gl.glScalef(2, 2, 1)
+            pyglet.gl.glTranslatef(TILE_WIDTH/2, TILE_WIDTH/2, 0)
+            self.batch.draw()
+            self.caterpillar_view.draw()
+            if self.cocoon_view:
+                self.cocoon_view.draw()
+            self.score_batch.draw()
+        if grid.done and self.shot is None:
+            self.shot = pyglet.image.get_buffer_manager().get_color_buffer().get_texture()
+            if self.ui:
+                self.ui.activate(self.shot)
+
+    def tick(self, dt):
+        grid = self.grid
+        grid.tick(dt)
+        for view in list(self.active_tile_views):
+            if not view.tick(dt):
+                del self.active_tile_views[view]
+        if self.score_labels:
+            new_score_labels = []
+            for label in self.score_labels:
+                t = grid.t - label._caterpillar_start_t
+                label.x = (label._caterpillar_x) * TILE_WIDTH
+                label.y = (label._caterpillar_y + t + t**2*2) * TILE_WIDTH
+                label.color = (*label._caterpillar_color, int(abs(1 - t)**.5 * 255))
+                if t < 1:
+                    new_score_labels.append(label)
+                else:
+                    label.delete()
+            self.score_labels = new_score_labels
+        if self.displayed_score != grid.total_score:
+            diff = (grid.total_score - self.displayed_score)
+            if diff < 1:
+                self.displayed_score = grid.total_score
+            else:
+                self.displayed_score += (grid.total_score - self.displayed_score) * 0.1
+                if diff > 1000:
+                    self.displayed_score += 111
+                if diff > 100:
+                    self.displayed_score += 11
+                elif diff > 10:
+                    self.displayed_score += 1
+                elif diff > 0:
+                    self.displayed_score += 0.5
+                else:
+                    self.displayed_score -= 0.5
+            if self.displayed_score:
+                self.main_score_label.text = str(int(self.displayed_score))
+            else:
+                self.main_score_label.text = ''
+        if grid.gameover_t is not None:
+            gt = (grid.t - grid.gameover_t)
+            n = 30
+            b = int(min(255-n, (255-n) * gt))
+            o = int(math.sin(gt * math.tau / 2) * n)
+            self.gameover_label.color = (
+                b-o, b-o, b-o, 255
+            )
+
+    def handle_command(self, command):
+        if command == 'end' and self.ui:
+            self.ui.activate()
+            return True
+        return self.grid.handle_command(command)
+
+    def activate(self, view):
+        """Tick the given view each frame, until its tick returns false"""
+        self.active_tile_views[view] = None
+
+    def tile_added(self, tile, x, y):
+        self.tile_views[x, y] = tiles_view.new(self, tile, x, y)
+
+    def tile_removed(self, tile, x, y):
+        view = self.tile_views.pop((x, y), None)
+        if view:
+            view.remove()
+
+    def flower_grown(self, tile, x, y):
+        self.tile_views[x, y].grow_flower(tile.flower)
+
+    def tile_cocooned(self, tile, x, y):
+        view = self.tile_views.get((x, y))
+        if view:
+            view.cocooned()
+
+    def caterpillar_added(self, caterpillar):
+        self.caterpillar_view = CaterpillarView(self, caterpillar)
+
+    def cocoon_added(self, cocoon):
+        self.cocoon_view = CocoonView(self, cocoon)
+
+    def scored(self, amount, x, y):
+        self.main_score_label.text = str(self.grid.total_score)
+        if not (0 < amount < 5):
+            label = self.label_added(f'{amount:+1}', x, y)
+            if amount > 0:
+                label._caterpillar_color = 250, 255, 200
+            else:
+                label._caterpillar_color = 255, 230, 200
+
+    def label_added(self, label, x, y):
+        label = pyglet.text.Label(
+            label,
+            **HALF_FONT_INFO.label_args(),
+            anchor_x='center',
+            anchor_y='baseline',
+            align='center',
+            batch=self.score_batch,
+            x=x * TILE_WIDTH,
+            y=y * TILE_WIDTH,
+        )
+        self.score_labels.append(label)
+        label._caterpillar_start_t = self.grid.t
+        label._caterpillar_x = x
+        label._caterpillar_y = y
+        label._caterpillar_color = 255, 255, 255
+        return label
+
+    def game_over(self, message):
+        self.gameover_label.text = f'{message}    Press esc to exit.'.upper()
+
+    def collected_changed(self, caterpillar):
+        grid = self.grid
+        for item in caterpillar.collected_items.difference(self.collected_sprites):
+            for i in range(100):
+                for sprite in self.collected_sprites.values():
+                    if sprite._caterpillar_i == i:
+                        break
+                else:
+                    break
+            sprite = pyglet.sprite.Sprite(
+                get_image(item),
+                x=(grid.width-1/4) * TILE_WIDTH,
+                y=(grid.height - 3/4 - i/2) * TILE_WIDTH,
+                batch=self.score_batch,
+            )
+            sprite._caterpillar_i = i
+            sprite.scale = 1/4
+            self.collected_sprites[item] = sprite
+        for name, sprite in list(self.collected_sprites.items()):
+            if name not in caterpillar.collected_items:
+                sprite.delete()
+                del self.collected_sprites[name]
@@ -1,27 +1,32 @@
+import hashlib
+import json
+import os
+import tempfile
+import traceback
+from pathlib import Path
 
-from .resources import LEVELS
+import numpy
+
+from .resources import read_maps, get_maps_path
+from .util import IndexedSet, random_hue, get_cache_dir
 from . import tiles
 
-tileinfo = {
-    0: {'str': '.'},
-    0xa0000082: {'str': '@', 'dx': +1, 'dy': 0},
-    0x60000082: {'str': '@', 'dx': -1, 'dy': 0},
-}
-convertfuncs = {
-    'int': int,
-    'string': str,
-}
-for tileset in LEVELS['tilesets']:
-    firstgid = tileset['firstgid']
-    tileinfo.update({
-        tile['id'] + firstgid: {
-            **{
-                p['name']: convertfuncs[p['type']](p['value'])
-                for p in tile.get('properties', ())},
-            'sprite': (8 - tile['id'] // 16) * 16 + (tile['id'] % 16),
-        }
-        for tile in tileset['tiles']
-    })
+# Size of a level, in tiles
+LEVEL_WIDTH = 31
+LEVEL_HEIGHT = 17
+
+# Levels are windows of the map, laid out in 3 columns and 4 rows
+MAP_WINDOWS = range(1, 13)
+
+# Compiled levels are kept here, keyed to the contents of maps.json
+LEVEL_CACHE_PATH = get_cache_dir() / 'levels'
+
+# Bump when the compiled format or the way levels are read changes
+LEVEL_FORMAT_VERSION = 1
+
+# Grid.cells indexes, in the order they are numbered in compiled levels
+INDEX_NAMES = 'empty', 'grass', 'flower', 'water', 'hazard'
+NO_INDEX = len(INDEX_NAMES)
 
 LEVEL_MAP = {
     1: 3,
@@ -46,39 +51,356 @@ KEY_LEVEL_MAP = {
     9: 6,
 }
 
-def load_level_to_grid(level, grid):
-    level = LEVEL_MAP.get(level, level)
-    start_col = (level - 1) % 3 * 32
-    start_row = (3 - (level - 1) // 3) * 18
+def get_tileinfo(levels):
+    """Return properties of the map's tiles, by tile number"""
+    tileinfo = {
+        0: {'str': '.'},
+        0xa0000082: {'str': '@', 'dx': +1, 'dy': 0},
+        0x60000082: {'str': '@', 'dx': -1, 'dy': 0},
+    }
+    convertfuncs = {
+        'int': int,
+        'string': str,
+    }
+    for tileset in levels['tilesets']:
+        firstgid = tileset['firstgid']
+        tileinfo.update({
+            tile['id'] + firstgid: {
+                **{
+                    p['name']: convertfuncs[p['type']](p['value'])
+                    for p in tile.get('properties', ())},
+                'sprite': (8 - tile['id'] // 16) * 16 + (tile['id'] % 16),
+            }
+            for tile in tileset['tiles']
+        })
+    return tileinfo
 
-    pitch = LEVELS['width']
-    data = LEVELS['layers'][1]['data']
 
-    for y in range(grid.height):
-        try:
-            for x in range(grid.width):
-                ny = grid.height - y - 1
-                tile = data[(grid.height - start_row - ny) * pitch + start_col + x]
-                props = tileinfo.get(tile, {})
+class _CompilingGrid:
+    """Stands in for a Grid when making tiles to compile a level"""
+    def __init__(self):
+        self.flower_hues = numpy.zeros(
+            (LEVEL_WIDTH, LEVEL_HEIGHT), dtype=numpy.uint8,
+        )
+
+
+def get_level_window(level):
+    """Return the map window a level is read from"""
+    return LEVEL_MAP.get(level, level)
+
+
+class LevelCompiler:
+    """Compiles windows of the map into arrays
+
+    A compiled window has axes (layer, x, y). The layers hold the index
+    of each tile's kind in `kinds` (0 for empty tiles), the Grid.cells
+    index the tile is listed in (see INDEX_NAMES), and its position in
+    that index. Tiles with a flower are listed in the 'flower' index in
+    the order their hues are drawn.
+
+    Give `kinds` of earlier compiled windows to keep their numbering.
+    """
+    def __init__(self, levels, kinds=None):
+        self.tileinfo = get_tileinfo(levels)
+        self.pitch = levels['width']
+        self.layer = numpy.array(levels['layers'][1]['data'], dtype=numpy.uint32)
+        self.kinds = [None]
+        self.kind_numbers = {}
+        for name, props in (kinds or [None])[1:]:
+            self.add_kind(name, props)
+
+    def add_kind(self, name, props):
+        key = json.dumps([name, props], sort_keys=True)
+        number = self.kind_numbers.get(key)
+        if number is None:
+            number = self.kind_numbers[key] = len(self.kinds)
+            self.kinds.append([name, props])
+        return number
+
+    def get_positions(self, window):
+        """Return positions in the map layer of a window's tiles"""
+        start_col = (window - 1) % 3 * 32
+        start_row = (3 - (window - 1) // 3) * 18
+        xs = numpy.arange(LEVEL_WIDTH)[:, None]
+        ys = numpy.arange(LEVEL_HEIGHT)[None, :]
+        positions = (LEVEL_HEIGHT - start_row - ys) * self.pitch + start_col + xs
+        # Like Python lists, negative positions count from the end
+        size = len(self.layer)
+        if positions.min() < -size or positions.max() >= size:
+            raise IndexError(f'window {window} is outside the map')
+        return positions % size
+
+    def compile_window(self, window, out):
+        """Compile a window into `out`; return the caterpillar start or None
+
+        The start is (x, y, dx, dy).
+        """
+        grid = _CompilingGrid()
+        layer_tiles = self.layer[self.get_positions(window)].tolist()
+        window_cells, indexes, ranks = out
+        window_cells[...] = 0
+        start = None
+        # Replay how Grid.__setitem__ and Grass.grow_flower update the
+        # indexes, so they come out in the same order
+        index_sets = {name: IndexedSet() for name in INDEX_NAMES}
+        for x in range(LEVEL_WIDTH):
+            for y in range(LEVEL_HEIGHT):
+                index_sets['empty'].add((x, y))
+        for ny in reversed(range(LEVEL_HEIGHT)):
+            for x in range(LEVEL_WIDTH):
+                tile = layer_tiles[x][ny]
+                props = self.tileinfo.get(tile, {})
                 tile_str = props.get('str')
-                #if tile_str:
-                #    print(' ' + props['str'] + ' ', end='')
-                #else:
-                #    print(f'{tile:^3}', end='')
-                tile_class = tiles.tile_classes.get(tile_str)
-                if tile_class:
-                    grid[x, ny] = tile_class(grid, x, ny, props)
+                if tile_str in tiles.tile_classes:
+                    name = tile_str
                 elif tile_str == '?':
-                    grid[x, ny] = 'grass'
-                    grid[x, ny].grow_flower()
+                    name, props = 'grass', {}
                 elif tile_str == '@':
-                    grid.add_caterpillar(
-                        x, ny, (props['dx'], props['dy'])
-                    )
+                    start = x, ny, props['dx'], props['dy']
+                    continue
                 else:
                     assert tile < 1000, hex(tile)
-        finally:
+                    continue
+                window_cells[x, ny] = self.add_kind(name, props)
+                index_name = tiles.new(name, grid, x, ny, props).index_name()
+                index_sets['empty'].discard((x, ny))
+                if index_name:
+                    index_sets[index_name].add((x, ny))
+                if tile_str == '?':
+                    index_sets['grass'].discard((x, ny))
+                    index_sets['flower'].add((x, ny))
+        indexes[...] = NO_INDEX
+        for index, name in enumerate(INDEX_NAMES):
+            for rank, xy in enumerate(index_sets[name]):
+                indexes[xy] = index
+                ranks[xy] = rank
+        return start
+
+
+def compile_levels(maps_data):
+    """Compile all map windows
+
+    Return (cells, info): `cells` has the compiled windows (see
+    LevelCompiler) stacked in the order of MAP_WINDOWS. info['kinds']
+    lists the tile kinds as (name, props), and info['starts'] has the
+    caterpillar's (x, y, dx, dy) for windows that set it.
+    """
+    compiler = LevelCompiler(json.loads(maps_data))
+    shape = len(MAP_WINDOWS), 3, LEVEL_WIDTH, LEVEL_HEIGHT
+    cells = numpy.zeros(shape, dtype=numpy.uint16)
+    starts = {}
+    for window, out in zip(MAP_WINDOWS, cells):
+        start = compiler.compile_window(window, out)
+        if start:
+            starts[window] = start
+    info = {
+        'kinds': compiler.kinds,
+        'starts': starts,
+    }
+    return cells, info
+
+
+def get_maps_hash(maps_data):
+    digest = hashlib.sha1(
+        f'{LEVEL_FORMAT_VERSION}:{LEVEL_WIDTH}x{LEVEL_HEIGHT}:'.encode()
+    )
+    digest.update(maps_data)
+    return digest.hexdigest()
+
+
+def _write_atomically(path, write):
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except FileNotFoundError:
             pass
-            #print()
+        raise
+
+
+def get_cache_paths(maps_data, cache_path=LEVEL_CACHE_PATH):
+    """Return paths of the (cells, info) cache files for a map"""
+    cache_path = Path(cache_path)
+    name = f'levels-{get_maps_hash(maps_data)}'
+    return cache_path / f'{name}.npy', cache_path / f'{name}.json'
+
+
+def save_compiled_levels(maps_data, cells, info, cache_path=LEVEL_CACHE_PATH):
+    """Write compiled levels to the cache
+
+    Older cache files are left alone, since they may still be mapped;
+    load_compiled_levels removes them.
+    """
+    cells_path, info_path = get_cache_paths(maps_data, cache_path)
+    # The cache is an optimization; failing to write it is fine
+    try:
+        cells_path.parent.mkdir(parents=True, exist_ok=True)
+        _write_atomically(cells_path, lambda f: numpy.save(f, cells))
+        _write_atomically(info_path, lambda f: f.write(json.dumps(info).encode()))
+    except OSError:
+        pass
+
+
+def remove_stale_levels(maps_data, cache_path=LEVEL_CACHE_PATH):
+    """Remove cache files of other versions of the map
+
+    Files that can't be removed, like ones another running game has
+    mapped on Windows, are left for next time.
+    """
+    current = get_cache_paths(maps_data, cache_path)
+    try:
+        paths = list(Path(cache_path).glob('levels-*'))
+    except OSError:
+        return
+    for path in paths:
+        if path not in current:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def load_compiled_levels(cache_path=LEVEL_CACHE_PATH):
+    """Return (cells, info) of compile_levels(), from the cache if possible
+
+    Cached cells are memory-mapped. If the cache is missing, out of
+    date or damaged, the levels are compiled and the cache is written.
+    Nothing is mapped yet when this is called, so older cache files are
+    removed here.
+    """
+    maps_data = read_maps()
+    remove_stale_levels(maps_data, cache_path)
+    cells_path, info_path = get_cache_paths(maps_data, cache_path)
+    try:
+        # The info file is written last, so if it's there, so are the cells
+        info = json.loads(info_path.read_text())
+        info['starts'] = {int(w): s for w, s in info['starts'].items()}
+        cells = numpy.load(cells_path, mmap_mode='r')
+    except (OSError, EOFError, ValueError, KeyError):
+        pass
+    else:
+        return cells, info
+    cells, info = compile_levels(maps_data)
+    save_compiled_levels(maps_data, cells, info, cache_path)
+    return cells, info
+
+compiled_levels = None
+
+def get_compiled_levels():
+    """Return (cells, info) of the current levels; see compile_levels"""
+    global compiled_levels
+    if compiled_levels is None:
+        compiled_levels = load_compiled_levels()
+    return compiled_levels
+
+
+class LevelWatcher:
+    """Recompiles levels when maps.json changes, for level design
+
+    Call poll() now and then. Only the windows whose tiles changed in
+    the map are compiled again.
+    """
+    def __init__(self, path=None, cache_path=LEVEL_CACHE_PATH):
+        if path is None:
+            path = get_maps_path()
+        self.path = Path(path)
+        self.cache_path = cache_path
+        self.mtime = self.path.stat().st_mtime
+        self.levels = json.loads(self.path.read_bytes())
+
+    def poll(self):
+        """Recompile levels if the map changed
+
+        Return the set of windows that changed; see get_level_window.
+        """
+        try:
+            mtime = self.path.stat().st_mtime
+            if mtime == self.mtime:
+                return set()
+            maps_data = self.path.read_bytes()
+            levels = json.loads(maps_data)
+        except (OSError, ValueError):
+            # Probably caught the file while it's being written or
+            # replaced; retry
+            return set()
+        self.mtime = mtime
+        old_levels, self.levels = self.levels, levels
+        try:
+            return self.reload(maps_data, old_levels, levels)
+        except Exception:
+            traceback.print_exc()
+            return set()
+
+    def reload(self, maps_data, old_levels, levels):
+        cells, info = get_compiled_levels()
+        compiler = LevelCompiler(levels, kinds=info['kinds'])
+        old_layer = old_levels['layers'][1]['data']
+        if (
+            old_levels['width'] != levels['width']
+            or old_levels['tilesets'] != levels['tilesets']
+            or len(old_layer) != len(compiler.layer)
+        ):
+            changed = set(MAP_WINDOWS)
+        else:
+            changed_tiles = compiler.layer != old_layer
+            changed = {
+                window for window in MAP_WINDOWS
+                if changed_tiles[compiler.get_positions(window)].any()
+            }
+        if not changed:
+            return changed
+        cells = numpy.array(cells)
+        starts = dict(info['starts'])
+        for window in changed:
+            start = compiler.compile_window(
+                window, cells[MAP_WINDOWS.index(window)],
+            )
+            if start:
+                starts[window] = start
+            else:
+                starts.pop(window, None)
+        info = {
+            'kinds': compiler.kinds,
+            'starts': starts,
+        }
+        global compiled_levels
+        compiled_levels = cells, info
+        save_compiled_levels(maps_data, cells, info, self.cache_path)
+        print('Reloaded levels from map windows:', *sorted(changed))
+        return changed
+
+
+def load_level_to_grid(level, grid):
+    """Fill a new, empty grid with a level
+
+    Observer hooks are not called; views read the grid once it's loaded.
+    """
+    assert (grid.width, grid.height) == (LEVEL_WIDTH, LEVEL_HEIGHT)
+    level = get_level_window(level)
+    cells, info = get_compiled_levels()
+    kind_cells, indexes, ranks = cells[MAP_WINDOWS.index(level)]
+
+    codes = numpy.zeros(len(info['kinds']), dtype=numpy.uint16)
+    for number, (name, props) in enumerate(info['kinds'][1:], start=1):
+        codes[number] = tiles.get_code(tiles.tile_classes[name], props)
+    grid.codes[...] = codes[kind_cells]
+
+    for index, name in enumerate(INDEX_NAMES):
+        xs, ys = numpy.nonzero(indexes == index)
+        order = numpy.argsort(ranks[xs, ys])
+        grid.cells[name] = IndexedSet(zip(
+            xs[order].tolist(), ys[order].tolist(),
+        ))
+    for xy in grid.cells['flower']:
+        grid.flower_hues[xy] = ord(random_hue())
+
+    start = info['starts'].get(level)
+    if start:
+        x, y, dx, dy = start
+        grid.add_caterpillar(x, y, (dx, dy))
 
     grid.autogrow_flowers = False
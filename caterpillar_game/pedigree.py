@@ -0,0 +1,52 @@
+from .butterfly import Butterfly
+
+
+class Pedigree:
+    """Numbers butterflies for saving, so that each is stored only once
+
+    Entries are dicts like Butterfly.to_dict(), with the entry numbers of
+    the butterfly's parents under 'parents'. Parents always come before
+    their children. Butterflies with the same hues and parents can't be
+    told apart, so they share an entry and load back as one object.
+    """
+    def __init__(self):
+        self.entries = []
+        # Butterfly object -> entry number
+        self.numbers = {}
+        # (hues, parent entry numbers) -> entry number
+        self.keys = {}
+
+    def add(self, butterfly):
+        """Return the entry number of a butterfly, adding its ancestry"""
+        # Lineages can be deep, so this avoids recursion
+        stack = [butterfly]
+        while stack:
+            current = stack[-1]
+            if current in self.numbers:
+                stack.pop()
+                continue
+            missing = [p for p in current.parents if p not in self.numbers]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            parents = tuple(self.numbers[p] for p in current.parents)
+            entry = current.to_dict()
+            key = entry['wing'], parents
+            number = self.keys.get(key)
+            if number is None:
+                number = self.keys[key] = len(self.entries)
+                if parents:
+                    entry['parents'] = list(parents)
+                self.entries.append(entry)
+            self.numbers[current] = number
+        return self.numbers[butterfly]
+
+
+def load_pedigree(entries):
+    """Return a list of butterflies made from Pedigree entries"""
+    butterflies = []
+    for entry in entries:
+        parents = [butterflies[number] for number in entry.get('parents', ())]
+        butterflies.append(Butterfly.from_dict(entry, parents=parents))
+    return butterflies
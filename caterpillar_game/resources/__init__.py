@@ -1,6 +1,5 @@
 import functools
 import tempfile
-import json
 import os
 import atexit
 
@@ -83,17 +82,29 @@ spritesheet_image = None
 butterfly_images = {}
 
 
-# Pyglet can only load fonts from an actual file
-_font_file = tempfile.NamedTemporaryFile(suffix='Aldrich-Regular.ttf', delete=False)
-atexit.register(lambda: os.unlink(_font_file.name))
-_font_file.write(importlib_resources.read_binary(__name__, 'Aldrich-Regular.ttf'))
-# The file needs to be closed for Windows
-_font_file.close()
-pyglet.font.add_file(_font_file.name)
-FONT = pyglet.font.load('Aldrich')
+def read_maps():
+    """Return the contents of the Tiled map file, maps.json
 
-with importlib_resources.open_text(__name__, 'maps.json') as f:
-    LEVELS = json.load(f)
+    The map is compiled into levels; see level.get_compiled_levels.
+    """
+    return importlib_resources.read_binary(__name__, 'maps.json')
+
+def get_maps_path():
+    """Return the path of maps.json, to watch it for changes"""
+    with importlib_resources.path(__name__, 'maps.json') as path:
+        return path
+
+@functools.lru_cache()
+def get_font():
+    # Loaded on first use, so the game logic can be imported without a display
+    # Pyglet can only load fonts from an actual file
+    font_file = tempfile.NamedTemporaryFile(suffix='Aldrich-Regular.ttf', delete=False)
+    atexit.register(lambda: os.unlink(font_file.name))
+    font_file.write(importlib_resources.read_binary(__name__, 'Aldrich-Regular.ttf'))
+    # The file needs to be closed for Windows
+    font_file.close()
+    pyglet.font.add_file(font_file.name)
+    return pyglet.font.load('Aldrich')
 
 class FONT_INFO:
     font_name = 'Aldrich'
@@ -102,6 +113,7 @@ class FONT_INFO:
 
     @classmethod
     def label_args(cls):
+        get_font()
         return {'font_name': cls.font_name, 'font_size': cls.font_size}
 
 class HALF_FONT_INFO(FONT_INFO):
@@ -1,12 +1,129 @@
+import atexit
 import json
+import os
+import tempfile
+import threading
+import time
+import traceback
 from pathlib import Path
 
 from .butterfly import Butterfly
 from .egg import Egg
 from .level import KEY_LEVEL_MAP
+from .pedigree import Pedigree, load_pedigree
 
 SAVE_PATH = Path('./savegame.json')
 
+# Saves are written this long after they're requested, so that a burst
+# of changes results in a single write
+SAVE_DELAY = 0.5
+
+
+def write_atomically(path, text):
+    """Write a file so that it has either the old or the new contents
+
+    The text goes to a temporary file that replaces the original once
+    it is safely on disk. The directory is synced too, so the rename
+    itself survives a crash.
+    """
+    path = Path(path)
+    fd, tmp_name = tempfile.mkstemp(
+        dir=path.parent, prefix=path.name, suffix='.tmp',
+    )
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except FileNotFoundError:
+            pass
+        raise
+    _sync_directory(path.parent)
+
+
+def _sync_directory(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Windows can't open directories; renames there are durable anyway
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class SaveWriter:
+    """Writes saved games in a background thread
+
+    Only the latest data for each file (or other target) is written, at
+    most once per `delay` seconds. A write that fails is reported, and
+    doesn't stop the other writes or later ones.
+    """
+    def __init__(self, delay=SAVE_DELAY):
+        self.delay = delay
+        self.condition = threading.Condition()
+        # Held while taking pending data and writing it, so that files
+        # are written in order
+        self.write_lock = threading.Lock()
+        # target -> (function, data)
+        self.pending = {}
+        self.thread = None
+
+    def write(self, path, data):
+        """Schedule writing `data` to `path` as JSON"""
+        self.schedule(Path(path), _write_json, data)
+
+    def schedule(self, target, function, data):
+        """Schedule calling `function(target, data)` in the background
+
+        Of the calls scheduled for a target, only the latest is made.
+        """
+        with self.condition:
+            self.pending[target] = function, data
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='save-writer', daemon=True,
+                )
+                self.thread.start()
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+            time.sleep(self.delay)
+            self.flush()
+
+    def flush(self):
+        """Write all pending data now"""
+        with self.write_lock:
+            with self.condition:
+                pending, self.pending = self.pending, {}
+            for target, (function, data) in pending.items():
+                try:
+                    function(target, data)
+                except Exception:
+                    traceback.print_exc()
+
+
+def _write_json(path, data):
+    write_atomically(path, json.dumps(data))
+
+
+def _save_store_meta(store, data):
+    store.save_meta(data)
+
+save_writer = SaveWriter()
+atexit.register(save_writer.flush)
+
 class GameState:
     def __init__(self):
         self.broods = []
@@ -16,18 +133,26 @@ class GameState:
         self.last_level = 0
         self.level_achievements = {}
         self.best_scores = {}
+        # ButterflyStore holding the butterflies and broods, or None to
+        # keep them in lists and save everything as JSON
+        self.store = None
 
     def save(self, path=SAVE_PATH):
-        print('SAVING')
+        """Save the game; the file is written in the background"""
+        if self.store is not None:
+            # Also commits the butterflies and eggs added since last time
+            save_writer.schedule(
+                self.store, _save_store_meta, self.meta_to_dict(),
+            )
+            return
         as_dict = self.to_dict()
         #print(as_dict)
-        as_text = json.dumps(as_dict)
-        SAVE_PATH.write_text(as_text)
+        save_writer.write(path, as_dict)
 
     @classmethod
     def load(cls, path=SAVE_PATH):
         try:
-            f = SAVE_PATH.open()
+            f = Path(path).open()
         except FileNotFoundError:
             self = cls()
             self.adjust()
@@ -39,14 +164,63 @@ class GameState:
     @classmethod
     def from_dict(cls, data):
         self = cls()
-        self.broods = [[Egg.from_dict(d) for d in b] for b in data['broods']]
+        self.broods, self.butterflies = cls.collections_from_dict(data)
+        self.load_meta(data)
+        self.adjust()
+        return self
+
+    @classmethod
+    def from_store(cls, store, json_path=SAVE_PATH):
+        """Load a game kept in a ButterflyStore
+
+        A new store starts out with the contents of the JSON save at
+        `json_path`, if there is one.
+        """
+        data = store.load_meta()
+        if data is None:
+            try:
+                data = json.loads(Path(json_path).read_text())
+            except FileNotFoundError:
+                pass
+            else:
+                broods, butterflies = cls.collections_from_dict(data)
+                for butterfly in butterflies:
+                    store.add_butterfly(butterfly)
+                for brood in broods:
+                    store.add_brood(brood)
+        self = cls()
+        self.store = store
+        self.broods = store.broods
+        self.butterflies = store.butterflies
+        if data is not None:
+            self.load_meta(data)
+        self.adjust()
+        return self
+
+    @staticmethod
+    def collections_from_dict(data):
+        """Load (broods, butterflies) from a dict
+
+        Saves without a 'pedigree' have a copy of each butterfly
+        wherever it is used.
+        """
+        if 'pedigree' not in data:
+            return (
+                [[Egg.from_dict(d) for d in b] for b in data['broods']],
+                [Butterfly.from_dict(b) for b in data['butterflies']],
+            )
+        pedigree = load_pedigree(data['pedigree'])
+        return (
+            [[Egg.from_dict(d, pedigree) for d in b] for b in data['broods']],
+            [pedigree[number] for number in data['butterflies']],
+        )
+
+    def load_meta(self, data):
+        """Load state other than butterflies and broods from a dict"""
         self.in_tutorial = data['in_tutorial']
-        self.butterflies = [Butterfly.from_dict(b) for b in data['butterflies']]
         self.last_level = data['last_level']
         self.level_achievements = {int(l): a for l, a in data['level_achievements'].items()}
         self.best_scores = {int(l): a for l, a in data['best_scores'].items()}
-        self.adjust()
-        return self
 
     @property
     def is_emergency(self):
@@ -78,21 +252,39 @@ class GameState:
             return False
 
     def to_dict(self):
+        """Return the game as a dict
+
+        Butterflies, including parents of eggs and their ancestors, are
+        listed once under 'pedigree' and referred to by entry number.
+        """
+        pedigree = Pedigree()
+        return {
+            'broods': [[e.to_dict(pedigree) for e in b] for b in self.broods],
+            'butterflies': [pedigree.add(b) for b in self.butterflies],
+            'pedigree': pedigree.entries,
+            **self.meta_to_dict(),
+        }
+
+    def meta_to_dict(self):
         return {
-            'broods': [[e.to_dict() for e in b] for b in self.broods],
             'in_tutorial': self.in_tutorial,
-            'butterflies': [b.to_dict() for b in self.butterflies],
             'last_level': self.last_level,
-            'level_achievements': self.level_achievements,
-            'best_scores': self.best_scores,
+            'level_achievements': dict(self.level_achievements),
+            'best_scores': dict(self.best_scores),
         }
 
     def count_eggs(self, max=None):
-        count = 0
-        for brood in self.broods:
-            count += len(brood)
-            if max is not None and count >= max:
-                return count
+        """Return the number of eggs; with `max`, stop counting there"""
+        if self.store is not None:
+            count = self.broods.egg_count
+        else:
+            count = 0
+            for brood in self.broods:
+                count += len(brood)
+                if max is not None and count >= max:
+                    break
+        if max is not None:
+            return min(count, max)
         return count
 
     def choose_egg(self):
@@ -107,5 +299,8 @@ class GameState:
             *self.level_achievements.get(level, ()), *items
         ]))
         if butterfly:
-            self.butterflies.append(butterfly)
+            if self.store is None:
+                self.butterflies.append(butterfly)
+            else:
+                self.store.add_butterfly(butterfly, level)
         self.adjust()
@@ -0,0 +1,357 @@
+import itertools
+import json
+import sqlite3
+import threading
+import weakref
+from pathlib import Path
+
+from .butterfly import Butterfly
+from .egg import Egg, get_hue_codes, get_mean_hue_codes
+from .wing import WING_PATCH_COUNT
+
+STORE_PATH = Path('./savegame.sqlite')
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS butterflies (
+        id INTEGER PRIMARY KEY,
+        level INTEGER,
+        wing TEXT NOT NULL,
+        mean_hue INTEGER NOT NULL,
+        pedigree INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS butterflies_level ON butterflies (level);
+    CREATE INDEX IF NOT EXISTS butterflies_mean_hue ON butterflies (mean_hue);
+    CREATE TABLE IF NOT EXISTS pedigree (
+        id INTEGER PRIMARY KEY,
+        wing TEXT NOT NULL,
+        parents TEXT NOT NULL
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS pedigree_key ON pedigree (wing, parents);
+    CREATE TABLE IF NOT EXISTS eggs (
+        id INTEGER PRIMARY KEY,
+        brood INTEGER NOT NULL,
+        parents TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS eggs_brood ON eggs (brood);
+'''
+
+
+def get_mean_hue(hues):
+    """Mean hue code of a wing, the hue feature butterflies are indexed by"""
+    codes = get_hue_codes([hues], WING_PATCH_COUNT)
+    return int(get_mean_hue_codes(codes)[0])
+
+
+class ButterflyStore:
+    """Saved game kept in a sqlite database
+
+    Butterflies and eggs are only ever appended, one row each, and are
+    read back only when needed, so loading and saving don't get slower
+    as the collection grows. The rest of the game state is small and
+    is stored as JSON in the `meta` table.
+
+    Rows are numbered from 1 and never deleted, so counts come from the
+    primary keys rather than from scanning the tables.
+
+    Like pedigree.Pedigree in JSON saves, the `pedigree` table has each
+    butterfly in a lineage once, with the row ids of its parents.
+    Collected butterflies and eggs refer to those rows. Databases saved
+    before that have butterflies and egg parents without ancestry.
+
+    The game commits from the background save writer (see
+    GameState.save), so the connection is shared between threads, and
+    each use of it holds `lock`.
+    """
+    def __init__(self, path=STORE_PATH):
+        self.path = Path(path)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+        columns = [
+            row[1] for row in
+            self.connection.execute('PRAGMA table_info(butterflies)')
+        ]
+        if 'pedigree' not in columns:
+            self.connection.execute(
+                'ALTER TABLE butterflies ADD COLUMN pedigree INTEGER'
+            )
+        # Butterfly object -> its row id in the pedigree table
+        self.pedigree_ids = weakref.WeakKeyDictionary()
+        # pedigree row id -> Butterfly object, so that shared ancestors
+        # load as one object
+        self.loaded = weakref.WeakValueDictionary()
+        self.butterflies = StoredButterflies(self)
+        self.broods = StoredBroods(self)
+
+    def _query_one(self, sql, *args):
+        with self.lock:
+            return self.connection.execute(sql, args).fetchone()[0]
+
+    def _query(self, sql, args=(), chunk_size=256):
+        """Iterate over result rows, fetched a few at a time"""
+        with self.lock:
+            cursor = self.connection.execute(sql, args)
+        while True:
+            # Don't hold the lock while the caller handles rows
+            with self.lock:
+                rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield from rows
+
+    def load_meta(self):
+        """Return the stored game state other than butterflies and eggs
+
+        Return None if nothing was saved yet.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'state'"
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save_meta(self, data):
+        """Store `data` and commit everything added since the last save"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('state', ?)",
+                (json.dumps(data),),
+            )
+            self.connection.commit()
+
+    def add_to_pedigree(self, butterfly):
+        """Return the pedigree row id of a butterfly, adding its ancestry
+
+        As in pedigree.Pedigree, butterflies with the same hues and
+        parents share a row.
+        """
+        with self.lock:
+            # Lineages can be deep, so this avoids recursion
+            stack = [butterfly]
+            while stack:
+                current = stack[-1]
+                if current in self.pedigree_ids:
+                    stack.pop()
+                    continue
+                missing = [
+                    p for p in current.parents if p not in self.pedigree_ids
+                ]
+                if missing:
+                    stack.extend(missing)
+                    continue
+                stack.pop()
+                key = str(current.hues), json.dumps(
+                    [self.pedigree_ids[p] for p in current.parents],
+                )
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO pedigree (wing, parents) VALUES (?, ?)',
+                    key,
+                )
+                number = self._query_one(
+                    'SELECT id FROM pedigree WHERE wing = ? AND parents = ?',
+                    *key,
+                )
+                self.pedigree_ids[current] = number
+                self.loaded.setdefault(number, current)
+            return self.pedigree_ids[butterfly]
+
+    def load_pedigree(self, numbers):
+        """Return butterflies with the given pedigree row ids"""
+        # Strong references, so that butterflies in `loaded` stay around
+        made = {}
+        rows = {}
+        wanted = set(numbers)
+        while wanted:
+            missing = []
+            for number in wanted:
+                butterfly = self.loaded.get(number)
+                if butterfly is None:
+                    missing.append(number)
+                else:
+                    made[number] = butterfly
+            new_rows = {}
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start+500]
+                new_rows.update(
+                    (number, (wing, json.loads(parents)))
+                    for number, wing, parents in self._query(
+                        'SELECT id, wing, parents FROM pedigree '
+                        + 'WHERE id IN ({})'.format(', '.join('?' * len(chunk))),
+                        chunk,
+                    )
+                )
+            rows.update(new_rows)
+            wanted = {
+                parent
+                for wing, parents in new_rows.values() for parent in parents
+                if parent not in made and parent not in rows
+            }
+        # Parents are added before their children, so have lower ids
+        for number in sorted(rows):
+            wing, parents = rows[number]
+            butterfly = Butterfly.from_dict(
+                {'wing': wing}, parents=[made[p] for p in parents],
+            )
+            made[number] = self.loaded[number] = butterfly
+            self.pedigree_ids[butterfly] = number
+        return [made[number] for number in numbers]
+
+    def _load_butterflies(self, rows):
+        """Make butterflies from (wing, pedigree) rows of `butterflies`"""
+        pedigree = self.load_pedigree(
+            [number for wing, number in rows if number is not None],
+        )
+        pedigree.reverse()
+        return [
+            Butterfly.from_dict({'wing': wing}) if number is None
+            else pedigree.pop()
+            for wing, number in rows
+        ]
+
+    def add_butterfly(self, butterfly, level=None):
+        with self.lock:
+            row = (
+                level, str(butterfly.hues), get_mean_hue(butterfly.hues),
+                self.add_to_pedigree(butterfly),
+            )
+            self.connection.execute(
+                'INSERT INTO butterflies (level, wing, mean_hue, pedigree) '
+                + 'VALUES (?, ?, ?, ?)',
+                row,
+            )
+            self.butterflies.count += 1
+
+    def add_brood(self, eggs):
+        with self.lock:
+            rows = [
+                json.dumps([self.add_to_pedigree(p) for p in egg.parents])
+                for egg in eggs
+            ]
+            brood = len(self.broods)
+            self.connection.executemany(
+                'INSERT INTO eggs (brood, parents) VALUES (?, ?)',
+                [(brood, parents) for parents in rows],
+            )
+            self.broods.count += 1
+            self.broods.egg_count += len(eggs)
+
+    def find_butterflies(self, level=None, mean_hue=None, limit=None):
+        """Iterate over stored butterflies, optionally filtered
+
+        `mean_hue` is a hue code, as returned by get_mean_hue. Both
+        filters use an index.
+        """
+        conditions = []
+        args = []
+        if level is not None:
+            conditions.append('level = ?')
+            args.append(level)
+        if mean_hue is not None:
+            conditions.append('mean_hue = ?')
+            args.append(mean_hue)
+        sql = 'SELECT wing, pedigree FROM butterflies'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        rows = self._query(sql, args)
+        while True:
+            chunk = list(itertools.islice(rows, 256))
+            if not chunk:
+                return
+            yield from self._load_butterflies(chunk)
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class StoredButterflies:
+    """List-like view of the butterflies in a ButterflyStore
+
+    Butterfly objects are made when items are accessed.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.count = store._query_one(
+            'SELECT coalesce(max(id), 0) FROM butterflies'
+        )
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        index = range(self.count)[index]
+        with self.store.lock:
+            row = self.store.connection.execute(
+                'SELECT wing, pedigree FROM butterflies WHERE id = ?',
+                (index + 1,),
+            ).fetchone()
+        return self.store._load_butterflies([row])[0]
+
+    def __iter__(self):
+        return self.store.find_butterflies()
+
+    def append(self, butterfly):
+        self.store.add_butterfly(butterfly)
+
+
+class StoredBroods:
+    """List-like view of the broods in a ButterflyStore
+
+    Broods are lists of Egg objects, made when the brood is accessed.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.count = store._query_one(
+            'SELECT coalesce(max(brood) + 1, 0) FROM eggs'
+        )
+        self.egg_count = store._query_one(
+            'SELECT coalesce(max(id), 0) FROM eggs'
+        )
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        index = range(self.count)[index]
+        rows = [
+            json.loads(parents) for parents, in self.store._query(
+                'SELECT parents FROM eggs WHERE brood = ? ORDER BY id',
+                (index,),
+            )
+        ]
+        # Eggs saved before the pedigree table have parents as dicts
+        numbers = [
+            number for parents in rows for number in parents
+            if isinstance(number, int)
+        ]
+        pedigree = dict(zip(numbers, self.store.load_pedigree(numbers)))
+        return [
+            Egg.from_dict(parents, pedigree)
+            if all(isinstance(p, int) for p in parents)
+            else Egg.from_dict(parents)
+            for parents in rows
+        ]
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def __reversed__(self):
+        for index in reversed(range(self.count)):
+            yield self[index]
+
+    def append(self, eggs):
+        self.store.add_brood(eggs)
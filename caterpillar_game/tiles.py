@@ -1,34 +1,35 @@
-import dataclasses
 import random
 
-import pyglet
+from .util import flip, random_hue
 
-from .resources import get_image, TILE_WIDTH
-from .util import UP, DOWN, LEFT, RIGHT, get_color, lerp, random_hue, flip
-
-@dataclasses.dataclass
 class Tile:
-    grid: object
-    x: int
-    y: int
-    props: dict = dataclasses.field(default_factory=dict)
-
-    def __post_init__(self):
-        self.active = True
-        self.prepare_sprite()
+    """Behaviour of a tile on a grid
+
+    Tiles don't keep per-cell state except what prepare() loads from
+    the grid. Tiles of kinds marked `flyweight` don't even use their
+    position, so one instance (with x and y set to None) is shared by
+    all cells of the kind.
+    """
+    __slots__ = ('grid', 'x', 'y', 'props')
+    flyweight = False
+
+    def __init__(self, grid, x, y, props=None):
+        self.grid = grid
+        self.x = x
+        self.y = y
+        if props is None:
+            props = {}
+        self.props = props
         self.prepare()
 
+    def __repr__(self):
+        return f'<{type(self).__name__} at {self.x}, {self.y}: {self.props}>'
+
     def prepare(self):
         pass
 
-    def prepare_sprite(self):
-        if 'sprite' in self.props:
-            self.sprite = self.make_sprite()
-
-    def delete(self):
-        self.active = False
-
-    def tick(self, dt):
+    def save(self):
+        """Store per-cell state in the grid's side arrays"""
         pass
 
     def is_edge(self, caterpillar):
@@ -37,16 +38,6 @@ class Tile:
     def enter(self, caterpillar):
         return False
 
-    def make_sprite(self, image=None, **kwargs):
-        if image == None:
-            image = get_image(self.props['sprite'])
-        kwargs.setdefault('x', self.x * TILE_WIDTH)
-        kwargs.setdefault('y', self.y * TILE_WIDTH)
-        kwargs.setdefault('batch', self.grid.batch)
-        sprite = pyglet.sprite.Sprite(image, **kwargs)
-        sprite.scale = 1/2
-        return sprite
-
     def grow_flower(self):
         return False
 
@@ -62,10 +53,16 @@ class Tile:
     def coccoon_info(self):
         return None, 0
 
+    def index_name(self):
+        """Name of the grid.cells index this tile is listed in, if any"""
+        return None
+
 
 empty = Tile(None, -1, -1)
 
 class Edge(Tile):
+    __slots__ = ()
+
     def is_edge(self, caterpillar):
         return True
 
@@ -80,14 +77,39 @@ class Edge(Tile):
 
 edge = Edge(None, -1, -1)
 
-groups = [pyglet.graphics.OrderedGroup(i) for i in range(4)]
-
 tile_classes = {}
 
-def new(name, grid, x, y):
+# Grids store tiles as integer codes; each code stands for a tile class
+# with its props. Code 0 is the empty tile.
+kinds = [(Tile, {})]
+kind_codes = {}
+flyweights = {}
+
+def new(name, grid, x, y, props=None):
     cls = tile_classes[name]
-    tile = cls(grid, x, y)
-    return tile
+    if cls.flyweight:
+        return from_code(get_code(cls, props or {}), grid, x, y)
+    return cls(grid, x, y, props)
+
+def get_code(cls, props):
+    key = cls, tuple(sorted(props.items()))
+    try:
+        return kind_codes[key]
+    except KeyError:
+        code = kind_codes[key] = len(kinds)
+        kinds.append((cls, props))
+        return code
+
+def from_code(code, grid, x, y):
+    try:
+        return flyweights[code]
+    except KeyError:
+        pass
+    cls, props = kinds[code]
+    if cls.flyweight:
+        tile = flyweights[code] = cls(None, None, None, props)
+        return tile
+    return cls(grid, x, y, props)
 
 def register(name):
     def _decorator(cls):
@@ -96,35 +118,26 @@ def register(name):
     return _decorator
 
 class EdibleTile(Tile):
-    def prepare(self):
-        self.end_t = None
+    __slots__ = ()
 
     def enter(self, caterpillar):
         self.grid[self.x, self.y] = None
         return True
 
-    def delete(self):
-        self.end_t = self.grid.t
-
-    def tick(self, dt):
-        if self.end_t is not None:
-            t = (self.grid.t - self.end_t) * 2
-            if t > 1:
-                self.sprite.delete()
-                self.sprite = None
-                return False
-            self.sprite.scale = (1 - t) / 2
-            return True
-
 @register('grass')
 @register('_')
 class Grass(EdibleTile):
+    __slots__ = ('flower',)
+
     def prepare(self):
-        self.end_t = None
-        self.flower = None
+        if self.grid.flower_hues[self.x, self.y]:
+            self.flower = Flower(self.grid, self.x, self.y)
+        else:
+            self.flower = None
 
-    def prepare_sprite(self):
-        self.sprite = self.make_sprite(get_image('grass'), group=groups[0])
+    def save(self):
+        if self.flower:
+            self.flower.save()
 
     def enter(self, caterpillar):
         if self.flower:
@@ -135,47 +148,35 @@ class Grass(EdibleTile):
         self.grid.score(1, self.x, self.y)
         return True
 
-    def delete(self):
-        super().delete()
-        if self.flower:
-            self.flower.delete()
-
-    def tick(self, dt):
-        if self.flower:
-            self.flower.tick(dt)
-        return super().tick(dt)
-
     def grow_flower(self):
         if self.flower:
             return False
         self.flower = Flower(self.grid, self.x, self.y)
+        self.flower.save()
+        self.grid.cells['grass'].discard((self.x, self.y))
+        self.grid.cells['flower'].add((self.x, self.y))
+        self.grid.observer.flower_grown(self, self.x, self.y)
         return True
 
+    def index_name(self):
+        if self.flower:
+            return 'flower'
+        return 'grass'
+
 
 @register('flower')
 class Flower(EdibleTile):
+    __slots__ = ('hue',)
+
     def prepare(self):
-        self.start_t = self.grid.t
-        self.end_t = None
-        self.grown = False
-        self.hue = random_hue()
-        self.stem_sprite = self.make_sprite(
-            get_image('flower-stem', anchor_y=1/8),
-            y = (self.y - 3/8) * TILE_WIDTH,
-            group=groups[1],
-        )
-        self.petals_sprite = self.make_sprite(
-            get_image('flower-petals'),
-            group=groups[2],
-            y = (self.y + 1/8) * TILE_WIDTH,
-        )
-        self.petals_sprite.color = get_color(self.hue, 0.5)
-        self.center_sprite = self.make_sprite(
-            get_image('flower-center'),
-            group=groups[3],
-            y = (self.y + 1/8) * TILE_WIDTH,
-        )
-        self.center_sprite.color = get_color(self.hue, 0.2)
+        hue = self.grid.flower_hues[self.x, self.y]
+        if hue:
+            self.hue = chr(hue)
+        else:
+            self.hue = random_hue()
+
+    def save(self):
+        self.grid.flower_hues[self.x, self.y] = ord(self.hue)
 
     def enter(self, caterpillar, from_grass=False):
         super().enter(caterpillar)
@@ -189,35 +190,14 @@ class Flower(EdibleTile):
             self.grid.score(9, self.x, self.y)
         return True
 
-    def tick(self, dt):
-        self.petals_sprite.rotation += dt * 40
-        if self.end_t is not None:
-            t = (self.grid.t - self.end_t) * 2
-            if t > 1:
-                self.stem_sprite.delete()
-                self.petals_sprite.delete()
-                self.center_sprite.delete()
-                return False
-            scale = (1 - t) / 2
-            self.stem_sprite.scale_y = scale
-            self.petals_sprite.scale = scale
-            self.center_sprite.scale = scale
-            return True
-        elif not self.grown:
-            t = self.grid.t - self.start_t
-            if t > 1:
-                t = 1
-                self.grown = True
-            scale = t / 2
-            self.stem_sprite.scale_y = scale
-            self.petals_sprite.scale = scale
-            self.center_sprite.scale = scale
-            y = (self.y + lerp(-3/8, 1/8, t)) * TILE_WIDTH
-            self.petals_sprite.y = y
-            self.center_sprite.y = y
+    def index_name(self):
+        return 'flower'
 
 @register('≈')
 class Water(Tile):
+    __slots__ = ()
+    flyweight = True
+
     def enter(self, caterpillar):
         if caterpillar.swimming:
             return
@@ -236,8 +216,21 @@ class Water(Tile):
     def is_water(self, caterpillar):
         return True
 
+    def index_name(self):
+        return 'water'
+
+
+class Hazard(Tile):
+    __slots__ = ()
+
+    def index_name(self):
+        return 'hazard'
+
 @register('#')
-class Abyss(Tile):
+class Abyss(Hazard):
+    __slots__ = ()
+    flyweight = True
+
     def enter(self, caterpillar):
         caterpillar.die('fall', '''
             That's a long way down.
@@ -248,51 +241,13 @@ class Abyss(Tile):
         ''')
 
 @register('%')
-class Boulder(Tile):
-    def prepare(self):
-        super().prepare()
-        self.sprites = []
+class Boulder(Hazard):
+    __slots__ = ()
 
     def enter(self, caterpillar):
         if caterpillar.use('mushroom-s'):
             caterpillar.grid[self.x, self.y] = None
             caterpillar.utter('HYIAH!')
-            self.end_t = self.grid.t
-            N = 5
-            self.sprites = []
-            image = get_image('boulder')
-            for x in range(N):
-                for y in range(N):
-                    sprite = pyglet.sprite.Sprite(
-                        image.get_region(
-                            x * image.width//N,
-                            y * image.height//N,
-                            image.width//N,
-                            image.height//N,
-                        ),
-                        batch=self.grid.batch,
-                    )
-                    sprite.start_x = (self.x + x/N - 1/2) * TILE_WIDTH
-                    sprite.start_y = (self.y + y/N - 1/2) * TILE_WIDTH
-                    sprite.end_x = (
-                        (self.x + x/N - 1/2)
-                        + random.gauss(x-N/2, 7)
-                        + caterpillar.direction[0] * 2
-                    ) * TILE_WIDTH
-                    sprite.end_y = (
-                        (self.y + y/N - 1/2)
-                        + random.gauss(y-N/2, 7)
-                        + caterpillar.direction[1] * 2
-                    ) * TILE_WIDTH
-                    sprite.rot_speed = random.uniform(-360, 360)
-                    self.sprites.append(sprite)
-            self.sprite.image = get_image('grass')
-            self.sprite.start_x = self.sprite.x
-            self.sprite.start_y = self.sprite.y
-            self.sprite.end_x = self.sprite.x+1
-            self.sprite.end_y = self.sprite.y+1
-            self.sprite.rot_speed = 10
-            self.sprites.append(self.sprite)
         else:
             caterpillar.die('crash', '''
                 Can't eat that!
@@ -307,22 +262,13 @@ class Boulder(Tile):
                 Ouch!
             ''')
 
-    def tick(self, dt):
-        if self.sprites:
-            t = self.grid.t - self.end_t
-            if t < 1:
-                for sprite in self.sprites:
-                    sprite.x = lerp(sprite.start_x, sprite.end_x, t)
-                    sprite.y = lerp(sprite.start_y, sprite.end_y, t)
-                    sprite.rotation = sprite.rot_speed * t
-                    sprite.opacity = (1 - t)**2 * 255
-                return True
-
     def coccoon_info(self):
         return 'boulder', 10
 
 @register('w')
 class BubblyMushroom(EdibleTile):
+    __slots__ = ()
+
     def enter(self, caterpillar):
         super().enter(caterpillar)
         if caterpillar.collect('mushroom-w'):
@@ -330,12 +276,16 @@ class BubblyMushroom(EdibleTile):
 
 @register('t')
 class SoporificMushroom(EdibleTile):
+    __slots__ = ()
+
     def enter(self, caterpillar):
         super().enter(caterpillar)
         caterpillar.pause('Z')
 
 @register('s')
 class StrengthMushroom(EdibleTile):
+    __slots__ = ()
+
     def enter(self, caterpillar):
         super().enter(caterpillar)
         if 'boulder' in caterpillar.collected_items:
@@ -347,9 +297,9 @@ class StrengthMushroom(EdibleTile):
 @register('S')
 @register('T')
 @register('W')
-class Diamond(Tile):
-    def prepare(self):
-        self.sprite = self.make_sprite()
+class Diamond(Hazard):
+    __slots__ = ()
+    flyweight = True
 
     def enter(self, caterpillar):
         caterpillar.die('crash', '''
@@ -366,13 +316,18 @@ class Diamond(Tile):
 
 @register('$')
 class Apple(EdibleTile):
+    __slots__ = ()
+
     def enter(self, caterpillar):
         super().enter(caterpillar)
         if caterpillar.collect('apple'):
             caterpillar.utter('YUM!')
 
 @register('*')
-class Star(Tile):
+class Star(Hazard):
+    __slots__ = ()
+    flyweight = True
+
     def enter(self, caterpillar):
         caterpillar.die('crash', '''
             You met with a starry fate.
@@ -389,6 +344,9 @@ class Star(Tile):
 @register('^')
 @register('v')
 class ArrowPad(Tile):
+    __slots__ = ('direction',)
+    flyweight = True
+
     def prepare(self):
         self.direction = self.props['dx'], self.props['dy']
 
@@ -406,17 +364,14 @@ class ArrowPad(Tile):
 @register('↑')
 @register('↓')
 class Launcher(ArrowPad):
+    __slots__ = ()
+
     def launch(self, caterpillar):
         return True
 
 @register('K')
-class Key(Tile):
-    def prepare_sprite(self):
-        self.gold = not self.grid.state.have_key_for(self.props["opens"])
-        if self.gold:
-            self.sprite = self.make_sprite(get_image('key'))
-        else:
-            self.sprite = self.make_sprite(get_image('spent-key'))
+class Key(Hazard):
+    __slots__ = ()
 
     def enter(self, caterpillar):
         caterpillar.die('crash', '''
@@ -428,5 +383,4 @@ class Key(Tile):
         ''')
 
     def coccoon_info(self):
-        self.sprite.image = get_image('spent-key')
         return f'key:{self.props["opens"]}', 100
@@ -0,0 +1,244 @@
+import random
+
+import pyglet
+
+from .resources import get_image, TILE_WIDTH
+from .util import get_color, lerp
+from . import tiles
+
+groups = [pyglet.graphics.OrderedGroup(i) for i in range(4)]
+
+view_classes = {}
+
+def new(grid_view, tile, x, y, initial=False):
+    for cls in type(tile).__mro__:
+        try:
+            view_class = view_classes[cls]
+        except KeyError:
+            continue
+        return view_class(grid_view, tile, x, y, initial)
+
+def register(tile_class):
+    def _decorator(cls):
+        view_classes[tile_class] = cls
+        return cls
+    return _decorator
+
+
+@register(tiles.Tile)
+class TileView:
+    def __init__(self, grid_view, tile, x, y, initial=False):
+        self.grid_view = grid_view
+        self.grid = grid_view.grid
+        self.tile = tile
+        self.x = x
+        self.y = y
+        self.sprite = None
+        self.prepare_sprite()
+
+    def prepare_sprite(self):
+        if 'sprite' in self.tile.props:
+            self.sprite = self.make_sprite()
+
+    def make_sprite(self, image=None, **kwargs):
+        if image == None:
+            image = get_image(self.tile.props['sprite'])
+        kwargs.setdefault('x', self.x * TILE_WIDTH)
+        kwargs.setdefault('y', self.y * TILE_WIDTH)
+        kwargs.setdefault('batch', self.grid_view.batch)
+        sprite = pyglet.sprite.Sprite(image, **kwargs)
+        sprite.scale = 1/2
+        return sprite
+
+    def remove(self):
+        """Called when the tile leaves the grid"""
+        if self.sprite:
+            self.sprite.delete()
+            self.sprite = None
+
+    def tick(self, dt):
+        """Animate; only called on views activated in the grid view
+
+        Return true to keep being ticked.
+        """
+        return False
+
+    def cocooned(self):
+        pass
+
+
+@register(tiles.EdibleTile)
+class EdibleTileView(TileView):
+    def __init__(self, grid_view, tile, x, y, initial=False):
+        self.end_t = None
+        super().__init__(grid_view, tile, x, y, initial)
+
+    def remove(self):
+        self.end_t = self.grid.t
+        self.grid_view.activate(self)
+
+    def tick(self, dt):
+        t = (self.grid.t - self.end_t) * 2
+        if t > 1:
+            self.sprite.delete()
+            self.sprite = None
+            return False
+        self.sprite.scale = (1 - t) / 2
+        return True
+
+
+@register(tiles.Grass)
+class GrassView(EdibleTileView):
+    def __init__(self, grid_view, tile, x, y, initial=False):
+        super().__init__(grid_view, tile, x, y, initial)
+        self.flower = None
+        if tile.flower:
+            self.grow_flower(tile.flower, initial)
+
+    def prepare_sprite(self):
+        self.sprite = self.make_sprite(get_image('grass'), group=groups[0])
+
+    def grow_flower(self, flower, initial=False):
+        self.flower = FlowerView(self.grid_view, flower, self.x, self.y, initial)
+
+    def remove(self):
+        super().remove()
+        if self.flower:
+            self.flower.remove()
+
+
+@register(tiles.Flower)
+class FlowerView(EdibleTileView):
+    def __init__(self, grid_view, tile, x, y, initial=False):
+        self.start_t = grid_view.grid.t
+        if initial:
+            self.start_t -= 1
+        self.grown = False
+        super().__init__(grid_view, tile, x, y, initial)
+        # The petals keep spinning, so flowers are always active
+        grid_view.activate(self)
+
+    def prepare_sprite(self):
+        hue = self.tile.hue
+        self.stem_sprite = self.make_sprite(
+            get_image('flower-stem', anchor_y=1/8),
+            y = (self.y - 3/8) * TILE_WIDTH,
+            group=groups[1],
+        )
+        self.petals_sprite = self.make_sprite(
+            get_image('flower-petals'),
+            group=groups[2],
+            y = (self.y + 1/8) * TILE_WIDTH,
+        )
+        self.petals_sprite.color = get_color(hue, 0.5)
+        self.center_sprite = self.make_sprite(
+            get_image('flower-center'),
+            group=groups[3],
+            y = (self.y + 1/8) * TILE_WIDTH,
+        )
+        self.center_sprite.color = get_color(hue, 0.2)
+
+    def tick(self, dt):
+        self.petals_sprite.rotation += dt * 40
+        if self.end_t is not None:
+            t = (self.grid.t - self.end_t) * 2
+            if t > 1:
+                self.stem_sprite.delete()
+                self.petals_sprite.delete()
+                self.center_sprite.delete()
+                return False
+            scale = (1 - t) / 2
+            self.stem_sprite.scale_y = scale
+            self.petals_sprite.scale = scale
+            self.center_sprite.scale = scale
+            return True
+        elif not self.grown:
+            t = self.grid.t - self.start_t
+            if t > 1:
+                t = 1
+                self.grown = True
+            scale = t / 2
+            self.stem_sprite.scale_y = scale
+            self.petals_sprite.scale = scale
+            self.center_sprite.scale = scale
+            y = (self.y + lerp(-3/8, 1/8, t)) * TILE_WIDTH
+            self.petals_sprite.y = y
+            self.center_sprite.y = y
+        return True
+
+
+@register(tiles.Boulder)
+class BoulderView(TileView):
+    def __init__(self, grid_view, tile, x, y, initial=False):
+        super().__init__(grid_view, tile, x, y, initial)
+        self.sprites = []
+
+    def remove(self):
+        # The boulder only leaves the grid when the caterpillar smashes it
+        direction = self.grid.caterpillar.direction
+        self.end_t = self.grid.t
+        N = 5
+        self.sprites = []
+        image = get_image('boulder')
+        for x in range(N):
+            for y in range(N):
+                sprite = pyglet.sprite.Sprite(
+                    image.get_region(
+                        x * image.width//N,
+                        y * image.height//N,
+                        image.width//N,
+                        image.height//N,
+                    ),
+                    batch=self.grid_view.batch,
+                )
+                sprite.start_x = (self.x + x/N - 1/2) * TILE_WIDTH
+                sprite.start_y = (self.y + y/N - 1/2) * TILE_WIDTH
+                sprite.end_x = (
+                    (self.x + x/N - 1/2)
+                    + random.gauss(x-N/2, 7)
+                    + direction[0] * 2
+                ) * TILE_WIDTH
+                sprite.end_y = (
+                    (self.y + y/N - 1/2)
+                    + random.gauss(y-N/2, 7)
+                    + direction[1] * 2
+                ) * TILE_WIDTH
+                sprite.rot_speed = random.uniform(-360, 360)
+                self.sprites.append(sprite)
+        self.sprite.image = get_image('grass')
+        self.sprite.start_x = self.sprite.x
+        self.sprite.start_y = self.sprite.y
+        self.sprite.end_x = self.sprite.x+1
+        self.sprite.end_y = self.sprite.y+1
+        self.sprite.rot_speed = 10
+        self.sprites.append(self.sprite)
+        self.grid_view.activate(self)
+
+    def tick(self, dt):
+        t = self.grid.t - self.end_t
+        if t < 1:
+            for sprite in self.sprites:
+                sprite.x = lerp(sprite.start_x, sprite.end_x, t)
+                sprite.y = lerp(sprite.start_y, sprite.end_y, t)
+                sprite.rotation = sprite.rot_speed * t
+                sprite.opacity = (1 - t)**2 * 255
+            return True
+        for sprite in self.sprites:
+            sprite.delete()
+        self.sprites = []
+        self.sprite = None
+        return False
+
+
+@register(tiles.Key)
+class KeyView(TileView):
+    def prepare_sprite(self):
+        state = self.grid.state
+        self.gold = not state.have_key_for(self.tile.props["opens"])
+        if self.gold:
+            self.sprite = self.make_sprite(get_image('key'))
+        else:
+            self.sprite = self.make_sprite(get_image('spent-key'))
+
+    def cocooned(self):
+        self.sprite.image = get_image('spent-key')
@@ -2,6 +2,7 @@ import pyglet
 
 from .resources import get_image, FONT_INFO, HALF_FONT_INFO
 from .grid import Grid
+from .grid_view import GridView
 
 WIDTH = 1024
 HEIGHT = 576
@@ -314,12 +315,12 @@ class LevelSelect:
             if self.state.accessible_levels[level] and not self.state.is_emergency:
                 self.chosen_level = level
         if command == 'go':
-            self.window.scene = Grid(
+            grid = Grid(
                 state=self.state,
                 egg=self.selected_egg,
                 level=self.chosen_level,
-                ui=self,
             )
+            self.window.scene = GridView(grid, ui=self)
         self.update()
 
     def activate(self, overlay=None):
@@ -1,7 +1,12 @@
 import pyglet
 import contextlib
 import colorsys
+import os
 import random
+import sys
+from pathlib import Path
+
+import numpy
 
 UP = 0, +1
 DOWN = 0, -1
@@ -18,10 +23,76 @@ def pushed_matrix():
         pyglet.gl.glPopMatrix()
 
 
+def get_cache_dir():
+    """Return the directory for the game's caches, in the user's home
+
+    The caches can always be rebuilt, so it is fine to delete them.
+    """
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or Path.home() / 'AppData/Local'
+    elif sys.platform == 'darwin':
+        base = Path.home() / 'Library/Caches'
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'caterpillar_game'
+
+
 def lerp(a, b, t):
     return a * (1-t) + b * t
 
 
+def add_quads(batch, image, count, group=None):
+    """Add a vertex list for `count` sprites showing `image` to a batch
+
+    Fill it in with sprite_quads().
+    """
+    texture = image.get_texture()
+    sprite_group = pyglet.sprite.SpriteGroup(
+        texture, pyglet.gl.GL_SRC_ALPHA, pyglet.gl.GL_ONE_MINUS_SRC_ALPHA,
+        parent=group,
+    )
+    return batch.add(
+        count * 4, pyglet.gl.GL_QUADS, sprite_group,
+        'v2i/stream', 'c4B/stream',
+        ('t3f/static', texture.tex_coords * count),
+    )
+
+
+def sprite_quads(
+    vertex_list, image, x, y, rotation, scale_x, scale_y, colors=None,
+):
+    """Write many sprites into a vertex list from add_quads() at once
+
+    Arguments are arrays (or scalars) with one item per sprite, and
+    colors as for quad_colors(). Vertices are computed like in
+    pyglet.sprite.Sprite. With no colors, the old ones are kept.
+    """
+    x1 = -image.anchor_x * scale_x
+    y1 = -image.anchor_y * scale_y
+    x2 = x1 + image.width * scale_x
+    y2 = y1 + image.height * scale_y
+    r = -numpy.radians(rotation)
+    cr = numpy.cos(r)
+    sr = numpy.sin(r)
+    count = vertex_list.get_size() // 4
+    vertices = numpy.empty((count, 4, 2), dtype=numpy.int32)
+    for corner, (cx, cy) in enumerate(((x1, y1), (x2, y1), (x2, y2), (x1, y2))):
+        vertices[:, corner, 0] = cx * cr - cy * sr + x
+        vertices[:, corner, 1] = cx * sr + cy * cr + y
+    numpy.ctypeslib.as_array(vertex_list.vertices)[:] = vertices.ravel()
+    if colors is not None:
+        quad_colors(vertex_list, colors)
+
+
+def quad_colors(vertex_list, colors):
+    """Set the colors of sprites in a vertex list from add_quads()
+
+    `colors` is an (n, 4) array of RGBA colors, or one color for all.
+    """
+    colors = numpy.asarray(colors).astype(numpy.uint8).reshape(-1, 1, 4)
+    numpy.ctypeslib.as_array(vertex_list.colors).reshape(-1, 4, 4)[:] = colors
+
+
 def flip(direction):
     x, y = direction
     return -x, -y
@@ -53,3 +124,38 @@ def decode_hue(char):
 
 def random_hue():
     return chr(random.randrange(33, 127))
+
+
+class IndexedSet:
+    """A set that can also pick a random item in constant time"""
+    def __init__(self, items=()):
+        self._items = []
+        self._positions = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if item not in self._positions:
+            self._positions[item] = len(self._items)
+            self._items.append(item)
+
+    def discard(self, item):
+        position = self._positions.pop(item, None)
+        if position is None:
+            return
+        last = self._items.pop()
+        if position < len(self._items):
+            self._items[position] = last
+            self._positions[last] = position
+
+    def choice(self):
+        return random.choice(self._items)
+
+    def __contains__(self, item):
+        return item in self._positions
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
@@ -5,6 +5,9 @@ import pyglet
 
 from .util import pushed_matrix
 from .ui import LevelSelect
+from .grid import Grid
+from .grid_view import GridView
+from .level import LevelWatcher, get_level_window
 
 WIDTH = 1024
 HEIGHT = 576
@@ -31,6 +34,22 @@ class Window(pyglet.window.Window):
             initial_scene = LevelSelect(state, self)
         self.scene = initial_scene
 
+    def watch_levels(self, interval=1/2):
+        """Reload levels when maps.json changes, restarting the one played"""
+        self.level_watcher = LevelWatcher()
+        pyglet.clock.schedule_interval(self.reload_levels, interval)
+
+    def reload_levels(self, dt):
+        changed = self.level_watcher.poll()
+        scene = self.scene
+        if isinstance(scene, GridView) and get_level_window(scene.grid.level) in changed:
+            grid = Grid(
+                state=scene.grid.state,
+                egg=scene.grid.egg,
+                level=scene.grid.level,
+            )
+            self.scene = GridView(grid, ui=scene.ui)
+
     def run(self, fps=30):
         pyglet.clock.schedule_interval(self.tick, 1/fps)
         pyglet.app.run()
@@ -1,41 +1,55 @@
 import png
 import array
+import functools
+import hashlib
 import concurrent.futures
+import sys
 import time
+import threading
 import multiprocessing
 
-try:
-    import importlib.resources as importlib_resources
-except ImportError:
-    import importlib_resources
-
 import pyglet
 import numpy
 
 from . import resources
-from .util import get_color, decode_hue
+from .util import decode_hue
+from .wing_cache import WingCache
+from .wing_kernel import wing_masks, wing_size, WING_PATCH_COUNT
+from .wing_kernel import get_patch_boxes, get_patch_weights, get_patch_colors
+from .wing_kernel import composite_into, composite_shared
+from .wing_scheduler import WingScheduler
 
 
-def get_wing_matrix():
-    """Return white wing matrix with axes (width, height, patch, channel)"""
-    wing_matrix = numpy.frombuffer(
-        importlib_resources.read_binary(resources, f'wings.dat'),
-        dtype='uint8',
-    )
-    wing_matrix = wing_matrix.reshape(
-        (-1, resources.BUTTERFLY_HEIGHT, resources.BUTTERFLY_HEIGHT),
-    )
-    wing_matrix = numpy.stack([wing_matrix] * 4, -1)
-    wing_matrix = wing_matrix.transpose((1, 2, 0, 3))[::-1, ...]
-    return wing_matrix.astype('uint16')
+# Smallest wing texture size generated for butterflies drawn small
+MIN_WING_SIZE = 16
+
+def get_wing_sizes():
+    """Return the sizes of the levels of detail, largest first"""
+    sizes = [wing_size]
+    while sizes[-1] % 2 == 0 and sizes[-1] // 2 >= MIN_WING_SIZE:
+        sizes.append(sizes[-1] // 2)
+    return sizes
+
+def get_lod_size(drawn_size):
+    """Return the smallest wing size that is at least `drawn_size`"""
+    for size in reversed(get_wing_sizes()):
+        if size >= drawn_size:
+            return size
+    return wing_size
 
-wing_matrix = get_wing_matrix()
-wing_alpha = wing_matrix.sum(axis=2)
-wing_where = wing_alpha > 0
 
-wing_size = wing_matrix.shape[0]
+# Bump when compositing changes, to invalidate cached wings
+WING_MODEL_VERSION = 1
 
-WING_PATCH_COUNT = wing_matrix.shape[2]
+@functools.lru_cache()
+def get_model_hash():
+    """Return a hash identifying the wing model, for caching wings"""
+    digest = hashlib.sha1(f'{WING_MODEL_VERSION}:'.encode())
+    digest.update(numpy.ascontiguousarray(wing_masks[:, ::-1, :]))
+    return digest.hexdigest()
+
+# Finished wings are kept on disk; set to None to disable
+wing_cache = WingCache()
 
 # Using threads for CPU-bound task (numpy number crunching);
 # use a relatively small number of threads
@@ -47,39 +61,281 @@ if thread_count > 5:
     thread_count = 5
 if thread_count < 1:
     thread_count = 1
-pool = concurrent.futures.ThreadPoolExecutor(max_workers=thread_count)
+scheduler = WingScheduler(thread_count)
+
+def get_priority(visible, drawn_size):
+    """Return the scheduling priority for a wing
+
+    Wings of visible butterflies come first, then the largest ones
+    on screen.
+    """
+    return not visible, -drawn_size
+
+# Optional pool of worker processes that do the compositing, leaving the
+# threads above to handle caching and hand-off; see use_process_pool.
+# Take the lock to use it, since it can be replaced from another thread.
+process_pool = None
+process_pool_lock = threading.Lock()
+
+def use_process_pool(worker_count=None):
+    """Composite wings in worker processes instead of threads
 
-def _get_array(hues):
+    Each worker memory-maps the wing model file, so the masks are shared
+    through the OS page cache, but each builds its own compositing weights
+    (get_patch_weights) for the sizes it is asked for. Finished wings are
+    written into a shared memory block and copied out of it; see _generate.
+    Pass worker_count=0 to go back to threads. Needs Python 3.9+.
+    """
+    global process_pool
+    if worker_count != 0 and sys.version_info < (3, 9):
+        raise RuntimeError('wing worker processes need Python 3.9+')
+    _stop_process_pool(wait=False)
+    if worker_count == 0:
+        return
+    with process_pool_lock:
+        if worker_count is None:
+            worker_count = multiprocessing.cpu_count()
+        # The game runs other threads, so the workers aren't forked from it.
+        # A fork server starts them from a process that has only imported
+        # wing_kernel; this module would start the scheduler's threads.
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([composite_shared.__module__])
+        else:
+            context = multiprocessing.get_context('spawn')
+        process_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=worker_count, mp_context=context,
+        )
+
+def _stop_process_pool(wait):
+    global process_pool
+    with process_pool_lock:
+        pool, process_pool = process_pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+def shutdown(wait=True):
+    """Stop generating wings; pending jobs are cancelled"""
+    _stop_process_pool(wait=wait)
+    scheduler.shutdown(wait=wait)
+
+# Scratch memory to use when generating wings in batches
+BATCH_MEMORY_BUDGET = 64 * 1024 * 1024
+
+def _get_arrays(hue_strings, size=wing_size):
+    """Return a buffer for each of several wings, from cache if possible"""
     time.sleep(0)
-    hues = list(hues)
-    while len(hues) < WING_PATCH_COUNT:
-        hues.append(' ')
-    colors = numpy.array([
-        get_color(hue, 0.9) + (255,)
-        for i, hue in zip(range(WING_PATCH_COUNT), hues)
-    ], dtype='uint16')
-    size = wing_matrix.shape[0]
-    colored = numpy.multiply(wing_matrix, colors, dtype='uint16')
-    result = numpy.zeros((size, size, 4), dtype='uint16')
-    numpy.floor_divide(colored.sum(axis=2), wing_alpha, out=result, where=wing_where)
-    result = numpy.nan_to_num(result, 0)
-    result = result.reshape(size, size * 4)
-    result = result.astype('uint8')
-    result = (pyglet.gl.GLubyte * result.size).from_buffer_copy(result.tobytes())
-    return result
+    if wing_cache is None:
+        return _generate(hue_strings, size)
+    buffer_type = pyglet.gl.GLubyte * (size * size * 4)
+    model_hash = get_model_hash()
+    results = [
+        wing_cache.get(model_hash, hues, size, buffer_type)
+        for hues in hue_strings
+    ]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        composited = _generate([hue_strings[i] for i in missing], size)
+        for i, result in zip(missing, composited):
+            wing_cache.put(model_hash, hue_strings[i], size, result)
+            results[i] = result
+    return results
+
+def _generate(hue_strings, size):
+    """Composite wings in this thread, or in the process pool if enabled
+
+    With the pool, workers write the wings into one shared memory block.
+    The results are copies, made in this process, and the block is freed
+    right away, so its lifetime doesn't depend on the images using them.
+    If the pool is shut down while the wings are being made, they are
+    made in this thread instead.
+    """
+    with process_pool_lock:
+        pool = process_pool
+    if pool is None:
+        return _composite(hue_strings, size)
+    from multiprocessing import shared_memory
+    buffer_size = size * size * 4
+    buffer_type = pyglet.gl.GLubyte * buffer_size
+    memory = shared_memory.SharedMemory(
+        create=True, size=buffer_size * len(hue_strings),
+    )
+    try:
+        try:
+            pool.submit(
+                composite_shared, memory.name, hue_strings, size,
+            ).result()
+        except (RuntimeError, concurrent.futures.CancelledError):
+            # Submitted after shutdown, or cancelled by it
+            return _composite(hue_strings, size)
+        return [
+            buffer_type.from_buffer_copy(memory.buf, i * buffer_size)
+            for i in range(len(hue_strings))
+        ]
+    finally:
+        memory.close()
+        memory.unlink()
+
+def _composite(hue_strings, size):
+    """Composite several wings at once; return a buffer for each"""
+    results = [
+        (pyglet.gl.GLubyte * (size * size * 4))() for hues in hue_strings
+    ]
+    # Write straight into the buffers that the images will use
+    composite_into(
+        [numpy.ctypeslib.as_array(r).reshape(-1, 4) for r in results],
+        hue_strings, size,
+    )
+    return results
+
+@functools.lru_cache()
+def get_patch_rows(size=wing_size):
+    """Return, for each patch, the rows of get_patch_weights it covers"""
+    pixels, weights, alpha, opacity = get_patch_weights(size)
+    return [numpy.flatnonzero(weights[:, i]) for i in range(WING_PATCH_COUNT)]
+
+def get_changed_patches(old_hues, new_hues):
+    """Return indices of the patches whose hue differs"""
+    return [
+        i for i, (old, new) in enumerate(zip(
+            get_patch_colors(old_hues), get_patch_colors(new_hues),
+        ))
+        if old != new
+    ]
+
+def recolor_wing(buffer, hues, patches, size=wing_size):
+    """Update a wing buffer after the hues of some patches changed
+
+    `buffer` holds a wing made by this module and `hues` are the new hues.
+    Only the pixels covered by the given patches are recomposited, within
+    the patches' bounding boxes.
+    Return the changed area as (x, y, width, height), or None.
+    """
+    pixels, weights, alpha, opacity = get_patch_weights(size)
+    patch_rows = get_patch_rows(size)
+    patches = list(patches)
+    boxes = [get_patch_boxes(size)[i] for i in patches]
+    boxes = [box for box in boxes if box[0] < box[1]]
+    if not boxes:
+        return None
+    if len(patches) == 1:
+        rows = patch_rows[patches[0]]
+    else:
+        rows = numpy.flatnonzero(weights[:, patches].any(axis=1))
+    colors = numpy.array(get_patch_colors(hues), dtype='float32')
+    colored = weights[rows] @ colors
+    colored /= alpha[rows]
+    rgba = numpy.ctypeslib.as_array(buffer).reshape(-1, 4)
+    rgba[pixels[rows], :3] = colored
+    y_start = min(box[0] for box in boxes)
+    y_end = max(box[1] for box in boxes)
+    x_start = min(box[2] for box in boxes)
+    x_end = max(box[3] for box in boxes)
+    return x_start, y_start, x_end - x_start, y_end - y_start
+
+def recolor_wing_image(image, hues, patches, textures=None):
+    """Recolor an image from get_wing_image in place; see recolor_wing
+
+    Only the changed area of the textures is uploaded again. By default
+    that is the image's own texture; pass `textures` to update others
+    holding the image, like atlas regions.
+    """
+    size = image.width
+    area = recolor_wing(image.get_data('RGBA', size * 4), hues, patches, size)
+    if area is not None:
+        if textures is None:
+            textures = [image.get_texture()]
+        x, y, width, height = area
+        for texture in textures:
+            texture.blit_into(image.get_region(x, y, width, height), x, y, 0)
+
+def _get_array(hues, size=wing_size):
+    return _get_arrays([hues], size)[0]
 
 def get_wing_image(futures):
     if futures[1].done():
         return futures[1].result()
     if futures[0].done():
+        size = futures[2]
         image = pyglet.image.ImageData(
-            wing_size, wing_size, 'RGBA', futures[0].result(),
+            size, size, 'RGBA', futures[0].result(),
         )
-        image.anchor_y = int((1-resources.BUTTERFLY_ANCHORS['wing']) * wing_size)
-        image.anchor_x = int((resources.BUTTERFLY_ANCHORS['x-wing']) * wing_size)
+        image.anchor_y = int((1-resources.BUTTERFLY_ANCHORS['wing']) * size)
+        image.anchor_x = int((resources.BUTTERFLY_ANCHORS['x-wing']) * size)
         futures[1].set_result(image)
         return image
 
-def start_wing_generation(hues):
-    future = pool.submit(_get_array, hues)
-    return future, concurrent.futures.Future()
+def start_wing_generation(hues, size=wing_size, priority=None):
+    """Start generating a wing texture of the given size
+
+    The size should be one of get_wing_sizes(); see get_lod_size.
+    Priority defaults to that of a butterfly not yet drawn; see
+    get_priority.
+    """
+    if priority is None:
+        priority = get_priority(False, size)
+    future = scheduler.submit(priority, _get_array, hues, size)
+    return future, concurrent.futures.Future(), size, future
+
+def start_wing_generations(hue_strings, size=wing_size, priority=None):
+    """Start generating wings for many butterflies at once
+
+    Return a list of futures usable with get_wing_image, one for each hue
+    string. The wings are composited in chunks that fit in
+    BATCH_MEMORY_BUDGET; a chunk is cancelled once all of its wings are.
+    """
+    if priority is None:
+        priority = get_priority(False, size)
+    pixels, weights, alpha, opacity = get_patch_weights(size)
+    wing_cost = len(pixels) * 3 * 4 + size * size * 4
+    chunk_size = max(1, BATCH_MEMORY_BUDGET // wing_cost)
+    result = []
+    for start in range(0, len(hue_strings), chunk_size):
+        chunk = hue_strings[start:start+chunk_size]
+        futures = [concurrent.futures.Future() for hues in chunk]
+        batch_future = scheduler.submit(priority, _get_arrays, chunk, size)
+        batch_future.add_done_callback(
+            functools.partial(_distribute_arrays, futures),
+        )
+        for future in futures:
+            future.add_done_callback(
+                functools.partial(_cancel_batch, futures, batch_future),
+            )
+        result.extend(
+            (future, concurrent.futures.Future(), size, batch_future)
+            for future in futures
+        )
+    return result
+
+def _distribute_arrays(futures, batch_future):
+    if batch_future.cancelled():
+        for future in futures:
+            future.cancel()
+        return
+    exception = batch_future.exception()
+    for i, future in enumerate(futures):
+        if not future.set_running_or_notify_cancel():
+            continue
+        if exception:
+            future.set_exception(exception)
+        else:
+            future.set_result(batch_future.result()[i])
+
+def _cancel_batch(futures, batch_future, future):
+    if all(f.cancelled() for f in futures):
+        batch_future.cancel()
+
+def set_wing_priority(futures, priority):
+    """Change the priority of a wing that is not being generated yet
+
+    For wings generated in a batch, this changes the whole batch.
+    """
+    scheduler.set_priority(futures[3], priority)
+
+def cancel_wing_generation(futures):
+    """Cancel generating a wing, unless it has already started"""
+    futures[0].cancel()
+
+def get_metrics():
+    """Return wing job statistics: queue depth, wait times and so on"""
+    return scheduler.get_metrics()
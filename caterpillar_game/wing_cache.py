@@ -0,0 +1,150 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from .util import get_cache_dir
+
+CACHE_PATH = get_cache_dir() / 'wings'
+
+# The cache is trimmed to this size, least recently used entries first
+CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+# Sizes of entries are added up as they are written; the directory is
+# scanned again after this many writes, to notice other game instances
+# sharing the cache
+TRIM_INTERVAL = 256
+
+# Temporary files older than this (in seconds) are left over from writers
+# that crashed, and are removed when trimming
+STALE_TMP_AGE = 60 * 60
+
+
+class WingCache:
+    """Finished wing RGBA buffers, stored as one file per wing
+
+    Entries are keyed by a hash of the wing model, the hue string and the
+    size. Reading an entry maps its file into memory; recency of use is
+    tracked in the files' modification times.
+
+    The total size is kept in memory, so writes only scan the directory
+    when the cache is over its limit, or once every TRIM_INTERVAL writes.
+
+    The cache is an optimization: if its files can't be read or written
+    (for example, in a read-only directory), wings are just made again.
+    """
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Size of all entries as of the last scan, plus writes since then;
+        # None before the first scan
+        self.total_bytes = None
+        self.puts_since_trim = 0
+
+    def get_path(self, model_hash, hues, size):
+        key = hashlib.sha1(f'{model_hash}:{size}:{hues}'.encode()).hexdigest()
+        return self.path / f'{key}.rgba'
+
+    def get(self, model_hash, hues, size, buffer_type):
+        """Return a buffer of `buffer_type` mapped from the cache, or None"""
+        path = self.get_path(model_hash, hues, size)
+        try:
+            with path.open('rb') as f:
+                if os.fstat(f.fileno()).st_size != size * size * 4:
+                    return None
+                # Copy-on-write, so the buffer is writable like a fresh one
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return buffer_type.from_buffer(mapped)
+
+    def put(self, model_hash, hues, size, buffer):
+        path = self.get_path(model_hash, hues, size)
+        # Write to a temporary file first, so readers never see a partial
+        # entry
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buffer)
+            os.replace(tmp_name, path)
+        except OSError:
+            try:
+                os.unlink(tmp_name)
+            except FileNotFoundError:
+                pass
+            return
+        with self.lock:
+            self.puts_since_trim += 1
+            if self.total_bytes is not None:
+                self.total_bytes += size * size * 4
+                if (
+                    self.total_bytes <= self.max_bytes
+                    and self.puts_since_trim < TRIM_INTERVAL
+                ):
+                    return
+        self.trim()
+
+    def trim(self):
+        """Remove least recently used entries until the cache fits
+
+        When over the limit, go down to 3/4 of it, so that the next
+        writes don't all need trimming again. Stale temporary files are
+        removed too.
+        """
+        with self.lock:
+            self.puts_since_trim = 0
+            entries = []
+            total = 0
+            stale_time = time.time() - STALE_TMP_AGE
+            try:
+                with os.scandir(self.path) as scan:
+                    for entry in scan:
+                        is_tmp = entry.name.endswith('.tmp')
+                        if not is_tmp and not entry.name.endswith('.rgba'):
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        if is_tmp:
+                            if stat.st_mtime < stale_time:
+                                _remove(entry.path)
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+            except OSError:
+                return
+            entries.sort()
+            if total > self.max_bytes:
+                target = self.max_bytes * 3 // 4
+            else:
+                target = self.max_bytes
+            for mtime, size, path in entries:
+                if total <= target:
+                    break
+                if _remove(path):
+                    total -= size
+            self.total_bytes = total
+
+
+def _remove(path):
+    """Remove a file if possible; return whether it's gone"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return False
+    return True
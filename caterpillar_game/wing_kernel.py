@@ -0,0 +1,137 @@
+import functools
+
+try:
+    import importlib.resources as importlib_resources
+except ImportError:
+    import importlib_resources
+
+import numpy
+
+from . import resources
+from .util import get_color
+
+# Wing compositing, kept apart from the scheduling and caching in wing.py
+# so that worker processes can import it without starting any threads.
+
+
+def get_wing_masks():
+    """Return wing patch masks with axes (patch, y, x), bottom row first
+
+    The masks are memory-mapped from the data file, one byte per pixel.
+    """
+    with importlib_resources.path(resources, 'wings.dat') as path:
+        masks = numpy.memmap(path, dtype='uint8', mode='r')
+    masks = masks.reshape(
+        (-1, resources.BUTTERFLY_HEIGHT, resources.BUTTERFLY_HEIGHT),
+    )
+    return masks[:, ::-1, :]
+
+wing_masks = get_wing_masks()
+
+wing_size = wing_masks.shape[1]
+
+WING_PATCH_COUNT = wing_masks.shape[0]
+
+
+@functools.lru_cache()
+def get_level_masks(size=wing_size):
+    """Return wing patch masks downsampled to the given size
+
+    Each level is the 2x2 average of the next larger one.
+    """
+    if size == wing_size:
+        return wing_masks
+    masks = get_level_masks(size * 2)
+    masks = masks.reshape(WING_PATCH_COUNT, size, 2, size, 2)
+    return masks.mean(axis=(2, 4), dtype='float32')
+
+@functools.lru_cache()
+def get_level_coverage(size=wing_size):
+    """Return the fraction of each pixel covered by any patch"""
+    if size == wing_size:
+        alpha = numpy.zeros((wing_size, wing_size), dtype='uint32')
+        for mask, (y_start, y_end, x_start, x_end) in zip(
+            wing_masks, get_patch_boxes(),
+        ):
+            alpha[y_start:y_end, x_start:x_end] += (
+                mask[y_start:y_end, x_start:x_end]
+            )
+        return (alpha > 0).astype('float32')
+    coverage = get_level_coverage(size * 2).reshape(size, 2, size, 2)
+    return coverage.mean(axis=(1, 3))
+
+@functools.lru_cache()
+def get_patch_boxes(size=wing_size):
+    """Return (y_start, y_end, x_start, x_end) bounding boxes of the patches
+
+    Empty patches get empty boxes.
+    """
+    boxes = []
+    for mask in get_level_masks(size):
+        ys = numpy.flatnonzero(mask.any(axis=1))
+        xs = numpy.flatnonzero(mask.any(axis=0))
+        if len(ys):
+            boxes.append((ys[0], ys[-1] + 1, xs[0], xs[-1] + 1))
+        else:
+            boxes.append((0, 0, 0, 0))
+    return boxes
+
+@functools.lru_cache()
+def get_patch_weights(size=wing_size):
+    """Return (pixels, weights, alpha, opacity) for compositing wings
+
+    `pixels` are flat indices of the pixels covered by some patch;
+    `weights` is a (pixel, patch) matrix of the masks at those pixels,
+    and `alpha` is the total of each row. `opacity` is the alpha channel
+    of those pixels: 255 at full size, less at edges of smaller levels.
+    Transparent pixels are left out entirely.
+    """
+    coverage = get_level_coverage(size).reshape(-1)
+    pixels = numpy.flatnonzero(coverage)
+    weights = numpy.empty((len(pixels), WING_PATCH_COUNT), dtype='float32')
+    for i, mask in enumerate(get_level_masks(size)):
+        weights[:, i] = mask.reshape(-1)[pixels]
+    alpha = weights.sum(axis=1, keepdims=True)
+    opacity = numpy.rint(coverage[pixels] * 255).astype('uint8')
+    return pixels, weights, alpha, opacity
+
+def get_patch_colors(hues):
+    hues = list(hues)
+    while len(hues) < WING_PATCH_COUNT:
+        hues.append(' ')
+    return [
+        get_color(hue, 0.9)
+        for i, hue in zip(range(WING_PATCH_COUNT), hues)
+    ]
+
+def composite_shared(memory_name, hue_strings, size):
+    """Composite wings into a shared memory block; run in worker processes"""
+    from multiprocessing import shared_memory
+    memory = shared_memory.SharedMemory(memory_name)
+    outputs = numpy.ndarray(
+        (len(hue_strings), size * size, 4), dtype='uint8', buffer=memory.buf,
+    )
+    try:
+        outputs[...] = 0
+        composite_into(outputs, hue_strings, size)
+    finally:
+        # The memory can only be closed once nothing refers to it
+        del outputs
+        memory.close()
+
+def composite_into(outputs, hue_strings, size):
+    """Composite wings into zeroed (pixel, channel) uint8 arrays"""
+    pixels, weights, alpha, opacity = get_patch_weights(size)
+    # Axes (patch, wing, channel), flattened to (patch, wing * channel)
+    # so that all the wings are done in one product
+    colors = numpy.array(
+        [get_patch_colors(hues) for hues in hue_strings], dtype='float32',
+    ).transpose((1, 0, 2)).reshape(WING_PATCH_COUNT, -1)
+    # Each pixel gets the average color of the patches that cover it,
+    # weighted by the patch masks. At full size the sums are exact in
+    # float32, so this matches integer division.
+    colored = weights @ colors
+    colored /= alpha
+    for i, rgba in enumerate(outputs):
+        rgba[pixels, :3] = colored[:, i*3:i*3+3]
+        rgba[pixels, 3] = opacity
@@ -0,0 +1,130 @@
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+
+class WingScheduler:
+    """Runs wing generation jobs in worker threads, most urgent first
+
+    Priorities are compared with `<`; lower values run sooner, and jobs of
+    equal priority run in the order they were submitted. A job can be
+    cancelled through its future until it starts running.
+    """
+    def __init__(self, thread_count):
+        self.condition = threading.Condition()
+        # Heap of (priority, sequence number, future); entries for jobs
+        # that were cancelled, started or re-prioritized are skipped
+        self.heap = []
+        # Pending jobs: future -> [priority, sequence number, submit time,
+        # function, arguments]
+        self.jobs = {}
+        self.counter = itertools.count()
+        self.is_shut_down = False
+        self.running = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.total_wait = 0
+        self.max_wait = 0
+        self.threads = []
+        for i in range(thread_count):
+            thread = threading.Thread(
+                target=self._work, name=f'wing-{i}', daemon=True,
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, priority, function, *args):
+        future = concurrent.futures.Future()
+        with self.condition:
+            if self.is_shut_down:
+                raise RuntimeError('cannot schedule jobs after shutdown')
+            number = next(self.counter)
+            self.jobs[future] = [
+                priority, number, time.perf_counter(), function, args,
+            ]
+            heapq.heappush(self.heap, (priority, number, future))
+            self.condition.notify()
+        future.add_done_callback(self._forget)
+        return future
+
+    def set_priority(self, future, priority):
+        """Change the priority of a job that has not started yet"""
+        with self.condition:
+            job = self.jobs.get(future)
+            if job is None or job[0] == priority:
+                return
+            job[0] = priority
+            job[1] = number = next(self.counter)
+            heapq.heappush(self.heap, (priority, number, future))
+
+    def _forget(self, future):
+        if future.cancelled():
+            with self.condition:
+                if self.jobs.pop(future, None) is not None:
+                    self.cancelled += 1
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.is_shut_down:
+                        return
+                    job = None
+                    while self.heap and job is None:
+                        priority, number, future = heapq.heappop(self.heap)
+                        job = self.jobs.get(future)
+                        if job is not None and job[1] != number:
+                            job = None
+                    if job is not None:
+                        break
+                    self.condition.wait()
+                del self.jobs[future]
+                priority, number, submit_time, function, args = job
+                wait = time.perf_counter() - submit_time
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.running += 1
+            started = future.set_running_or_notify_cancel()
+            if started:
+                try:
+                    result = function(*args)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            with self.condition:
+                self.running -= 1
+                if started:
+                    self.completed += 1
+                else:
+                    self.cancelled += 1
+
+    def get_metrics(self):
+        """Return a dict of statistics about the jobs
+
+        Wait times are in seconds, from submission until the job started.
+        """
+        with self.condition:
+            started = self.completed + self.running
+            return {
+                'queued': len(self.jobs),
+                'running': self.running,
+                'completed': self.completed,
+                'cancelled': self.cancelled,
+                'mean_wait': self.total_wait / started if started else 0,
+                'max_wait': self.max_wait,
+            }
+
+    def shutdown(self, wait=True):
+        """Cancel all pending jobs and stop the worker threads"""
+        with self.condition:
+            self.is_shut_down = True
+            pending = list(self.jobs)
+            self.condition.notify_all()
+        for future in pending:
+            future.cancel()
+        if wait:
+            for thread in self.threads:
+                thread.join()
@@ -15,3 +15,6 @@ if sys.version_info[:2] == MIN_VER:
 sys.path.insert(0, Path(__file__).parent)
 
 import caterpillar_game.__main__
+
+if __name__ == '__main__':
+    caterpillar_game.__main__.main()
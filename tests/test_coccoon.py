@@ -0,0 +1,47 @@
+import itertools
+
+import numpy
+import pytest
+
+from caterpillar_game.coccoon import Cocoon
+
+bresenham = pytest.importorskip('bresenham').bresenham
+
+
+def make_cocoon(inside, origin):
+    """Make a Cocoon with just what line_of_sight needs"""
+    cocoon = Cocoon.__new__(Cocoon)
+    cocoon.inside = inside
+    cocoon.origin = origin
+    return cocoon
+
+
+def bresenham_check(inside, origin, start, end):
+    """Line of sight as the game checked it with the `bresenham` package"""
+    x0, y0 = origin
+    return all(inside[x - x0, y - y0] for x, y in bresenham(*start, *end))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_line_of_sight_matches_bresenham(seed):
+    rng = numpy.random.default_rng(seed)
+    width, height = 9, 7
+    origin = 3, -2
+    inside = rng.random((width, height)) < 0.8
+    cocoon = make_cocoon(inside, origin)
+    tiles = [
+        (x + origin[0], y + origin[1])
+        for x in range(width) for y in range(height)
+    ]
+    pairs = list(itertools.product(tiles, repeat=2))
+    starts = numpy.array([start for start, end in pairs])
+    ends = numpy.array([end for start, end in pairs])
+    result = cocoon.line_of_sight(starts, ends)
+    expected = [bresenham_check(inside, origin, *pair) for pair in pairs]
+    assert result.tolist() == expected
+
+
+def test_line_of_sight_empty():
+    cocoon = make_cocoon(numpy.ones((3, 3), dtype=bool), (0, 0))
+    empty = numpy.zeros((0, 2), dtype=int)
+    assert cocoon.line_of_sight(empty, empty).tolist() == []
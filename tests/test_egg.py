@@ -0,0 +1,126 @@
+import random
+
+import numpy
+
+from caterpillar_game.butterfly import Butterfly
+from caterpillar_game.egg import Egg, breed, make_butterflies
+from caterpillar_game.egg import get_hue_codes, get_hue_strings
+from caterpillar_game.egg import get_mean_hue_codes, BLANK_CODE
+from caterpillar_game.util import random_hue
+from caterpillar_game.wing import WING_PATCH_COUNT
+
+
+def random_hues(rng, length=WING_PATCH_COUNT, blank_chance=0.2):
+    return ''.join(
+        ' ' if rng.random() < blank_chance else chr(rng.randrange(33, 127))
+        for i in range(length)
+    )
+
+
+def test_hue_codes_round_trip():
+    strings = ['abc', '', ' ~!']
+    codes = get_hue_codes(strings, 4)
+    assert codes.shape == (3, 4)
+    assert get_hue_strings(codes) == ['abc ', '    ', ' ~! ']
+
+
+def test_mean_hue_codes_match_make_butterfly():
+    rng = random.Random(0)
+    collected = [
+        random_hues(rng, rng.randrange(12)) for i in range(2000)
+    ]
+    # Without parents, make_butterfly gives the mean hue everywhere
+    expected = numpy.array(
+        [ord(Egg().make_butterfly(hues).hues[0]) for hues in collected],
+    )
+    result = get_mean_hue_codes(get_hue_codes(collected, 12))
+    difference = numpy.abs(result.astype(int) - expected)
+    # Means right on a boundary between codes may round differently
+    assert difference.max() <= 1
+    assert numpy.count_nonzero(difference) < len(collected) / 100
+
+
+def test_breed_without_parents_gives_mean_hue():
+    collected = get_hue_codes(['abc', '', 'xyz'], 3)
+    parent_codes = numpy.full((3, 2, WING_PATCH_COUNT), ord('a'))
+    result = breed(parent_codes, collected, parent_counts=[0, 0, 0], rng=1)
+    mean_hues = get_mean_hue_codes(collected)
+    assert (result == mean_hues[:, None]).all()
+
+
+def test_breed_inherits_from_parents_or_mean():
+    rng = random.Random(1)
+    egg_count = 500
+    parent_hues = [
+        [random_hues(rng) for parent in range(2)] for egg in range(egg_count)
+    ]
+    parent_codes = numpy.stack([
+        get_hue_codes(hues, WING_PATCH_COUNT) for hues in parent_hues
+    ])
+    collected = get_hue_codes(
+        [random_hues(rng, 5, 0) for egg in range(egg_count)], 5,
+    )
+    result = breed(parent_codes, collected, rng=2)
+    mean_hues = get_mean_hue_codes(collected)[:, None]
+    from_parents = (result[:, None, :] == parent_codes).any(axis=1)
+    assert (from_parents | (result == mean_hues)).all()
+    # Where both parents have a hue, a blank can only be the mean hue
+    # (negative mean angles encode as blanks)
+    no_blank_parents = (parent_codes != BLANK_CODE).all(axis=1)
+    blank = result == BLANK_CODE
+    assert not (blank & no_blank_parents & (mean_hues != BLANK_CODE)).any()
+
+
+def test_breed_is_seeded():
+    hues = random_hues(random.Random(5)), ' ' * WING_PATCH_COUNT
+    parent_codes = numpy.stack([get_hue_codes(hues, WING_PATCH_COUNT)] * 50)
+    collected = get_hue_codes(['xyz'] * 50, 3)
+    first = breed(parent_codes, collected, rng=5)
+    assert (breed(parent_codes, collected, rng=5) == first).all()
+
+
+def test_breed_statistics_match_make_butterfly():
+    """Offspring hues are distributed like those from make_butterfly"""
+    count = 4000
+    colorful = Butterfly(''.join(chr(40 + i) for i in range(WING_PATCH_COUNT)))
+    blank = Butterfly(' ' * WING_PATCH_COUNT)
+    collected = 'xyz'
+
+    random.seed(3)
+    expected = numpy.array([
+        get_hue_codes([
+            Egg([colorful, blank]).make_butterfly(collected).hues
+        ], WING_PATCH_COUNT)[0]
+        for i in range(count)
+    ])
+    parent_codes = numpy.broadcast_to(
+        get_hue_codes([colorful.hues, blank.hues], WING_PATCH_COUNT),
+        (count, 2, WING_PATCH_COUNT),
+    )
+    result = breed(parent_codes, get_hue_codes([collected] * count, 3), rng=3)
+
+    colorful_codes = get_hue_codes([colorful.hues], WING_PATCH_COUNT)
+    mean_code = ord(Egg().make_butterfly(collected).hues[0])
+    for offspring in expected, result:
+        assert set(numpy.unique(offspring)) <= {
+            *colorful_codes[0].tolist(), mean_code, BLANK_CODE,
+        }
+    for outcome in (
+        lambda codes: codes == colorful_codes,
+        lambda codes: codes == mean_code,
+        lambda codes: codes == BLANK_CODE,
+    ):
+        assert abs(outcome(expected).mean() - outcome(result).mean()) < 0.03
+
+
+def test_make_butterflies():
+    rng = random.Random(4)
+    parents = [Butterfly(random_hues(rng)) for i in range(4)]
+    eggs = [Egg(parents[:2]), Egg(), Egg(parents[1:])]
+    collected = ['abc', '', ''.join(random_hue() for i in range(10))]
+    butterflies = make_butterflies(eggs, collected, rng=6)
+    assert [b.parents for b in butterflies] == [tuple(e.parents) for e in eggs]
+    assert all(len(b.hues) == WING_PATCH_COUNT for b in butterflies)
+    assert butterflies[1].hues == ' ' * WING_PATCH_COUNT
+    again = make_butterflies(eggs, collected, rng=6)
+    assert [b.hues for b in again] == [b.hues for b in butterflies]
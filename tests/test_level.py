@@ -0,0 +1,180 @@
+import json
+import os
+import random
+
+import numpy
+import pytest
+
+from caterpillar_game import grid as grid_module
+from caterpillar_game import level, tiles
+from caterpillar_game.egg import Egg
+from caterpillar_game.grid import Grid
+from caterpillar_game.resources import read_maps
+from caterpillar_game.state import GameState
+
+
+def load_level_the_old_way(level_number, grid):
+    """The loader from before compiled levels, reading the map directly"""
+    levels = json.loads(read_maps())
+    tileinfo = level.get_tileinfo(levels)
+    window = level.get_level_window(level_number)
+    start_col = (window - 1) % 3 * 32
+    start_row = (3 - (window - 1) // 3) * 18
+    pitch = levels['width']
+    data = levels['layers'][1]['data']
+    for y in range(grid.height):
+        for x in range(grid.width):
+            ny = grid.height - y - 1
+            tile = data[(grid.height - start_row - ny) * pitch + start_col + x]
+            props = tileinfo.get(tile, {})
+            tile_str = props.get('str')
+            if tile_str in tiles.tile_classes:
+                grid[x, ny] = tiles.new(tile_str, grid, x, ny, props)
+            elif tile_str == '?':
+                grid[x, ny] = 'grass'
+                grid[x, ny].grow_flower()
+            elif tile_str == '@':
+                grid.add_caterpillar(x, ny, (props['dx'], props['dy']))
+            else:
+                assert tile < 1000, hex(tile)
+    grid.autogrow_flowers = False
+
+
+def describe(grid):
+    return (
+        [
+            [(type(grid[x, y]).__name__, sorted(grid[x, y].props.items()))
+             for y in range(grid.height)]
+            for x in range(grid.width)
+        ],
+        grid.flower_hues.tolist(),
+        {name: list(cells) for name, cells in grid.cells.items()},
+        [segment.xy for segment in grid.caterpillar.segments],
+        grid.caterpillar.direction,
+        grid.autogrow_flowers,
+        random.random(),
+    )
+
+
+@pytest.fixture(scope='module')
+def compiled():
+    return level.compile_levels(read_maps())
+
+
+@pytest.mark.parametrize('level_number', range(1, 10))
+def test_compiled_levels_load_like_the_old_loader(
+    level_number, compiled, monkeypatch,
+):
+    monkeypatch.setattr(level, 'compiled_levels', compiled)
+    random.seed(level_number)
+    loaded = describe(Grid(GameState(), egg=Egg(), level=level_number))
+
+    monkeypatch.setattr(grid_module, 'load_level_to_grid', load_level_the_old_way)
+    random.seed(level_number)
+    expected = describe(Grid(GameState(), egg=Egg(), level=level_number))
+    assert loaded == expected
+
+
+def test_positions_outside_the_map():
+    compiler = level.LevelCompiler(json.loads(read_maps()))
+    with pytest.raises(IndexError):
+        compiler.get_positions(0)
+    with pytest.raises(IndexError):
+        compiler.get_positions(100)
+
+
+def test_cache_round_trip(tmp_path, compiled):
+    cells, info = level.load_compiled_levels(tmp_path)
+    assert (cells == compiled[0]).all()
+    cached_cells, cached_info = level.load_compiled_levels(tmp_path)
+    assert isinstance(cached_cells, numpy.memmap)
+    assert (cached_cells == compiled[0]).all()
+    for loaded_info in info, cached_info:
+        assert loaded_info['kinds'] == json.loads(json.dumps(compiled[1]['kinds']))
+        assert {
+            window: list(start) for window, start in loaded_info['starts'].items()
+        } == {
+            window: list(start) for window, start in compiled[1]['starts'].items()
+        }
+
+
+@pytest.mark.parametrize('damage', [
+    lambda cells_path, info_path: cells_path.write_bytes(
+        cells_path.read_bytes()[:100],
+    ),
+    lambda cells_path, info_path: cells_path.write_bytes(b''),
+    lambda cells_path, info_path: info_path.write_text('{"kinds": []}'),
+    lambda cells_path, info_path: info_path.write_text('{'),
+])
+def test_damaged_cache_is_compiled_again(tmp_path, compiled, damage):
+    level.load_compiled_levels(tmp_path)
+    damage(*level.get_cache_paths(read_maps(), tmp_path))
+    cells, info = level.load_compiled_levels(tmp_path)
+    assert (cells == compiled[0]).all()
+    assert info['starts'] == compiled[1]['starts']
+
+
+def test_stale_cache_files_are_removed(tmp_path):
+    stale = tmp_path / 'levels-0123.npy'
+    stale.write_bytes(b'')
+    level.load_compiled_levels(tmp_path)
+    assert not stale.exists()
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def resolve_kinds(cells, info):
+    """Compiled cells with tile kinds as JSON instead of numbers"""
+    kinds = numpy.array([json.dumps(kind) for kind in info['kinds']])
+    return kinds[cells[:, 0]].tolist(), numpy.asarray(cells[:, 1:]).tolist()
+
+
+def edit_window(levels, window):
+    """Change one tile of a map window to another tile of that window"""
+    compiler = level.LevelCompiler(levels)
+    tileinfo = level.get_tileinfo(levels)
+    data = levels['layers'][1]['data']
+    positions = compiler.get_positions(window).ravel().tolist()
+    usable = [
+        p for p in positions if tileinfo.get(data[p], {}).get('str') != '@'
+    ]
+    target = usable[0]
+    data[target] = next(data[p] for p in usable if data[p] != data[target])
+
+
+def test_watcher_recompiles_changed_windows(tmp_path, compiled, monkeypatch):
+    monkeypatch.setattr(level, 'compiled_levels', compiled)
+    maps_path = tmp_path / 'maps.json'
+    maps_path.write_bytes(read_maps())
+    watcher = level.LevelWatcher(maps_path, cache_path=tmp_path / 'cache')
+    assert watcher.poll() == set()
+
+    levels = json.loads(read_maps())
+    edit_window(levels, 5)
+    maps_path.write_text(json.dumps(levels))
+    mtime = watcher.mtime + 10
+    os.utime(maps_path, (mtime, mtime))
+    assert watcher.poll() == {5}
+
+    cells, info = level.compiled_levels
+    expected_cells, expected_info = level.compile_levels(maps_path.read_bytes())
+    assert resolve_kinds(cells, info) == resolve_kinds(
+        expected_cells, expected_info,
+    )
+    assert info['starts'] == expected_info['starts']
+    # The original compiled levels are left alone
+    assert (compiled[0][4] != cells[4]).any()
+    assert (compiled[0][3] == cells[3]).all()
+    assert len(list((tmp_path / 'cache').iterdir())) == 2
+
+
+def test_watcher_ignores_missing_map(tmp_path, compiled, monkeypatch):
+    monkeypatch.setattr(level, 'compiled_levels', compiled)
+    maps_path = tmp_path / 'maps.json'
+    maps_path.write_bytes(read_maps())
+    watcher = level.LevelWatcher(maps_path, cache_path=tmp_path / 'cache')
+    # Editors may delete the file before writing the new one
+    maps_path.unlink()
+    assert watcher.poll() == set()
+    maps_path.write_text('{')
+    assert watcher.poll() == set()
+    assert level.compiled_levels is compiled
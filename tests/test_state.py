@@ -0,0 +1,177 @@
+import json
+import threading
+
+import pytest
+
+from caterpillar_game.butterfly import Butterfly
+from caterpillar_game.egg import Egg
+from caterpillar_game.pedigree import Pedigree, load_pedigree
+from caterpillar_game.state import GameState, SaveWriter
+
+
+@pytest.fixture(autouse=True)
+def no_saving(monkeypatch):
+    # Loading a game saves it right away; keep the tests from writing files
+    monkeypatch.setattr(GameState, 'save', lambda self, path=None: None)
+
+
+def make_family():
+    grandparent = Butterfly('aaaaaaaa')
+    mother = Butterfly('bbbbbbbb', parents=[grandparent, grandparent])
+    father = Butterfly('cccccccc', parents=[grandparent])
+    child = Butterfly('dddddddd', parents=[mother, father])
+    return grandparent, mother, father, child
+
+
+def hues_of(butterfly):
+    """A butterfly's hues and those of its ancestors, as nested tuples"""
+    return butterfly.hues, tuple(hues_of(p) for p in butterfly.parents)
+
+
+def test_pedigree_stores_each_butterfly_once():
+    grandparent, mother, father, child = make_family()
+    pedigree = Pedigree()
+    number = pedigree.add(child)
+    assert pedigree.add(mother) < number
+    assert len(pedigree.entries) == 4
+    # Parents come before their children
+    for i, entry in enumerate(pedigree.entries):
+        assert all(parent < i for parent in entry.get('parents', ()))
+
+    loaded = load_pedigree(json.loads(json.dumps(pedigree.entries)))
+    assert hues_of(loaded[number]) == hues_of(child)
+    loaded_mother, loaded_father = loaded[number].parents
+    assert loaded_mother.parents[0] is loaded_father.parents[0]
+
+
+def test_pedigree_merges_identical_butterflies():
+    parent = Butterfly('aaaaaaaa')
+    twins = [Butterfly('bbbbbbbb', parents=[parent]) for i in range(2)]
+    other = Butterfly('bbbbbbbb')
+    pedigree = Pedigree()
+    numbers = [pedigree.add(b) for b in [*twins, other]]
+    assert numbers[0] == numbers[1] != numbers[2]
+    assert len(pedigree.entries) == 3
+
+
+def test_pedigree_handles_deep_lineages():
+    butterfly = Butterfly('aaaaaaaa')
+    for i in range(5000):
+        butterfly = Butterfly('bbbbbbbb', parents=[butterfly])
+    pedigree = Pedigree()
+    number = pedigree.add(butterfly)
+    loaded = load_pedigree(pedigree.entries)[number]
+    depth = 0
+    while loaded.parents:
+        loaded, = loaded.parents
+        depth += 1
+    assert depth == 5000
+
+
+def old_format_save():
+    """A save as written before pedigrees: butterflies copied in full"""
+    return json.loads(json.dumps({
+        'broods': [
+            [[{'wing': 'aaaaaaaa'}, {'wing': 'bbbbbbbb'}], []],
+            [[{'wing': 'cccccccc'}]],
+        ],
+        'in_tutorial': False,
+        'butterflies': [{'wing': 'dddddddd'}, {'wing': 'aaaaaaaa'}],
+        'last_level': 3,
+        'level_achievements': {1: ['apple', 'key:2'], 4: []},
+        'best_scores': {1: 120, 4: 7},
+    }))
+
+
+def summarize(state):
+    return (
+        [[[p.hues for p in egg.parents] for egg in b] for b in state.broods],
+        [b.hues for b in state.butterflies],
+        state.in_tutorial,
+        state.last_level,
+        state.level_achievements,
+        state.best_scores,
+        state.accessible_levels,
+    )
+
+
+def test_old_format_save_loads():
+    state = GameState.from_dict(old_format_save())
+    assert summarize(state) == (
+        [[['aaaaaaaa', 'bbbbbbbb'], []], [['cccccccc']]],
+        ['dddddddd', 'aaaaaaaa'],
+        False,
+        3,
+        {1: ['apple', 'key:2'], 4: []},
+        {1: 120, 4: 7},
+        [True, False, True] + [False] * 7,
+    )
+
+
+def test_old_format_save_round_trip():
+    state = GameState.from_dict(old_format_save())
+    saved = json.loads(json.dumps(state.to_dict()))
+    assert 'pedigree' in saved
+    loaded = GameState.from_dict(saved)
+    assert summarize(loaded) == summarize(state)
+
+
+def test_save_round_trip_keeps_lineage():
+    grandparent, mother, father, child = make_family()
+    state = GameState()
+    state.butterflies = [child, father]
+    state.broods = [[Egg([mother, father]), Egg([child])]]
+    saved = json.loads(json.dumps(state.to_dict()))
+    loaded = GameState.from_dict(saved)
+    assert [hues_of(b) for b in loaded.butterflies] == [
+        hues_of(child), hues_of(father),
+    ]
+    first, second = loaded.broods[0]
+    assert [hues_of(p) for p in first.parents] == [
+        hues_of(mother), hues_of(father),
+    ]
+    # Shared butterflies load back as one object
+    assert first.parents[1] is loaded.butterflies[1]
+    assert second.parents[0] is loaded.butterflies[0]
+
+
+class Recorder:
+    """Collects the calls a SaveWriter makes"""
+    def __init__(self):
+        self.calls = []
+        self.called = threading.Event()
+
+    def write(self, target, data):
+        self.calls.append((target, data))
+        self.called.set()
+
+    def fail(self, target, data):
+        raise OSError('disk full')
+
+
+def test_save_writer_coalesces_writes():
+    recorder = Recorder()
+    writer = SaveWriter(delay=60)
+    for i in range(5):
+        writer.schedule('a', recorder.write, i)
+    writer.schedule('b', recorder.write, 'x')
+    writer.flush()
+    assert recorder.calls == [('a', 4), ('b', 'x')]
+    writer.flush()
+    assert len(recorder.calls) == 2
+
+
+def test_save_writer_recovers_from_errors(capsys):
+    recorder = Recorder()
+    writer = SaveWriter(delay=0.01)
+    writer.schedule('bad', recorder.fail, 1)
+    writer.schedule('good', recorder.write, 2)
+    assert recorder.called.wait(5)
+    assert recorder.calls == [('good', 2)]
+    assert writer.thread.is_alive()
+
+    recorder.called.clear()
+    writer.schedule('bad', recorder.write, 3)
+    assert recorder.called.wait(5)
+    assert recorder.calls == [('good', 2), ('bad', 3)]
+    assert 'disk full' in capsys.readouterr().err
@@ -0,0 +1,199 @@
+import json
+import sqlite3
+
+import pytest
+
+from caterpillar_game.butterfly import Butterfly
+from caterpillar_game.egg import Egg
+from caterpillar_game.state import GameState
+from caterpillar_game.state_store import ButterflyStore, get_mean_hue
+
+
+@pytest.fixture(autouse=True)
+def no_saving(monkeypatch):
+    # Loading a game saves it right away; keep the tests from writing files
+    monkeypatch.setattr(GameState, 'save', lambda self, path=None: None)
+
+
+def make_family():
+    grandparent = Butterfly('aaaaaaaa')
+    mother = Butterfly('bbbbbbbb', parents=[grandparent, grandparent])
+    father = Butterfly('cccccccc', parents=[grandparent])
+    child = Butterfly('dddddddd', parents=[mother, father])
+    return grandparent, mother, father, child
+
+
+def hues_of(butterfly):
+    """A butterfly's hues and those of its ancestors, as nested tuples"""
+    return butterfly.hues, tuple(hues_of(p) for p in butterfly.parents)
+
+
+def test_store_keeps_lineage(tmp_path):
+    grandparent, mother, father, child = make_family()
+    store = ButterflyStore(tmp_path / 'save.sqlite')
+    store.add_butterfly(child)
+    store.add_butterfly(father)
+    store.add_brood([Egg([mother, father]), Egg([child])])
+    store.close()
+
+    store = ButterflyStore(tmp_path / 'save.sqlite')
+    # Each butterfly of the lineage is stored once
+    assert store._query_one('SELECT count(*) FROM pedigree') == 4
+    loaded_child, loaded_father = store.butterflies
+    assert hues_of(loaded_child) == hues_of(child)
+    assert hues_of(loaded_father) == hues_of(father)
+    first, second = store.broods[0]
+    assert [hues_of(p) for p in first.parents] == [
+        hues_of(mother), hues_of(father),
+    ]
+    # Shared butterflies load back as one object
+    assert first.parents[1] is loaded_father
+    assert second.parents[0] is loaded_child
+    loaded_mother = first.parents[0]
+    assert loaded_mother.parents[0] is loaded_father.parents[0]
+    store.close()
+
+
+def test_store_handles_deep_lineages(tmp_path):
+    butterfly = Butterfly('aaaaaaaa')
+    for i in range(2000):
+        butterfly = Butterfly('bbbbbbbb', parents=[butterfly])
+    store = ButterflyStore(tmp_path / 'save.sqlite')
+    store.add_butterfly(butterfly)
+    store.close()
+
+    store = ButterflyStore(tmp_path / 'save.sqlite')
+    loaded = store.butterflies[0]
+    depth = 0
+    while loaded.parents:
+        loaded, = loaded.parents
+        depth += 1
+    assert depth == 2000
+    store.close()
+
+
+def test_store_loads_rows_without_pedigree(tmp_path):
+    path = tmp_path / 'save.sqlite'
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        CREATE TABLE butterflies (
+            id INTEGER PRIMARY KEY,
+            level INTEGER,
+            wing TEXT NOT NULL,
+            mean_hue INTEGER NOT NULL
+        );
+        CREATE TABLE eggs (
+            id INTEGER PRIMARY KEY,
+            brood INTEGER NOT NULL,
+            parents TEXT NOT NULL
+        );
+    ''')
+    connection.execute(
+        "INSERT INTO butterflies (level, wing, mean_hue) VALUES (1, 'aaaa', 97)"
+    )
+    connection.execute(
+        'INSERT INTO eggs (brood, parents) VALUES (0, ?)',
+        (json.dumps([{'wing': 'bbbb'}]),),
+    )
+    connection.commit()
+    connection.close()
+
+    store = ButterflyStore(path)
+    store.add_butterfly(Butterfly('cccc', parents=[Butterfly('dddd')]))
+    first, second = store.butterflies
+    assert hues_of(first) == ('aaaa', ())
+    assert hues_of(second) == ('cccc', (('dddd', ()),))
+    egg, = store.broods[0]
+    assert [hues_of(p) for p in egg.parents] == [('bbbb', ())]
+    store.close()
+
+
+def test_json_save_moves_to_store_with_lineage(tmp_path):
+    grandparent, mother, father, child = make_family()
+    state = GameState()
+    state.butterflies = [child, father]
+    state.broods = [[Egg([mother, father])]]
+    json_path = tmp_path / 'save.json'
+    json_path.write_text(json.dumps(state.to_dict()))
+
+    store = ButterflyStore(tmp_path / 'save.sqlite')
+    loaded = GameState.from_store(store, json_path=json_path)
+    assert [hues_of(b) for b in loaded.butterflies] == [
+        hues_of(child), hues_of(father),
+    ]
+    egg, = loaded.broods[0]
+    assert [hues_of(p) for p in egg.parents] == [
+        hues_of(mother), hues_of(father),
+    ]
+    assert loaded.meta_to_dict() == state.meta_to_dict()
+    store.save_meta(loaded.meta_to_dict())
+    store.close()
+
+    # Once the store has been saved, the JSON save isn't read again
+    json_path.unlink()
+    store = ButterflyStore(tmp_path / 'save.sqlite')
+    reloaded = GameState.from_store(store, json_path=json_path)
+    assert len(reloaded.butterflies) == 2
+    assert len(reloaded.broods) == 1
+    assert reloaded.meta_to_dict() == state.meta_to_dict()
+    store.close()
+
+
+def test_store_round_trip(tmp_path):
+    first = Butterfly('AAAAAAAA')
+    second = Butterfly('MMMMMMMM')
+    third = Butterfly('AAAAAAAA', parents=[second])
+    store = ButterflyStore(tmp_path / 'save.sqlite')
+    store.add_butterfly(first, level=1)
+    store.add_butterfly(second, level=2)
+    store.add_butterfly(third, level=2)
+    store.add_brood([Egg(), Egg([first])])
+    store.add_brood([Egg([first, second])])
+    store.save_meta({'last_level': 2})
+    store.close()
+
+    store = ButterflyStore(tmp_path / 'save.sqlite')
+    assert store.load_meta() == {'last_level': 2}
+    assert len(store.butterflies) == 3
+    assert [b.hues for b in store.butterflies] == [
+        'AAAAAAAA', 'MMMMMMMM', 'AAAAAAAA',
+    ]
+    assert hues_of(store.butterflies[-1]) == hues_of(third)
+    with pytest.raises(IndexError):
+        store.butterflies[3]
+
+    assert len(store.broods) == 2
+    assert store.broods.egg_count == 3
+    assert [len(brood) for brood in store.broods] == [2, 1]
+    assert [len(brood) for brood in reversed(store.broods)] == [1, 2]
+    egg, = store.broods[-1]
+    assert [p.hues for p in egg.parents] == ['AAAAAAAA', 'MMMMMMMM']
+    with pytest.raises(IndexError):
+        store.broods[2]
+
+    def found(**filters):
+        return [hues_of(b) for b in store.find_butterflies(**filters)]
+    first_hue = get_mean_hue(first.hues)
+    assert first_hue != get_mean_hue(second.hues)
+    assert found(level=2) == [hues_of(second), hues_of(third)]
+    assert found(mean_hue=first_hue) == [hues_of(first), hues_of(third)]
+    assert found(level=2, mean_hue=first_hue) == [hues_of(third)]
+    assert found(mean_hue=first_hue, limit=1) == [hues_of(first)]
+    assert found(level=3) == []
+    store.close()
+
+
+def test_count_eggs_with_store(tmp_path):
+    store = ButterflyStore(tmp_path / 'save.sqlite')
+    state = GameState.from_store(store, json_path=tmp_path / 'missing.json')
+    # A new game starts with a brood of eggs
+    assert len(state.broods) == 1
+    assert state.count_eggs() == 5
+    assert state.count_eggs(max=2) == 2
+    state.broods.append([Egg(), Egg()])
+    assert state.count_eggs() == 7
+
+    state.level_completed(4, 10, [], Butterfly('aaaaaaaa'))
+    assert [b.hues for b in store.find_butterflies(level=4)] == ['aaaaaaaa']
+    assert len(state.butterflies) == 1
+    store.close()
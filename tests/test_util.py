@@ -0,0 +1,41 @@
+import random
+
+from caterpillar_game.util import IndexedSet
+
+
+def test_indexed_set_behaves_like_set():
+    rng = random.Random(0)
+    indexed = IndexedSet()
+    reference = set()
+    for i in range(2000):
+        item = rng.randrange(50), rng.randrange(50)
+        if rng.randrange(3):
+            indexed.add(item)
+            reference.add(item)
+        else:
+            indexed.discard(item)
+            reference.discard(item)
+        assert len(indexed) == len(reference)
+        assert (item in indexed) == (item in reference)
+    assert set(indexed) == reference
+    assert len(list(indexed)) == len(reference)
+
+
+def test_indexed_set_keeps_insertion_order_until_discard():
+    indexed = IndexedSet([3, 1, 2, 1])
+    assert list(indexed) == [3, 1, 2]
+    # The last item takes the place of a discarded one
+    indexed.discard(3)
+    assert list(indexed) == [2, 1]
+    indexed.discard(3)
+    indexed.discard(1)
+    assert list(indexed) == [2]
+
+
+def test_indexed_set_choice():
+    indexed = IndexedSet(range(10))
+    for i in range(5):
+        indexed.discard(i)
+    random.seed(0)
+    choices = {indexed.choice() for i in range(200)}
+    assert choices == {5, 6, 7, 8, 9}
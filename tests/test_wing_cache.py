@@ -0,0 +1,83 @@
+import ctypes
+import os
+import time
+
+from caterpillar_game import wing_cache
+from caterpillar_game.wing_cache import WingCache
+
+SIZE = 4
+BUFFER_TYPE = ctypes.c_ubyte * (SIZE * SIZE * 4)
+
+
+def make_buffer(value):
+    return BUFFER_TYPE(*[value] * (SIZE * SIZE * 4))
+
+
+def test_cache_round_trip(tmp_path):
+    cache = WingCache(tmp_path)
+    assert cache.get('model', 'abc', SIZE, BUFFER_TYPE) is None
+    cache.put('model', 'abc', SIZE, make_buffer(7))
+    assert bytes(cache.get('model', 'abc', SIZE, BUFFER_TYPE)) == bytes(
+        make_buffer(7),
+    )
+    assert cache.get('other', 'abc', SIZE, BUFFER_TYPE) is None
+
+
+def test_cache_reads_without_updating_times(tmp_path, monkeypatch):
+    cache = WingCache(tmp_path)
+    cache.put('model', 'abc', SIZE, make_buffer(7))
+
+    def fail(*args, **kwargs):
+        raise PermissionError('read-only')
+    monkeypatch.setattr(os, 'utime', fail)
+    assert bytes(cache.get('model', 'abc', SIZE, BUFFER_TYPE)) == bytes(
+        make_buffer(7),
+    )
+
+
+def test_unreadable_entries_are_misses(tmp_path, monkeypatch):
+    cache = WingCache(tmp_path)
+    cache.put('model', 'abc', SIZE, make_buffer(7))
+
+    def fail(*args, **kwargs):
+        raise PermissionError('unreadable')
+    monkeypatch.setattr(wing_cache.mmap, 'mmap', fail)
+    assert cache.get('model', 'abc', SIZE, BUFFER_TYPE) is None
+
+
+def test_trim_removes_least_recently_used(tmp_path):
+    entry_size = SIZE * SIZE * 4
+    cache = WingCache(tmp_path, max_bytes=entry_size * 4)
+    for i in range(4):
+        cache.put('model', str(i), SIZE, make_buffer(i))
+        path = cache.get_path('model', str(i), SIZE)
+        os.utime(path, (1000 + i, 1000 + i))
+    cache.trim()
+    assert cache.total_bytes == entry_size * 4
+    cache.put('model', '4', SIZE, make_buffer(4))
+    # Trimmed to 3/4 of the limit, oldest first
+    assert cache.total_bytes == entry_size * 3
+    assert [
+        cache.get('model', str(i), SIZE, BUFFER_TYPE) is not None
+        for i in range(5)
+    ] == [False, False, True, True, True]
+
+
+def test_trim_removes_stale_temporary_files(tmp_path):
+    cache = WingCache(tmp_path)
+    stale = tmp_path / 'stale.tmp'
+    fresh = tmp_path / 'fresh.tmp'
+    for path in stale, fresh:
+        path.write_bytes(b'partial')
+    old = time.time() - wing_cache.STALE_TMP_AGE - 10
+    os.utime(stale, (old, old))
+    cache.trim()
+    assert not stale.exists()
+    assert fresh.exists()
+    assert cache.total_bytes == 0
+
+
+def test_missing_cache_directory(tmp_path):
+    cache = WingCache(tmp_path / 'missing')
+    cache.trim()
+    assert cache.get('model', 'abc', SIZE, BUFFER_TYPE) is None